@@ -1,33 +1,238 @@
 import os
+import sys
+import copy
+import atexit
 import json
-import base64
+import binascii
+import errno
 import hashlib
+import random
 import re
 import time
 import threading
+import functools
+import itertools
+import math
+import mmap
+import contextvars
+import difflib
+import importlib.util
+import shutil
+import socket
+import sqlite3
+import stat
+import struct
+import urllib.parse
+import zlib
+from contextlib import contextmanager
 from io import BytesIO
+from types import SimpleNamespace
 from typing import Optional, List, Dict, Any, Tuple, Union
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
-from PIL import Image, ImageOps
+import anyio
+import httpx
+from PIL import Image, ImageChops, ImageFilter, ImageOps, ImageSequence, UnidentifiedImageError
+from mcp import types as mcp_types
 from mcp.server.fastmcp import FastMCP
-from litellm import completion
-import litellm.exceptions
 
 # --- CONFIGURATION ---
 MODEL_NAME = os.getenv("VISION_MODEL", "gpt-4o")
 REPAIR_MODEL = os.getenv("VISION_REPAIR_MODEL", MODEL_NAME)
 
+# Optional OpenAI-compatible endpoint override (proxies, self-hosted deployments)
+API_BASE = os.getenv("VISION_API_BASE") or None
+
 BASE_DIR = os.getenv("VISION_BASE_DIR", os.getcwd()) 
 MAX_FILE_SIZE_MB = 20
 CACHE_TTL = 300  # 5 minutes
 CACHE_MAX_SIZE = 100
-PROMPT_VERSION = "v1.5" 
+PROMPT_VERSION = "v1.6" 
+
+# Perceptual near-duplicate reuse. Negative disables; otherwise the max Hamming
+# distance (out of NEAR_DUP_HASH_BITS) at which a cached result is reused.
+NEAR_DUP_MAX_DISTANCE = int(os.getenv("VISION_NEAR_DUP_DISTANCE", "-1"))
+NEAR_DUP_HASH_SIZE = 16
+NEAR_DUP_HASH_BITS = NEAR_DUP_HASH_SIZE * NEAR_DUP_HASH_SIZE
+
+# Shared HTTP connection pool for provider calls
+HTTP_POOL_SIZE = int(os.getenv("VISION_HTTP_POOL_SIZE", "32"))
+HTTP_PER_PROVIDER_LIMIT = int(os.getenv("VISION_HTTP_PER_PROVIDER", "16"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("VISION_HTTP_KEEPALIVE", "120"))
+HTTP_TIMEOUT_SECONDS = float(os.getenv("VISION_HTTP_TIMEOUT", "120"))
+HTTP2_ENABLED = os.getenv("VISION_HTTP2", "1") == "1"
+HTTP_WARM_URLS = [u.strip() for u in os.getenv("VISION_HTTP_WARM_URLS", "").split(",") if u.strip()]
+
+# Long-running HTTP deployment: SQLite file holding the response cache and rate
+# limiter state shared by every worker process (empty = per-process), and how
+# long a shutdown waits for in-flight requests to finish
+SHARED_STORE_PATH = os.getenv("VISION_SHARED_STORE", "")
+DRAIN_SECONDS = float(os.getenv("VISION_DRAIN_SECONDS", "30"))
+
+# Preload litellm and open provider connections in the background once a client
+# has completed the MCP handshake (0 = load everything on the first call)
+WARM_UP_ENABLED = os.getenv("VISION_WARMUP", "1") == "1"
+
+# Client-side rate limiting (0 = learn from provider headers / 429s)
+RATE_LIMIT_RPM = float(os.getenv("VISION_RATE_LIMIT_RPM", "0"))
+RATE_LIMIT_TPM = float(os.getenv("VISION_RATE_LIMIT_TPM", "0"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("VISION_RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("VISION_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("VISION_RETRY_MAX_DELAY", "30"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("VISION_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("VISION_BREAKER_RESET", "30"))
+
+# Request hedging: when a call outlasts the given percentile of recent
+# latency, send a duplicate to a second model and/or endpoint and take the
+# first answer. Off unless VISION_HEDGE_MODEL or VISION_HEDGE_API_BASE is set.
+# The budget caps duplicates as a fraction of primary calls.
+HEDGE_MODEL = os.getenv("VISION_HEDGE_MODEL", "")
+HEDGE_API_BASE = os.getenv("VISION_HEDGE_API_BASE", "")
+HEDGE_PERCENTILE = float(os.getenv("VISION_HEDGE_PERCENTILE", "95"))
+HEDGE_BUDGET = float(os.getenv("VISION_HEDGE_BUDGET", "0.05"))
+HEDGE_MIN_DELAY = float(os.getenv("VISION_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_INITIAL_DELAY = float(os.getenv("VISION_HEDGE_INITIAL_DELAY", "15"))
+HEDGE_MIN_SAMPLES = 20
+
+# Inference scheduling: concurrent provider calls, priority classes (lower runs first)
+MAX_CONCURRENT_INFERENCES = int(os.getenv("VISION_MAX_CONCURRENCY", "8"))
+PRIORITY_CLASSES = {"interactive": 0, "normal": 1, "bulk": 2}
+
+# Multi-frame images: max frames per request, concurrent per-frame analyses
+MAX_FRAMES = int(os.getenv("VISION_MAX_FRAMES", "64"))
+FRAME_WORKERS = int(os.getenv("VISION_FRAME_WORKERS", "4"))
+
+# Video keyframe extraction (needs the optional 'video' extra, PyAV)
+MAX_VIDEO_SIZE_MB = float(os.getenv("VISION_MAX_VIDEO_MB", "200"))
+VIDEO_SAMPLE_FPS = float(os.getenv("VISION_VIDEO_SAMPLE_FPS", "2"))
+VIDEO_MAX_SAMPLES = int(os.getenv("VISION_VIDEO_MAX_SAMPLES", "3600"))
+SCENE_CHANGE_THRESHOLD = float(os.getenv("VISION_SCENE_THRESHOLD", "0.25"))
+
+# PDF documents (needs the optional 'pdf' extra, pypdfium2): DPI bounds for
+# rasterizing, and whether ocr reads a page's text layer instead of the model
+# (pages whose region is mostly covered by images count as scans)
+PDF_MIN_DPI = int(os.getenv("VISION_PDF_MIN_DPI", "72"))
+PDF_MAX_DPI = int(os.getenv("VISION_PDF_MAX_DPI", "300"))
+PDF_TEXT_LAYER = os.getenv("VISION_PDF_TEXT_LAYER", "1") == "1"
+PDF_SCANNED_COVERAGE = 0.5
+
+# Content pre-detection: occupancy grid resolution (cells on the long side),
+# edge strength that counts as content, and the gap between mosaic tiles
+CONTENT_GRID_CELLS = int(os.getenv("VISION_CONTENT_GRID", "160"))
+CONTENT_EDGE_THRESHOLD = int(os.getenv("VISION_CONTENT_EDGE_THRESHOLD", "24"))
+MOSAIC_GAP = 8
+CONTENT_CROP_MODES = {"crop", "mosaic"}
+
+# Compact wire schema for ocr/ui: the model emits bare rows with bbox on a
+# fixed integer grid, expanded server-side into the usual envelope
+COMPACT_OUTPUT = os.getenv("VISION_COMPACT_OUTPUT", "0") == "1"
+COMPACT_GRID = 1000
+
+# Screenshot fast path for ocr/ui: text-preserving downscale (integer reduce +
+# area averaging + light unsharp instead of bicubic) when the image looks like
+# a UI capture, and lossless palette PNGs when it has at most 256 colours
+SCREENSHOT_FAST_PATH = os.getenv("VISION_SCREENSHOT_FAST_PATH", "1") == "1"
+SCREENSHOT_SAMPLE_PX = 256
+SCREENSHOT_TOP_COLORS = 16
+SCREENSHOT_MIN_FLAT_SHARE = 0.6
+
+# Progressive (coarse-to-fine) analysis: overview size, the text height in
+# overview pixels below which an area is re-read, items per overview cell that
+# count as dense, and the cap on concurrent full-resolution sub-calls
+PROGRESSIVE_OVERVIEW_PX = int(os.getenv("VISION_PROGRESSIVE_OVERVIEW_PX", "1280"))
+PROGRESSIVE_TINY_PX = float(os.getenv("VISION_PROGRESSIVE_TINY_PX", "10"))
+PROGRESSIVE_DENSE_ITEMS = int(os.getenv("VISION_PROGRESSIVE_DENSE_ITEMS", "12"))
+PROGRESSIVE_MAX_REGIONS = int(os.getenv("VISION_PROGRESSIVE_MAX_REGIONS", "8"))
+PROGRESSIVE_WORKERS = int(os.getenv("VISION_PROGRESSIVE_WORKERS", "4"))
+PROGRESSIVE_CELLS = 8
+PROGRESSIVE_MARGIN_PX = 24
+
+# Grounded box refinement: longest side of the analysed search window, and the
+# share of a detected component that must lie inside the model's box to snap to it
+REFINE_WINDOW_PX = 256
+REFINE_MIN_COVERAGE = 0.5
+
+# Uploaded image bytes (examine_image image_data) kept by content hash, so a
+# later call can name the hash instead of uploading again
+BLOB_CACHE_MB = float(os.getenv("VISION_BLOB_CACHE_MB", "256"))
+
+# Label similarity (0-1) a fuzzy find_element match needs
+SPATIAL_FUZZY_CUTOFF = float(os.getenv("VISION_SPATIAL_FUZZY_CUTOFF", "0.6"))
+
+# Provider traffic recording: VISION_RECORD appends every model call (request
+# with image hashes instead of bytes, raw response, latency) to a JSONL file;
+# VISION_REPLAY serves a recording back offline, with latencies divided by
+# VISION_REPLAY_SPEED (0 answers instantly)
+RECORD_PATH = os.getenv("VISION_RECORD", "")
+REPLAY_PATH = os.getenv("VISION_REPLAY", "")
+REPLAY_SPEED = float(os.getenv("VISION_REPLAY_SPEED", "1"))
+
+# Offline batch jobs (submit_batch_job) through an OpenAI-compatible Batch API.
+# Job state and results are kept under VISION_BATCH_DIR; the endpoint defaults
+# to VISION_API_BASE, the key to VISION_BATCH_API_KEY or OPENAI_API_KEY
+BATCH_DIR = os.path.expanduser(os.getenv("VISION_BATCH_DIR", "~/.cache/mcp-eyes-8k/batches"))
+BATCH_API_BASE = os.getenv("VISION_BATCH_API_BASE", "")
+BATCH_POLL_SECONDS = float(os.getenv("VISION_BATCH_POLL_SECONDS", "60"))
+BATCH_MAX_FILE_MB = 190  # provider limit is 200 MB per input file
+BATCH_MAX_REQUESTS = 50000
+BATCH_IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp", ".tif", ".tiff"}
+
+# Tiled multi-resolution pyramids for very large images, built once per content
+# hash under VISION_PYRAMID_DIR and read a few tiles at a time. Files up to
+# PYRAMID_MAX_FILE_MB are accepted (uncompressed only, plain analysis and region
+# only above MAX_FILE_SIZE_MB); smaller images over PYRAMID_MIN_MP megapixels use them too
+PYRAMID_ENABLED = os.getenv("VISION_PYRAMID", "1") == "1"
+PYRAMID_DIR = os.path.expanduser(os.getenv("VISION_PYRAMID_DIR", "~/.cache/mcp-eyes-8k/pyramids"))
+PYRAMID_MAX_FILE_MB = float(os.getenv("VISION_PYRAMID_MAX_FILE_MB", "2048"))
+PYRAMID_MIN_PIXELS = int(float(os.getenv("VISION_PYRAMID_MIN_MP", "40")) * 1_000_000)
+PYRAMID_MAX_PIXELS = int(float(os.getenv("VISION_PYRAMID_MAX_MP", "1000")) * 1_000_000)
+PYRAMID_MAX_GB = float(os.getenv("VISION_PYRAMID_MAX_GB", "20"))
+PYRAMID_TILE = 512
+
+# Cache snapshots for warm-starting new nodes: exports are written to (and
+# tool imports read from) VISION_SNAPSHOT_DIR; VISION_SNAPSHOTS lists snapshot
+# files attached read-only at startup
+SNAPSHOT_DIR = os.path.expanduser(os.getenv("VISION_SNAPSHOT_DIR", "~/.cache/mcp-eyes-8k/snapshots"))
+SNAPSHOT_PATHS = [p.strip() for p in os.getenv("VISION_SNAPSHOTS", "").split(",") if p.strip()]
+
+# Full-text index over OCR text and UI labels (SQLite path; ':memory:' keeps it
+# per process, an empty value disables indexing)
+RESULT_INDEX_PATH = os.getenv("VISION_INDEX_PATH", ":memory:")
 
 ALLOWED_MODES = {"ui", "ocr", "general", "query"}
 
 mcp = FastMCP("Active Vision Adamant")
 
+# --- LAZY IMPORTS ---
+_LITELLM_LOCK = threading.Lock()
+_LITELLM = None
+
+def _litellm():
+    """
+    litellm takes seconds and ~150 MB to import (provider tables, tokenizers),
+    so it is loaded on first use rather than before the MCP handshake. The
+    lock makes concurrent first calls wait for the finished module; the
+    import system alone can hand out a partially initialized one.
+    """
+    global _LITELLM
+    if _LITELLM is None:
+        with _LITELLM_LOCK:
+            if _LITELLM is None:
+                import litellm
+                _LITELLM = litellm
+    return _LITELLM
+
+def completion(**kwargs):
+    """litellm.completion, imported on first call."""
+    return _litellm().completion(**kwargs)
+
+def _is_litellm_error(exc: BaseException, *names: str) -> bool:
+    """isinstance() against litellm.exceptions; never imports litellm itself."""
+    module = sys.modules.get("litellm.exceptions")
+    classes = tuple(c for c in (getattr(module, name, None) for name in names) if isinstance(c, type))
+    return bool(classes) and isinstance(exc, classes)
+
 # --- THREAD-SAFE LRU CACHE ---
 class TTLCache:
     def __init__(self, max_size: int, ttl: int):
@@ -47,6 +252,14 @@ class TTLCache:
             self.cache.move_to_end(key)
             return data
 
+    def peek(self, key: str) -> Optional[Any]:
+        """get() without touching recency."""
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
     def set(self, key: str, value: Any):
         with self.lock:
             if key in self.cache:
@@ -55,313 +268,4433 @@ class TTLCache:
             if len(self.cache) > self.max_size:
                 self.cache.popitem(last=False)
 
-_CACHE = TTLCache(CACHE_MAX_SIZE, CACHE_TTL)
+    def items(self, prefix: str = ""):
+        """Live (key, value) pairs whose key starts with prefix."""
+        now = time.time()
+        with self.lock:
+            entries = [(k, v) for k, (v, ts) in self.cache.items() if k.startswith(prefix) and now - ts <= self.ttl]
+        return iter(entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"entries": len(self.cache), "shared": False}
 
-# --- HELPERS ---
+class SharedStore:
+    """
+    SQLite file (WAL) shared by the worker processes of one deployment.
+    transaction() takes the database write lock up front (BEGIN IMMEDIATE),
+    so read-modify-write sequences are atomic across processes.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL,
+                                          stored_at REAL NOT NULL, used_at REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS cache_used ON cache(used_at);
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS limiter (key TEXT PRIMARY KEY, state TEXT NOT NULL);
+    """
 
-def _validate_path(path: str) -> str:
-    """Securely validates path is within BASE_DIR using strict resolution."""
-    abs_path = os.path.realpath(os.path.abspath(path))
-    base_abs = os.path.realpath(os.path.abspath(BASE_DIR))
+    def __init__(self, db_path: str):
+        self.path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(self.SCHEMA)
 
-    try:
-        if os.path.commonpath([base_abs, abs_path]) != base_abs:
-            raise PermissionError("Access denied: Path outside strict base directory.")
-    except ValueError:
-         raise PermissionError("Access denied: Path on different drive.")
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
 
-    if not os.path.exists(abs_path):
-        raise FileNotFoundError(f"File not found: {path}")
-        
-    if os.path.getsize(abs_path) > (MAX_FILE_SIZE_MB * 1024 * 1024):
-        raise ValueError(f"File too large (> {MAX_FILE_SIZE_MB}MB)")
-        
-    return abs_path
+    def incr(self, conn: sqlite3.Connection, name: str, value: float = 1):
+        conn.execute("INSERT INTO counters (name, value) VALUES (?, ?) "
+                     "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, value))
 
-def _process_image(path: str, region: Optional[List[int]], mode: str):
+class SharedCache:
     """
-    Loads, crops, resizes, and encodes.
-    Returns: (b64, mime, orig_size, crop_bbox, sent_size)
-    """
-    with Image.open(path) as img:
-        img = ImageOps.exif_transpose(img)
-        orig_w, orig_h = img.size
-
-        # 1. Crop Logic
-        if region:
-            x1, y1, x2, y2 = region
-            x1, y1 = max(0, x1), max(0, y1)
-            x2, y2 = min(orig_w, x2), min(orig_h, y2)
-            if x2 <= x1 or y2 <= y1:
-                raise ValueError(f"Invalid region {region} for image size {orig_w}x{orig_h}")
-            crop_bbox = (x1, y1, x2, y2)
-            img = img.crop(crop_bbox)
-        else:
-            crop_bbox = (0, 0, orig_w, orig_h)
+    TTLCache drop-in backed by a SharedStore, so a result computed by one worker
+    is a hit for every other. Values are stored as JSON; least recently used
+    entries beyond max_size are evicted. Hits and misses are counted in the
+    store, so get_metrics reports the hit rate of the whole fleet.
 
-        # 2. Resize Logic
-        max_dim = 2560 if mode in ["ocr", "ui"] else 1536
-        if max(img.size) > max_dim:
-            img.thumbnail((max_dim, max_dim))
-        
-        sent_w, sent_h = img.size 
+    Lookups never take the write lock. Hit/miss counts, recency updates and
+    expired keys are kept per worker and written in one transaction at most
+    every FLUSH_INTERVAL seconds (or with the next set). Recency is coarse: an
+    entry's used_at only moves once it is TOUCH_INTERVAL seconds old.
+    """
+    FLUSH_INTERVAL = 5.0
+    TOUCH_INTERVAL = 60.0
 
-        # 3. Encoding Logic
-        buffer = BytesIO()
-        if mode in ["ocr", "ui"]:
-            mime = "image/png"
-            img.save(buffer, format="PNG", optimize=True)
-        else:
-            mime = "image/jpeg"
-            if img.mode in ("RGBA", "LA"):
-                bg = Image.new("RGB", img.size, (255, 255, 255))
-                bg.paste(img, mask=img.split()[-1])
-                img = bg
-            elif img.mode != "RGB":
-                img = img.convert("RGB")
-            img.save(buffer, format="JPEG", quality=85, optimize=True)
+    def __init__(self, store: SharedStore, max_size: int, ttl: int):
+        self.store = store
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.counts: Dict[str, float] = {}
+        self.touched: Dict[str, float] = {}
+        self.expired: Dict[str, float] = {}
+        self.flushed_at = time.monotonic()
 
-        return (
-            base64.b64encode(buffer.getvalue()).decode("utf-8"),
-            mime,
-            (orig_w, orig_h),
-            crop_bbox,
-            (sent_w, sent_h)
-        )
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self.store.lock:
+            row = self.store.conn.execute("SELECT value, stored_at, used_at FROM cache WHERE key = ?", (key,)).fetchone()
+        hit = row is not None and now - row[1] <= self.ttl
+        with self.lock:
+            name = "cache.hits" if hit else "cache.misses"
+            self.counts[name] = self.counts.get(name, 0) + 1
+            if row is not None and not hit:
+                self.expired[key] = now - self.ttl
+            elif hit and now - row[2] > self.TOUCH_INTERVAL:
+                self.touched[key] = now
+            due = time.monotonic() - self.flushed_at >= self.FLUSH_INTERVAL
+        if due:
+            self.flush()
+        return json.loads(row[0]) if hit else None
 
-def _normalize_content(content: Any) -> str:
-    """Safely converts diverse provider outputs (lists, dicts, None) to string."""
-    if content is None:
-        return ""
-    if isinstance(content, str):
-        return content
-    if isinstance(content, list):
-        parts = []
-        for item in content:
-            if isinstance(item, str):
-                parts.append(item)
-            elif isinstance(item, dict):
-                parts.append(str(item.get("text", item)))
-            else:
-                parts.append(str(item))
-        return "\n".join(parts)
-    return str(content)
+    def peek(self, key: str) -> Optional[Any]:
+        """get() without counting a hit or miss or touching recency."""
+        with self.store.lock:
+            row = self.store.conn.execute("SELECT value, stored_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def _write_pending(self, conn: sqlite3.Connection):
+        with self.lock:
+            counts, touched, expired = self.counts, self.touched, self.expired
+            self.counts, self.touched, self.expired = {}, {}, {}
+            self.flushed_at = time.monotonic()
+        for name, value in counts.items():
+            self.store.incr(conn, name, value)
+        conn.executemany("UPDATE cache SET used_at = MAX(used_at, ?) WHERE key = ?",
+                         [(used_at, key) for key, used_at in touched.items()])
+        # Only rows still expired: another worker may have stored a fresh value since
+        conn.executemany("DELETE FROM cache WHERE key = ? AND stored_at < ?", list(expired.items()))
+
+    def flush(self):
+        """Writes this worker's pending counters, recency updates and expiries."""
+        with self.lock:
+            if not (self.counts or self.touched or self.expired):
+                self.flushed_at = time.monotonic()
+                return
+        with self.store.transaction() as conn:
+            self._write_pending(conn)
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        data = json.dumps(value)
+        with self.store.transaction() as conn:
+            self._write_pending(conn)
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, stored_at, used_at) VALUES (?, ?, ?, ?)",
+                         (key, data, now, now))
+            excess = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_size
+            if excess > 0:
+                conn.execute("DELETE FROM cache WHERE key IN "
+                             "(SELECT key FROM cache ORDER BY used_at LIMIT ?)", (excess,))
+
+    def items(self, prefix: str = ""):
+        """Live (key, value) pairs whose key starts with prefix, streamed in pages."""
+        last = prefix
+        while True:
+            with self.store.lock:
+                rows = self.store.conn.execute(
+                    "SELECT key, value, stored_at FROM cache WHERE key > ? AND key LIKE ? ORDER BY key LIMIT 500",
+                    (last, prefix.replace("%", "") + "%")).fetchall()
+            if not rows:
+                return
+            now = time.time()
+            for key, value, stored_at in rows:
+                if now - stored_at <= self.ttl:
+                    yield key, json.loads(value)
+            last = rows[-1][0]
+
+    def stats(self) -> Dict[str, Any]:
+        self.flush()
+        with self.store.lock:
+            entries = self.store.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            counters = dict(self.store.conn.execute(
+                "SELECT name, value FROM counters WHERE name LIKE 'cache.%'").fetchall())
+        hits, misses = counters.get("cache.hits", 0), counters.get("cache.misses", 0)
+        return {
+            "entries": entries,
+            "shared": True,
+            "hits": int(hits),
+            "misses": int(misses),
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+        }
+
+_SHARED_STORE = SharedStore(SHARED_STORE_PATH) if SHARED_STORE_PATH else None
+_CACHE = SharedCache(_SHARED_STORE, CACHE_MAX_SIZE, CACHE_TTL) if _SHARED_STORE else TTLCache(CACHE_MAX_SIZE, CACHE_TTL)
+if _SHARED_STORE:
+    atexit.register(_CACHE.flush)
+
+# --- METRICS ---
+class Metrics:
+    """Thread-safe counters and windowed summaries, exported by get_metrics."""
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self.counters: Dict[str, float] = {}
+        self.samples: Dict[str, deque] = {}
+        self.totals: Dict[str, List[float]] = {}
+        self.lock = threading.Lock()
+
+    def incr(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            self.samples.setdefault(name, deque(maxlen=self.window)).append(value)
+            total = self.totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            summaries = {}
+            for name, values in self.samples.items():
+                ordered = sorted(values)
+                count, total = self.totals[name]
+                summaries[name] = {
+                    "count": count,
+                    "mean": total / count if count else 0.0,
+                    "p50": ordered[len(ordered) // 2] if ordered else 0.0,
+                    "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else 0.0,
+                    "max": ordered[-1] if ordered else 0.0,
+                }
+            return {"counters": dict(self.counters), "summaries": summaries}
+
+_METRICS = Metrics()
+
+# --- REQUEST SCHEDULING ---
+class DeadlineExceeded(TimeoutError):
+    """The request's deadline passed before it could be sent to the model."""
 
-def _adjust_coordinates(result: Dict, crop_bbox: Tuple[int,int,int,int], sent_size: Tuple[int,int], orig_size: Tuple[int,int]):
+class RequestCancelled(RuntimeError):
+    """The MCP client cancelled the request while it was queued."""
+
+class RequestContext:
+    """Per-request scheduling attributes, carried in a context variable."""
+    def __init__(self, priority: str = "normal", deadline: Optional[float] = None, caller: str = "local"):
+        self.priority = priority
+        self.deadline = deadline  # time.monotonic() value
+        self.caller = caller
+        self.cancelled = threading.Event()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise RequestCancelled("Request cancelled by client")
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise DeadlineExceeded("Request deadline exceeded before inference")
+
+    def cancel(self):
+        self.cancelled.set()
+        _SCHEDULER.wake()
+
+_REQUEST_CTX: contextvars.ContextVar[Optional[RequestContext]] = contextvars.ContextVar("vision_request", default=None)
+
+@contextmanager
+def _request_scope(priority: str, deadline_ms: Optional[int]):
+    """Applies a call's priority/deadline to the current (or a new) request context."""
+    request = _REQUEST_CTX.get() or RequestContext(caller=threading.current_thread().name)
+    request.priority = priority
+    if deadline_ms is not None:
+        request.deadline = time.monotonic() + deadline_ms / 1000.0
+    token = _REQUEST_CTX.set(request)
+    try:
+        yield request
+    finally:
+        _REQUEST_CTX.reset(token)
+
+class _Waiter:
+    __slots__ = ("request", "rank", "seq", "enqueued", "granted", "error")
+
+    def __init__(self, request: RequestContext, seq: int):
+        self.request = request
+        self.rank = PRIORITY_CLASSES.get(request.priority, PRIORITY_CLASSES["normal"])
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.error: Optional[Exception] = None
+
+class InferenceScheduler:
     """
-    Maps relative VLM coordinates -> Absolute Original coordinates.
-    Handles normalization detection, sorting, rounding, and safe-clamping.
+    Admission gate in front of the provider. At most `max_concurrency` calls run
+    at once; queued calls are granted by priority class, then fairly across
+    callers (least-served first, like start-time fair queuing), then FIFO.
+    Queued calls whose deadline passes or whose client cancels are dropped
+    before they ever reach the model.
     """
-    crop_x1, crop_y1, crop_x2, crop_y2 = crop_bbox
-    crop_w = crop_x2 - crop_x1
-    crop_h = crop_y2 - crop_y1
-    sent_w, sent_h = sent_size
-    orig_w, orig_h = orig_size
-    
-    # 0-indexed max boundaries for click safety
-    max_x_safe = max(0, orig_w - 1)
-    max_y_safe = max(0, orig_h - 1)
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.active = 0
+        self.waiters: List[_Waiter] = []
+        self.served: Dict[str, float] = {}
+        self.vclock = 0.0
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
 
-    sx = crop_w / max(sent_w, 1)
-    sy = crop_h / max(sent_h, 1)
+    @contextmanager
+    def slot(self, request: RequestContext):
+        request.check()
+        waiter = _Waiter(request, next(self.seq))
+        with self.cond:
+            # Callers joining late start at the current virtual time
+            self.served[request.caller] = max(self.served.get(request.caller, 0.0), self.vclock)
+            self.waiters.append(waiter)
+            self._dispatch()
+            while not waiter.granted and waiter.error is None:
+                timeout = 1.0
+                if request.deadline is not None:
+                    timeout = min(timeout, max(0.0, request.deadline - time.monotonic()) + 0.001)
+                self.cond.wait(timeout)
+                self._dispatch()
+        wait = time.monotonic() - waiter.enqueued
+        _METRICS.observe(f"scheduler.wait_seconds.{request.priority}", wait)
+        if waiter.error is not None:
+            _METRICS.incr(f"scheduler.{'expired' if isinstance(waiter.error, DeadlineExceeded) else 'cancelled'}")
+            raise waiter.error
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self._dispatch()
 
-    def sanitize_and_map(bbox):
-        if not isinstance(bbox, list) or len(bbox) != 4:
-            return bbox
-        
+    def _dispatch(self):
+        """Drops dead waiters and grants free slots. Caller holds the lock."""
+        for waiter in list(self.waiters):
+            try:
+                waiter.request.check()
+            except (DeadlineExceeded, RequestCancelled) as e:
+                waiter.error = e
+                self.waiters.remove(waiter)
+        while self.waiters and self.active < self.max_concurrency:
+            best = min(self.waiters, key=lambda w: (w.rank, self.served.get(w.request.caller, 0.0), w.seq))
+            self.waiters.remove(best)
+            best.granted = True
+            self.active += 1
+            self.vclock = self.served.get(best.request.caller, 0.0)
+            self.served[best.request.caller] = self.vclock + 1
+        if len(self.served) > 4096:
+            waiting = {w.request.caller for w in self.waiters}
+            self.served = {c: v for c, v in self.served.items() if c in waiting or v > self.vclock}
+        self.cond.notify_all()
+
+    def wake(self):
+        with self.cond:
+            self._dispatch()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.cond:
+            depth = {name: 0 for name in PRIORITY_CLASSES}
+            for waiter in self.waiters:
+                depth[waiter.request.priority] = depth.get(waiter.request.priority, 0) + 1
+            oldest = min((w.enqueued for w in self.waiters), default=None)
+            return {
+                "active": self.active,
+                "max_concurrency": self.max_concurrency,
+                "queue_depth": depth,
+                "oldest_wait_seconds": time.monotonic() - oldest if oldest is not None else 0.0,
+            }
+
+_SCHEDULER = InferenceScheduler(MAX_CONCURRENT_INFERENCES)
+
+def _run_tool_in_thread(fn):
+    """
+    Registers a blocking tool with MCP so it runs in a worker thread instead of
+    on the event loop. The MCP session identifies the caller for fair
+    scheduling, and a client cancellation is forwarded to the request context
+    so queued work is dropped.
+    """
+    @functools.wraps(fn)
+    async def runner(**kwargs):
+        caller = "mcp"
         try:
-            raw_coords = [float(x) for x in bbox]
-            
-            # Heuristic: If largest value <= 1.5, treat as normalized (0.0-1.0)
-            if max(raw_coords) <= 1.5:
-                raw_coords[0] *= sent_w
-                raw_coords[1] *= sent_h
-                raw_coords[2] *= sent_w
-                raw_coords[3] *= sent_h
+            session = mcp.get_context().request_context.session
+            caller = f"session-{id(session)}"
+        except (LookupError, ValueError):
+            pass
+        request = RequestContext(caller=caller)
+        token = _REQUEST_CTX.set(request)
+        try:
+            return await anyio.to_thread.run_sync(functools.partial(fn, **kwargs), abandon_on_cancel=True)
+        except anyio.get_cancelled_exc_class():
+            request.cancel()
+            raise
+        finally:
+            _REQUEST_CTX.reset(token)
 
-            # Map Sent-Coords -> Crop-Coords -> Original-Coords
-            x1 = crop_x1 + (raw_coords[0] * sx)
-            y1 = crop_y1 + (raw_coords[1] * sy)
-            x2 = crop_x1 + (raw_coords[2] * sx)
-            y2 = crop_y1 + (raw_coords[3] * sy)
+    mcp.add_tool(runner, name=fn.__name__, description=fn.__doc__)
+    return fn
 
-            # Sort coordinates
-            final_x1, final_x2 = sorted((x1, x2))
-            final_y1, final_y2 = sorted((y1, y2))
+# --- HTTP CONNECTION POOL ---
+_PROVIDER_BASES = {
+    "openai": "https://api.openai.com/v1",
+    "anthropic": "https://api.anthropic.com",
+}
 
-            # Round and Clamp
-            return [
-                int(round(max(0, min(final_x1, max_x_safe)))),
-                int(round(max(0, min(final_y1, max_y_safe)))),
-                int(round(max(0, min(final_x2, max_x_safe)))),
-                int(round(max(0, min(final_y2, max_y_safe))))
-            ]
-        except (ValueError, TypeError):
-            return bbox 
+def _provider_of(model: str) -> str:
+    """Best-effort provider name from a litellm model string."""
+    if "/" in model:
+        return model.split("/", 1)[0]
+    if model.startswith("claude"):
+        return "anthropic"
+    return "openai"
 
-    if "elements" in result:
-        for el in result["elements"]:
-            if "bbox" in el: el["bbox"] = sanitize_and_map(el["bbox"])
-            
-    if "text_blocks" in result:
-        for blk in result["text_blocks"]:
-            if "bbox" in blk: blk["bbox"] = sanitize_and_map(blk["bbox"])
+class HTTPPool:
+    """
+    One keep-alive httpx client shared by every provider call, installed as
+    litellm's client session, plus a per-provider cap on in-flight requests so
+    one slow provider cannot monopolize the pool.
+    """
+    def __init__(self, max_connections: int, per_provider: int, keepalive: float, timeout: float, http2: bool):
+        self.max_connections = max_connections
+        self.per_provider = per_provider
+        self.keepalive = keepalive
+        self.timeout = timeout
+        # HTTP/2 needs the optional 'h2' package; fall back to pooled HTTP/1.1
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        self.client: Optional[httpx.Client] = None
+        self.semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self.lock = threading.Lock()
 
-def _repair_json(raw_input: Union[str, Dict, List, None], model: str) -> Dict:
-    """Robust JSON extraction/repair with internal content normalization."""
-    
-    # 1. Handle pre-parsed Dict
-    if isinstance(raw_input, dict):
-        return raw_input
-    
-    # 2. Normalize input to String (handles List/None)
-    raw_text = _normalize_content(raw_input)
+    def get_client(self) -> httpx.Client:
+        with self.lock:
+            if self.client is None:
+                self.client = httpx.Client(
+                    http2=self.http2,
+                    timeout=self.timeout,
+                    follow_redirects=True,
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_connections,
+                        keepalive_expiry=self.keepalive,
+                    ),
+                )
+                _litellm().client_session = self.client
+            return self.client
 
-    # 3. Slice method
-    try:
-        start = raw_text.find('{')
-        end = raw_text.rfind('}')
-        if start != -1 and end != -1:
-            return json.loads(raw_text[start:end+1])
-    except:
-        pass
+    @contextmanager
+    def slot(self, model: str):
+        """Holds one of the provider's in-flight slots for the duration of a call."""
+        self.get_client()
+        provider = _provider_of(model)
+        with self.lock:
+            sem = self.semaphores.get(provider)
+            if sem is None:
+                sem = self.semaphores[provider] = threading.BoundedSemaphore(self.per_provider)
+        with sem:
+            yield
 
-    # 4. LLM Repair (Truncated)
-    try:
-        truncated_text = raw_text[:8000]
-        response = completion(
-            model=model,
-            temperature=0,
-            top_p=1,
-            messages=[{
-                "role": "system", 
-                "content": "You are a JSON fixer. Return ONLY valid JSON. No markdown."
-            }, {
-                "role": "user", 
-                "content": truncated_text
-            }]
-        )
-        
-        # Normalize response content (handle lists/None from repair model)
-        repaired_content = _normalize_content(response.choices[0].message.content)
-        
-        cleaned = re.sub(r"```json|```", "", repaired_content).strip()
-        start = cleaned.find('{')
-        end = cleaned.rfind('}')
-        if start != -1 and end != -1:
-            return json.loads(cleaned[start:end+1])
-        return json.loads(cleaned)
-    except Exception:
-        return {"error": "JSON Parse Failed", "raw_output": raw_text[:500] + "..."}
+    def warm(self, urls: List[str]):
+        """Opens a pooled connection to each URL so the first call skips TCP/TLS setup."""
+        client = self.get_client()
+        for url in urls:
+            try:
+                client.head(url, timeout=min(self.timeout, 10.0))
+            except httpx.HTTPError:
+                pass
 
-# --- TOOL ---
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                litellm = sys.modules.get("litellm")
+                if litellm is not None and litellm.client_session is self.client:
+                    litellm.client_session = None
+                self.client.close()
+                self.client = None
 
-@mcp.tool()
-def examine_image(
-    path: str, 
-    mode: str = "general", 
-    question: Optional[str] = None, 
-    region: Optional[List[int]] = None
-) -> Dict[str, Any]:
+_HTTP_POOL = HTTPPool(HTTP_POOL_SIZE, HTTP_PER_PROVIDER_LIMIT, HTTP_KEEPALIVE_SECONDS, HTTP_TIMEOUT_SECONDS, HTTP2_ENABLED)
+
+def _warm_targets() -> List[str]:
+    if HTTP_WARM_URLS:
+        return HTTP_WARM_URLS
+    if API_BASE:
+        return [API_BASE]
+    base = _PROVIDER_BASES.get(_provider_of(MODEL_NAME))
+    return [base] if base else []
+
+# --- RATE LIMITING, RETRIES & CIRCUIT BREAKER ---
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the provider while its circuit breaker is open."""
+
+class AdaptiveRateLimiter:
     """
-    Analyzes an image.
-    
-    Args:
-        path: Absolute local path.
-        mode: 'ui' (elements), 'ocr' (text), 'general' (describe), 'query' (QA).
-        question: Required if mode='query'.
-        region: [x1, y1, x2, y2] pixel crop.
+    Client-side token buckets for requests/min and tokens/min with AIMD control:
+    the allowed rate grows additively on success (up to the ceiling learned
+    from x-ratelimit-limit-* headers or configured) and halves on throttling.
+    A rate of None means unlimited until the provider first pushes back.
     """
-    try:
-        # 1. Strict Validation
-        if mode not in ALLOWED_MODES:
-            return {"error": f"Invalid mode '{mode}'. Allowed: {sorted(list(ALLOWED_MODES))}", "path": path}
+    WINDOW = 60.0
+    BURST_SECONDS = 10.0
+    INCREASE_FRACTION = 0.05
+    MIN_RPM = 1.0
+    BOOTSTRAP_RPM = 60.0
+    DECREASE_HOLDOFF = 1.0
 
-        if mode == "query" and not question:
-            return {"error": "Parameter 'question' is required when mode='query'", "path": path}
+    def __init__(self, rpm: float = 0, tpm: float = 0):
+        self.ceiling_rpm = rpm or None
+        self.ceiling_tpm = tpm or None
+        self.rpm = self.ceiling_rpm
+        self.tpm = self.ceiling_tpm
+        self.req_level = self._capacity(self.rpm, 1)
+        self.tok_level = self._capacity(self.tpm, 1)
+        self.updated = self._now()
+        self.recent: List[float] = []
+        self.last_decrease = float("-inf")
+        self.lock = threading.Lock()
 
-        safe_path = _validate_path(path)
-        region_norm = [int(c) for c in region] if region else None
+    def _now(self) -> float:
+        return time.monotonic()
 
-        # 2. Cache Lookup
-        mtime = os.path.getmtime(safe_path)
-        cache_key_str = f"{safe_path}|{mtime}|{mode}|{question}|{json.dumps(region_norm)}|{PROMPT_VERSION}"
-        cache_key = hashlib.md5(cache_key_str.encode()).hexdigest()
-        
-        cached = _CACHE.get(cache_key)
-        if cached: return cached
+    def _state(self):
+        """Guards the bucket state; SharedRateLimiter loads and stores it here."""
+        return self.lock
 
-        # 3. Processing
-        b64_img, mime, orig_size, crop_bbox, sent_size = _process_image(safe_path, region_norm, mode)
+    def _capacity(self, rate: Optional[float], minimum: float) -> float:
+        return max(minimum, rate * self.BURST_SECONDS / self.WINDOW) if rate else float("inf")
 
-        # 4. Prompting
-        schemas = {
-            "ui": "JSON: { \"elements\": [ { \"type\": \"button|input\", \"label\": string, \"bbox\": [x1,y1,x2,y2] } ], \"uncertainties\": [string] }",
-            "ocr": "JSON: { \"text_blocks\": [ { \"text\": string, \"bbox\": [x1,y1,x2,y2] } ], \"uncertainties\": [string] }",
-            "query": f"Question: {question}. JSON: {{ \"answer\": string, \"evidence\": [string], \"uncertainties\": [string] }}",
-            "general": "JSON: { \"description\": string, \"main_objects\": [string], \"uncertainties\": [string] }"
-        }
-        
-        system_prompt = (
-            "You are a machine vision engine. Output strict JSON only. "
-            f"Mode: {mode.upper()}. {schemas.get(mode, schemas['general'])} "
-            f"Image is {sent_size[0]}x{sent_size[1]}. Coordinates must be relative to this size."
-        )
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.req_level = min(self._capacity(self.rpm, 1), self.req_level + elapsed * self.rpm / self.WINDOW)
+        if self.tpm:
+            self.tok_level = min(self._capacity(self.tpm, 1), self.tok_level + elapsed * self.tpm / self.WINDOW)
 
-        user_content_text = "Analyze."
-        if mode == "query" and question:
-            user_content_text = f"Answer this question strictly based on the image: {question}"
+    def acquire(self, tokens: int = 0):
+        """Blocks until one request and `tokens` tokens fit in the buckets."""
+        while True:
+            with self._state():
+                now = self._now()
+                self._refill(now)
+                # A single oversized request may take the whole bucket
+                need_tok = min(tokens, self._capacity(self.tpm, 1)) if self.tpm else 0
+                if self.req_level >= 1 and self.tok_level >= need_tok:
+                    self.req_level -= 1
+                    if self.tpm:
+                        self.tok_level -= need_tok
+                    self.recent = [t for t in self.recent if now - t < self.WINDOW] + [now]
+                    return
+                wait = 0.0
+                if self.req_level < 1:
+                    wait = (1 - self.req_level) * self.WINDOW / self.rpm
+                if self.tpm and self.tok_level < need_tok:
+                    wait = max(wait, (need_tok - self.tok_level) * self.WINDOW / self.tpm)
+            time.sleep(min(max(wait, 0.005), 5.0))
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": [
-                {"type": "text", "text": user_content_text},
-                {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64_img}"}}
-            ]}
-        ]
+    def on_success(self, headers: Dict[str, str], used_tokens: int = 0, estimated_tokens: int = 0):
+        with self._state():
+            self._learn_ceiling(headers)
+            # Settle the token estimate against real usage
+            if self.tpm and used_tokens:
+                self.tok_level -= used_tokens - estimated_tokens
+            remaining = _header_number(headers, "x-ratelimit-remaining-requests")
+            if remaining is not None and remaining <= 0:
+                self._decrease()
+                return
+            if self.rpm and self.ceiling_rpm:
+                self.rpm = min(self.ceiling_rpm, self.rpm + self.ceiling_rpm * self.INCREASE_FRACTION)
+            if self.tpm and self.ceiling_tpm:
+                self.tpm = min(self.ceiling_tpm, self.tpm + self.ceiling_tpm * self.INCREASE_FRACTION)
 
-        # 5. Inference
-        try:
-            response = completion(
-                model=MODEL_NAME,
-                messages=messages,
-                temperature=0, 
-                top_p=1,
-                response_format={"type": "json_object"}
-            )
-        except litellm.exceptions.UnsupportedParamsError:
-            response = completion(model=MODEL_NAME, messages=messages, temperature=0, top_p=1)
-        except Exception as e:
-            # Broad fallback for any provider rejection of structured outputs
-            msg = str(e).lower()
-            if any(k in msg for k in ("response_format", "unsupported", "bad request", "invalid_request")):
-                response = completion(model=MODEL_NAME, messages=messages, temperature=0, top_p=1)
-            else:
-                raise e
-        
-        # 6. Repair & Normalize
-        # Pass raw content (string/list/none) directly to repair, which now handles normalization
-        result_json = _repair_json(response.choices[0].message.content, REPAIR_MODEL)
-
-        _adjust_coordinates(result_json, crop_bbox, sent_size, orig_size)
-
-        envelope = {
-            "mode": mode,
-            "metadata": {
-                "original_path": path,
-                "original_size": {"width": orig_size[0], "height": orig_size[1]},
-                "crop_bbox": list(crop_bbox) if region else None,
-                "sent_size": {"width": sent_size[0], "height": sent_size[1]},
-                "prompt_version": PROMPT_VERSION
-            },
-            "content": result_json
-        }
-        
-        _CACHE.set(cache_key, envelope)
-        return envelope
+    def on_throttle(self, headers: Dict[str, str]):
+        with self._state():
+            self._learn_ceiling(headers)
+            self._decrease()
 
-    except Exception as e:
-        return {"error": str(e), "path": path}
+    def _learn_ceiling(self, headers: Dict[str, str]):
+        limit_rpm = _header_number(headers, "x-ratelimit-limit-requests")
+        limit_tpm = _header_number(headers, "x-ratelimit-limit-tokens")
+        if limit_rpm:
+            self.ceiling_rpm = min(self.ceiling_rpm or limit_rpm, limit_rpm)
+        if limit_tpm:
+            self.ceiling_tpm = min(self.ceiling_tpm or limit_tpm, limit_tpm)
+
+    def _decrease(self):
+        now = self._now()
+        # Throttles arriving together are one congestion event, not several
+        if now - self.last_decrease < self.DECREASE_HOLDOFF:
+            return
+        self.last_decrease = now
+        if not self.rpm:
+            # First push-back while unlimited: start from the advertised limit,
+            # else from observed throughput
+            observed = len([t for t in self.recent if now - t < self.WINDOW])
+            self.rpm = float(self.ceiling_rpm or max(observed, self.BOOTSTRAP_RPM))
+            self.ceiling_rpm = self.ceiling_rpm or self.rpm
+            self.updated = now
+        self.rpm = max(self.MIN_RPM, self.rpm / 2)
+        self.req_level = min(self.req_level, self._capacity(self.rpm, 1))
+        if self.tpm:
+            self.tpm = max(1000.0, self.tpm / 2)
+            self.tok_level = min(self.tok_level, self._capacity(self.tpm, 1))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._state():
+            return {"rpm": self.rpm, "tpm": self.tpm, "ceiling_rpm": self.ceiling_rpm, "ceiling_tpm": self.ceiling_tpm}
+
+class SharedRateLimiter(AdaptiveRateLimiter):
+    """
+    AdaptiveRateLimiter whose buckets and learned rates live in a SharedStore,
+    so every worker process draws from one per-provider budget. State is loaded
+    and written back inside one store transaction per operation; timestamps
+    are wall-clock since monotonic clocks differ between processes.
+    """
+    FIELDS = ("rpm", "tpm", "ceiling_rpm", "ceiling_tpm", "req_level", "tok_level",
+              "updated", "recent", "last_decrease")
+
+    def __init__(self, store: SharedStore, key: str, rpm: float = 0, tpm: float = 0):
+        self.store = store
+        self.key = key
+        super().__init__(rpm, tpm)
+
+    def _now(self) -> float:
+        return time.time()
+
+    @contextmanager
+    def _state(self):
+        with self.lock, self.store.transaction() as conn:
+            row = conn.execute("SELECT state FROM limiter WHERE key = ?", (self.key,)).fetchone()
+            if row is not None:
+                for name, value in json.loads(row[0]).items():
+                    setattr(self, name, value)
+            yield
+            state = json.dumps({name: getattr(self, name) for name in self.FIELDS})
+            conn.execute("INSERT OR REPLACE INTO limiter (key, state) VALUES (?, ?)", (self.key, state))
+
+class CircuitBreaker:
+    """
+    Classic closed -> open -> half-open breaker. After `threshold` consecutive
+    retryable failures calls fail fast for `reset_seconds`; then a single trial
+    call is let through and its outcome closes or re-opens the circuit.
+    """
+    def __init__(self, threshold: int, reset_seconds: float):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                return "half-open"
+            return "open"
+
+    def before_call(self) -> bool:
+        """Raises CircuitOpenError when open; True when the caller holds the half-open trial."""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.reset_seconds - (time.monotonic() - self.opened_at)
+            if remaining > 0 or self.trial_in_flight:
+                raise CircuitOpenError(f"Provider circuit open; retry in {max(remaining, 0):.1f}s")
+            self.trial_in_flight = True
+            return True
+
+    def release_trial(self):
+        """Gives the half-open trial back unused (the call never reached the provider)."""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+_RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+def _header_number(headers: Dict[str, str], name: str) -> Optional[float]:
+    try:
+        value = headers.get(name)
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _response_headers(obj: Any) -> Dict[str, str]:
+    """Lower-cased provider headers from a litellm response or exception."""
+    headers = {}
+    hidden = getattr(obj, "_hidden_params", None) or {}
+    sources = [
+        hidden.get("additional_headers"),
+        getattr(obj, "_response_headers", None),
+        getattr(obj, "litellm_response_headers", None),
+        getattr(getattr(obj, "response", None), "headers", None),
+    ]
+    for source in sources:
+        if not source:
+            continue
+        for key, value in dict(source).items():
+            key = str(key).lower()
+            if key.startswith("llm_provider-"):
+                key = key[len("llm_provider-"):]
+            headers.setdefault(key, value)
+    return headers
+
+def _retry_after(headers: Dict[str, str]) -> Optional[float]:
+    """Seconds to wait from Retry-After / retry-after-ms, if the provider sent one."""
+    ms = _header_number(headers, "retry-after-ms")
+    if ms is not None:
+        return ms / 1000.0
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, httpx.TransportError) or _is_litellm_error(
+            exc, "RateLimitError", "ServiceUnavailableError", "APIConnectionError", "Timeout", "InternalServerError"):
+        return True
+    return getattr(exc, "status_code", None) in _RETRYABLE_STATUS
+
+def _is_throttle(exc: Exception) -> bool:
+    return _is_litellm_error(exc, "RateLimitError") or getattr(exc, "status_code", None) == 429
+
+def _estimate_tokens(messages: List[Dict]) -> int:
+    """Rough prompt size for the tokens/min bucket; settled against real usage later."""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                total += 1100
+            else:
+                total += len(str(part.get("text", ""))) // 4
+    return total
+
+class ProviderGuard:
+    """Limiter + breaker pair per provider endpoint, created on first use."""
+    def __init__(self):
+        self.guards: Dict[str, Tuple[AdaptiveRateLimiter, CircuitBreaker]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, model: str, api_base: Optional[str] = None) -> Tuple[AdaptiveRateLimiter, CircuitBreaker]:
+        provider = f"{_provider_of(model)}|{api_base or ''}"
+        with self.lock:
+            if provider not in self.guards:
+                limiter = (SharedRateLimiter(_SHARED_STORE, provider, RATE_LIMIT_RPM, RATE_LIMIT_TPM)
+                           if _SHARED_STORE else AdaptiveRateLimiter(RATE_LIMIT_RPM, RATE_LIMIT_TPM))
+                self.guards[provider] = (
+                    limiter,
+                    CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS),
+                )
+            return self.guards[provider]
+
+_PROVIDER_GUARD = ProviderGuard()
+
+# --- PROVIDER CALLS ---
+def _completion(model: str, messages: List[Dict], **kwargs):
+    """
+    Single entry point for provider calls: priority scheduling, pooled client,
+    endpoint override, client-side rate limiting, bounded retries with full
+    jitter (honouring Retry-After) and a per-provider circuit breaker.
+    """
+    if API_BASE:
+        kwargs.setdefault("api_base", API_BASE)
+    # Retries are owned here; stop the provider SDK from retrying underneath
+    kwargs.setdefault("max_retries", 0)
+    limiter, breaker = _PROVIDER_GUARD.get(model, kwargs.get("api_base"))
+    estimated = _estimate_tokens(messages)
+
+    attempt = 0
+    request = _REQUEST_CTX.get() or RequestContext()
+    while True:
+        trial = False
+        try:
+            with _SCHEDULER.slot(request):
+                trial = breaker.before_call()
+                limiter.acquire(estimated)
+                request.check()
+                with _HTTP_POOL.slot(model):
+                    if _TRAFFIC is not None:
+                        response = _TRAFFIC.call(completion, model=model, messages=messages, **kwargs)
+                    else:
+                        response = completion(model=model, messages=messages, **kwargs)
+        except (CircuitOpenError, DeadlineExceeded, RequestCancelled):
+            if trial:
+                # Expired or cancelled before sending: the next caller gets the trial
+                breaker.release_trial()
+            raise
+        except Exception as e:
+            if not _is_retryable(e):
+                # Client errors say nothing about provider health
+                breaker.record_success()
+                raise
+            headers = _response_headers(e)
+            if _is_throttle(e):
+                limiter.on_throttle(headers)
+            breaker.record_failure()
+            attempt += 1
+            if attempt >= RETRY_MAX_ATTEMPTS:
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** (attempt - 1))))
+            server_delay = _retry_after(headers)
+            if server_delay is not None:
+                delay = max(delay, min(server_delay, RETRY_MAX_DELAY))
+            time.sleep(delay)
+            continue
+
+        breaker.record_success()
+        usage = getattr(response, "usage", None)
+        _record_usage(usage)
+        limiter.on_success(_response_headers(response), getattr(usage, "total_tokens", 0) or 0, estimated)
+        return response
+
+# --- RECORD / REPLAY ---
+_DATA_URL = re.compile(r"^data:([\w/+.-]+);base64,")
+# Transport settings that do not change what the model is asked
+_UNFINGERPRINTED = {"api_base", "max_retries", "timeout", "client"}
+
+def _redact_payloads(value: Any) -> Any:
+    """Request with each base64 data: URL replaced by a hash of its payload."""
+    if isinstance(value, str):
+        match = _DATA_URL.match(value)
+        if match:
+            digest = hashlib.sha256(value[match.end():].encode("ascii", "replace")).hexdigest()
+            return f"data:{match.group(1)};sha256,{digest}"
+        return value
+    if isinstance(value, dict):
+        return {k: _redact_payloads(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_redact_payloads(v) for v in value]
+    return value
+
+def _plain(obj: Any) -> Any:
+    """JSON-ready copy of a litellm response (or any attribute tree)."""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    if isinstance(obj, dict):
+        return {str(k): _plain(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_plain(v) for v in obj]
+    if hasattr(obj, "__dict__"):
+        return {k: _plain(v) for k, v in vars(obj).items() if not k.startswith("_")}
+    return obj if isinstance(obj, (str, int, float, bool, type(None))) else str(obj)
+
+def _namespace(value: Any) -> Any:
+    if isinstance(value, dict):
+        return SimpleNamespace(**{k: _namespace(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_namespace(v) for v in value]
+    return value
+
+def _fingerprint(kwargs: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    request = _redact_payloads({k: v for k, v in kwargs.items() if k not in _UNFINGERPRINTED})
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest(), request
+
+class ReplayedError(RuntimeError):
+    """A provider error served from a recording; keeps its status and headers for retry handling."""
+    def __init__(self, message: str, status_code: Optional[int], headers: Dict[str, str]):
+        super().__init__(message)
+        self.status_code = status_code
+        self._response_headers = headers
+
+class ReplayMiss(LookupError):
+    pass
+
+class TrafficRecorder:
+    """Calls the provider and appends request, raw response (or error) and latency to a JSONL file."""
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def call(self, fn, **kwargs):
+        fingerprint, request = _fingerprint(kwargs)
+        entry: Dict[str, Any] = {"fingerprint": fingerprint, "time": time.time(), "request": request}
+        start = time.perf_counter()
+        try:
+            response = fn(**kwargs)
+            entry["response"] = _plain(response)
+            entry["headers"] = _response_headers(response)
+            return response
+        except Exception as e:
+            entry["error"] = {"type": type(e).__name__, "message": str(e),
+                              "status_code": getattr(e, "status_code", None)}
+            entry["headers"] = _response_headers(e)
+            raise
+        finally:
+            entry["latency"] = round(time.perf_counter() - start, 4)
+            line = json.dumps(entry, default=str) + "\n"
+            with self.lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+            _METRICS.incr("traffic.recorded")
+
+class TrafficReplayer:
+    """
+    Serves a recording instead of calling the provider. Identical requests get
+    their recorded answers in order, the last one repeating once they run out;
+    a request that was never recorded raises ReplayMiss.
+    """
+    def __init__(self, path: str, speed: float = 1.0):
+        self.speed = speed
+        self.entries: Dict[str, List[Dict[str, Any]]] = {}
+        self.served: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries.setdefault(entry["fingerprint"], []).append(entry)
+
+    def call(self, fn, **kwargs):
+        fingerprint, _ = _fingerprint(kwargs)
+        with self.lock:
+            entries = self.entries.get(fingerprint)
+            if not entries:
+                _METRICS.incr("traffic.replay_misses")
+                raise ReplayMiss(f"No recorded response for request {fingerprint[:16]} (model {kwargs.get('model')})")
+            index = self.served.get(fingerprint, 0)
+            self.served[fingerprint] = index + 1
+        entry = entries[min(index, len(entries) - 1)]
+        if self.speed > 0:
+            time.sleep(entry.get("latency", 0) / self.speed)
+        _METRICS.incr("traffic.replayed")
+        headers = entry.get("headers") or {}
+        if "error" in entry:
+            error = entry["error"]
+            raise ReplayedError(f"{error['type']}: {error['message']}", error.get("status_code"), headers)
+        response = _namespace(entry["response"])
+        response._hidden_params = {"additional_headers": headers}
+        return response
+
+def _traffic_from_env():
+    if RECORD_PATH and REPLAY_PATH:
+        raise ValueError("Set VISION_RECORD or VISION_REPLAY, not both")
+    if RECORD_PATH:
+        return TrafficRecorder(RECORD_PATH)
+    if REPLAY_PATH:
+        return TrafficReplayer(REPLAY_PATH, REPLAY_SPEED)
+    return None
+
+_TRAFFIC = _traffic_from_env()
+
+# --- REQUEST HEDGING ---
+class LatencyHistogram:
+    """
+    Rolling histogram of call latencies over log-spaced buckets (10% wide,
+    10 ms to ~10 min). Two generations rotate every `window` seconds, so
+    percentiles reflect the last one to two windows. Percentiles report the
+    upper edge of their bucket.
+    """
+    MIN_SECONDS = 0.01
+    GROWTH = 1.1
+    BUCKETS = 116
+
+    def __init__(self, window: float = 300.0):
+        self.window = window
+        self.current = [0] * self.BUCKETS
+        self.previous = [0] * self.BUCKETS
+        self.rotated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self.rotated >= self.window:
+            # A gap of two windows or more leaves nothing worth keeping
+            self.previous = self.current if now - self.rotated < 2 * self.window else [0] * self.BUCKETS
+            self.current = [0] * self.BUCKETS
+            self.rotated = now
+
+    def observe(self, seconds: float):
+        index = 0
+        if seconds > self.MIN_SECONDS:
+            index = min(self.BUCKETS - 1, int(math.ceil(math.log(seconds / self.MIN_SECONDS, self.GROWTH))))
+        with self.lock:
+            self._rotate()
+            self.current[index] += 1
+
+    def count(self) -> int:
+        with self.lock:
+            self._rotate()
+            return sum(self.current) + sum(self.previous)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self.lock:
+            self._rotate()
+            counts = [a + b for a, b in zip(self.current, self.previous)]
+        total = sum(counts)
+        if not total:
+            return None
+        rank, seen = total * pct / 100.0, 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self.MIN_SECONDS * self.GROWTH ** index
+        return self.MIN_SECONDS * self.GROWTH ** (self.BUCKETS - 1)
+
+class HedgeBudget:
+    """Credit earned per primary call (`ratio`), spent one per hedge, capped at `burst`."""
+    def __init__(self, ratio: float, burst: float = 5.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.credit = min(1.0, burst)
+        self.lock = threading.Lock()
+
+    def earn(self):
+        with self.lock:
+            self.credit = min(self.burst, self.credit + self.ratio)
+
+    def spend(self) -> bool:
+        with self.lock:
+            if self.credit < 1.0:
+                return False
+            self.credit -= 1.0
+            return True
+
+_LATENCY = LatencyHistogram()
+_HEDGE_BUDGET = HedgeBudget(HEDGE_BUDGET)
+
+def _hedge_delay() -> float:
+    """Seconds to wait on the primary before hedging, from recent latency."""
+    if _LATENCY.count() < HEDGE_MIN_SAMPLES:
+        return max(HEDGE_MIN_DELAY, HEDGE_INITIAL_DELAY)
+    return max(HEDGE_MIN_DELAY, _LATENCY.percentile(HEDGE_PERCENTILE))
+
+def _start_leg(parent: RequestContext, model: str, messages: List[Dict], kwargs: Dict[str, Any],
+               record: bool = False):
+    """
+    Runs one _completion in a daemon thread under its own request context, so
+    the losing leg can be cancelled without touching the caller's. Returns
+    (future, context). With `record`, a successful call's latency is observed.
+    """
+    leg = RequestContext(parent.priority, parent.deadline, parent.caller)
+    future: Future = Future()
+
+    def run():
+        _REQUEST_CTX.set(leg)
+        started = time.monotonic()
+        try:
+            response = _completion(model, messages, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            return
+        if record:
+            _LATENCY.observe(time.monotonic() - started)
+        future.set_result(response)
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(run,), daemon=True, name="vision-hedge").start()
+    return future, leg
+
+def _hedged_completion(messages: List[Dict], **kwargs):
+    """
+    _completion for MODEL_NAME, with tail-latency hedging when configured: if
+    no answer arrives within _hedge_delay() and the budget allows, the same
+    request goes to HEDGE_MODEL / HEDGE_API_BASE and the first success wins.
+    The loser is cancelled: dropped if still queued or between retries, and
+    abandoned with its result discarded if already in flight. The primary's
+    latency always feeds the threshold, including when it loses.
+    """
+    if not (HEDGE_MODEL or HEDGE_API_BASE):
+        started = time.monotonic()
+        response = _completion(MODEL_NAME, messages, **kwargs)
+        _LATENCY.observe(time.monotonic() - started)
+        return response
+
+    parent = _REQUEST_CTX.get() or RequestContext()
+    _METRICS.incr("hedge.requests")
+    _HEDGE_BUDGET.earn()
+    hedge_at = time.monotonic() + _hedge_delay()
+    primary, context = _start_leg(parent, MODEL_NAME, messages, kwargs, record=True)
+    legs = {primary: ("primary", context)}
+    hedged = False
+    failure: Optional[BaseException] = None
+    try:
+        while legs:
+            timeout = 0.5 if hedged else min(0.5, max(0.0, hedge_at - time.monotonic()))
+            done, _ = wait(list(legs), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, _ = legs.pop(future)
+                if future.exception() is None:
+                    if name == "hedge":
+                        _METRICS.incr("hedge.wins")
+                    return future.result()
+                failure = failure or future.exception()
+            if parent.cancelled.is_set():
+                raise RequestCancelled("Request cancelled by client")
+            if legs and not hedged and time.monotonic() >= hedge_at:
+                hedged = True
+                if _HEDGE_BUDGET.spend():
+                    _METRICS.incr("hedge.fired")
+                    # Without its own base the hedge leg keeps API_BASE (_completion fills it in)
+                    hedge_kwargs = dict(kwargs, api_base=HEDGE_API_BASE) if HEDGE_API_BASE else dict(kwargs)
+                    future, context = _start_leg(parent, HEDGE_MODEL or MODEL_NAME, messages, hedge_kwargs)
+                    legs[future] = ("hedge", context)
+                else:
+                    _METRICS.incr("hedge.budget_denied")
+        raise failure
+    finally:
+        for _, context in legs.values():
+            context.cancel()
+
+# --- PERCEPTUAL HASH INDEX ---
+class BKTree:
+    """
+    Burkhard-Keller tree over integer hashes with Hamming distance.
+    Each node is [hash, children_by_distance, payloads]; radius queries only
+    descend into children whose edge distance can still fall within range.
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value: int, payload: Any):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, {}, [payload]]
+            return
+        node = self.root
+        while True:
+            dist = (node[0] ^ value).bit_count()
+            if dist == 0:
+                node[2].append(payload)
+                return
+            child = node[1].get(dist)
+            if child is None:
+                node[1][dist] = [value, {}, [payload]]
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, Any]]:
+        """Returns (distance, payload) pairs within max_distance, nearest first."""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            dist = (node[0] ^ value).bit_count()
+            if dist <= max_distance:
+                found.extend((dist, p) for p in node[2])
+            lo, hi = dist - max_distance, dist + max_distance
+            stack.extend(child for d, child in node[1].items() if lo <= d <= hi)
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def __iter__(self):
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            for payload in node[2]:
+                yield node[0], payload
+            stack.extend(node[1].values())
+
+class NearDuplicateIndex:
+    """
+    Thread-safe dHash index of analyzed images, one BK-tree per request context
+    (mode, question, region, prompt version). Entries point at _CACHE keys.
+    At most `max_entries` are kept (the cache cannot hold more live results):
+    the oldest are retired as new ones arrive, expired ones when a lookup
+    meets them, and a tree is rebuilt once its dead entries reach half its size.
+    """
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.trees: Dict[str, BKTree] = {}
+        self.dead: Dict[str, set] = {}
+        self.order: deque = deque()  # (context, cache_key), oldest first
+        self.lock = threading.Lock()
+
+    def add(self, context: str, phash: int, cache_key: str, orig_size: Tuple[int, int]):
+        with self.lock:
+            self.trees.setdefault(context, BKTree()).add(phash, (cache_key, tuple(orig_size)))
+            self.order.append((context, cache_key))
+            while len(self.order) > self.max_entries:
+                old_context, old_key = self.order.popleft()
+                self._retire(old_context, {old_key})
+
+    def lookup(self, context: str, phash: int, orig_size: Tuple[int, int], max_distance: int) -> Optional[Tuple[int, Dict]]:
+        """Returns (distance, cached_envelope) of the nearest live match, or None."""
+        with self.lock:
+            tree = self.trees.get(context)
+            if tree is None:
+                return None
+            candidates = tree.search(phash, max_distance)
+            dead = set(self.dead.get(context, ()))
+
+        stale = set()
+        match = None
+        for dist, (cache_key, size) in candidates:
+            # Coordinates are only transferable between same-sized images
+            if size != tuple(orig_size) or cache_key in dead:
+                continue
+            # peek: probing candidates must not count as cache misses
+            cached = _CACHE.peek(cache_key)
+            if cached is None:
+                stale.add(cache_key)
+                continue
+            match = (dist, cached)
+            break
+
+        if stale:
+            with self.lock:
+                self._retire(context, stale)
+        return match
+
+    def _retire(self, context: str, cache_keys: set):
+        """Marks entries dead and rebuilds the tree without them once half of it is dead. Lock held."""
+        tree = self.trees.get(context)
+        if tree is None:
+            return
+        dead = self.dead.setdefault(context, set())
+        dead |= cache_keys
+        if len(dead) * 2 < tree.size:
+            return
+        rebuilt = BKTree()
+        for value, payload in tree:
+            if payload[0] not in dead:
+                rebuilt.add(value, payload)
+        del self.dead[context]
+        if rebuilt.size:
+            self.trees[context] = rebuilt
+        else:
+            del self.trees[context]
+
+_PHASH_INDEX = NearDuplicateIndex(CACHE_MAX_SIZE)
+
+# --- FILE ACCESS ---
+_OPEN_FLAGS = os.O_RDONLY | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_NONBLOCK", 0) | getattr(os, "O_BINARY", 0)
+_PROC_FD = os.path.isdir("/proc/self/fd")
+_BASE_REAL: Dict[str, str] = {}
+
+class OpenFile:
+    """
+    A file opened once for a whole request. Size and mtime come from a single
+    fstat of the descriptor, and hashing, decoding and pyramid builds all read
+    through it, so they see the bytes that were validated even if the path is
+    replaced meanwhile. Readers take turns: reader() rewinds the one file object.
+    """
+    def __init__(self, fd: int, path: str):
+        self.path = path
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                raise ValueError(f"Not a regular file: {path}")
+            self.file = os.fdopen(fd, "rb")
+        except BaseException:
+            os.close(fd)
+            raise
+        self.fd = fd
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+
+    @classmethod
+    def open(cls, path: str) -> "OpenFile":
+        return cls(os.open(path, _OPEN_FLAGS), os.path.abspath(path))
+
+    def reader(self):
+        self.file.seek(0)
+        return self.file
+
+    def pread(self, size: int, offset: int) -> bytes:
+        return os.pread(self.fd, size, offset)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self) -> "OpenFile":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _base_dir() -> str:
+    """BASE_DIR with symlinks resolved, once per value."""
+    base = _BASE_REAL.get(BASE_DIR)
+    if base is None:
+        base = _BASE_REAL[BASE_DIR] = os.path.realpath(os.path.abspath(BASE_DIR))
+    return base
+
+def _within_base(real_path: str, base_abs: str) -> bool:
+    try:
+        return os.path.commonpath([base_abs, real_path]) == base_abs
+    except ValueError:
+        return False
+
+def _open_validated(path: str, max_size_mb: Optional[float] = None) -> OpenFile:
+    """
+    Opens path for reading if it resolves to a regular file inside BASE_DIR.
+    The resolved path is checked before anything is opened (opening a FIFO or
+    device node can have side effects), then opened with O_NOFOLLOW. Where
+    /proc/self/fd exists the descriptor's own path is checked again, so a
+    directory swapped for a symlink in between cannot redirect the read.
+    """
+    max_size_mb = MAX_FILE_SIZE_MB if max_size_mb is None else max_size_mb
+    base_abs = _base_dir()
+    real_path = os.path.realpath(os.path.abspath(path))
+    if not _within_base(real_path, base_abs):
+        raise PermissionError("Access denied: Path outside strict base directory.")
+    try:
+        fd = os.open(real_path, _OPEN_FLAGS | getattr(os, "O_NOFOLLOW", 0))
+    except FileNotFoundError:
+        raise FileNotFoundError(f"File not found: {path}")
+    except OSError as e:
+        if e.errno == errno.ELOOP:  # the last component became a symlink after resolving
+            raise PermissionError("Access denied: Path changed while opening.")
+        raise
+    if _PROC_FD:
+        real_path = os.readlink(f"/proc/self/fd/{fd}")
+        if not _within_base(real_path, base_abs):
+            os.close(fd)
+            raise PermissionError("Access denied: Path outside strict base directory.")
+    opened = OpenFile(fd, real_path)
+    if opened.size > max_size_mb * 1024 * 1024:
+        opened.close()
+        raise ValueError(f"File too large (> {max_size_mb}MB)")
+    return opened
+
+# --- RESULT INDEX ---
+class ResultIndex:
+    """
+    Searchable record of every OCR text block and UI element label produced.
+    Rows live in a plain SQLite table mirrored into an FTS5 index by triggers,
+    so queries are ranked by bm25 and stay fast at hundreds of thousands of
+    blocks. Re-analyzing an image replaces its rows for that mode, frame and
+    region; a changed file (new content hash) drops all of its old rows.
+    Falls back to LIKE matching when SQLite was built without FTS5.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blocks (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            frame INTEGER,
+            region TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            type TEXT,
+            text TEXT NOT NULL,
+            bbox TEXT,
+            indexed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS blocks_path ON blocks(path, mode);
+    """
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS blocks_fts USING fts5(
+            text, content='blocks', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+        CREATE TRIGGER IF NOT EXISTS blocks_ai AFTER INSERT ON blocks BEGIN
+            INSERT INTO blocks_fts(rowid, text) VALUES (new.id, new.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS blocks_ad AFTER DELETE ON blocks BEGIN
+            INSERT INTO blocks_fts(blocks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END;
+    """
+
+    def __init__(self, db_path: str = ":memory:"):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            if db_path != ":memory:":
+                self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(self.SCHEMA)
+            try:
+                self.conn.executescript(self.FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False
+
+    @staticmethod
+    def _rows(content: Dict) -> List[Tuple[str, Optional[str], str, Optional[str]]]:
+        """(kind, type, text, bbox) for each searchable item of a result."""
+        rows = []
+        for block in content.get("text_blocks") or []:
+            if isinstance(block, dict) and str(block.get("text") or "").strip():
+                rows.append(("text", None, str(block["text"]), json.dumps(block.get("bbox"))))
+        for element in content.get("elements") or []:
+            if isinstance(element, dict) and str(element.get("label") or "").strip():
+                rows.append(("element", str(element.get("type") or "") or None, str(element["label"]),
+                             json.dumps(element.get("bbox"))))
+        return rows
+
+    def add(self, path: str, content_hash: str, mode: str, region: Optional[List[int]],
+            items: List[Tuple[Optional[int], Dict]]) -> int:
+        """Indexes (frame, content) results for one file; returns blocks written."""
+        scope = json.dumps(region) if region else ""
+        now = time.time()
+        written = 0
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM blocks WHERE path = ? AND content_hash != ?", (path, content_hash))
+            for frame, content in items:
+                self.conn.execute(
+                    "DELETE FROM blocks WHERE path = ? AND mode = ? AND frame IS ? AND region = ?",
+                    (path, mode, frame, scope))
+                rows = self._rows(content)
+                self.conn.executemany(
+                    "INSERT INTO blocks (path, content_hash, mode, frame, region, kind, type, text, bbox, indexed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(path, content_hash, mode, frame, scope, *row, now) for row in rows])
+                written += len(rows)
+        return written
+
+    @staticmethod
+    def _fts_query(query: str) -> str:
+        """Each whitespace-separated term becomes a quoted phrase (trailing * = prefix)."""
+        terms = []
+        for term in query.split():
+            prefix = term.endswith("*")
+            term = term.rstrip("*")
+            if term:
+                terms.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+        return " AND ".join(terms)
+
+    def search(self, query: str, mode: Optional[str] = None, kind: Optional[str] = None,
+               path_prefix: Optional[str] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        filters, params = [], []
+        if self.fts:
+            match = self._fts_query(query)
+            if not match:
+                return []
+            sql = ("SELECT b.path, b.content_hash, b.mode, b.frame, b.region, b.kind, b.type, b.text, b.bbox "
+                   "FROM blocks_fts JOIN blocks b ON b.id = blocks_fts.rowid WHERE blocks_fts MATCH ?")
+            params.append(match)
+            order = " ORDER BY blocks_fts.rank"
+        else:
+            sql = ("SELECT b.path, b.content_hash, b.mode, b.frame, b.region, b.kind, b.type, b.text, b.bbox "
+                   "FROM blocks b WHERE 1")
+            for term in query.split():
+                filters.append("instr(lower(b.text), ?) > 0")
+                params.append(term.rstrip("*").lower())
+            order = " ORDER BY b.id DESC"
+        if mode:
+            filters.append("b.mode = ?")
+            params.append(mode)
+        if kind:
+            filters.append("b.kind = ?")
+            params.append(kind)
+        if path_prefix:
+            filters.append("substr(b.path, 1, ?) = ?")
+            params.extend([len(path_prefix), path_prefix])
+        sql += "".join(f" AND {f}" for f in filters) + order + " LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [{
+            "path": path,
+            "content_hash": content_hash,
+            "mode": row_mode,
+            "frame": frame,
+            "region": json.loads(region) if region else None,
+            "kind": row_kind,
+            "type": row_type,
+            "text": text,
+            "bbox": json.loads(bbox) if bbox else None,
+        } for path, content_hash, row_mode, frame, region, row_kind, row_type, text, bbox in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            blocks, images = self.conn.execute("SELECT COUNT(*), COUNT(DISTINCT path) FROM blocks").fetchone()
+        return {"blocks": blocks, "images": images, "fts": self.fts}
+
+_RESULT_INDEX = ResultIndex(RESULT_INDEX_PATH) if RESULT_INDEX_PATH else None
+
+def _content_hash(source: OpenFile) -> str:
+    """SHA-256 of the file bytes, identifying an image independent of its path."""
+    digest = hashlib.sha256()
+    offset = 0
+    while True:
+        chunk = source.pread(1 << 20, offset)
+        if not chunk:
+            return digest.hexdigest()
+        digest.update(chunk)
+        offset += len(chunk)
+
+def _index_envelope(source: Union[OpenFile, str], envelope: Dict[str, Any], region: Optional[List[int]],
+                    content_hash: Optional[str] = None):
+    """
+    Adds a freshly produced OCR/UI result (single image, frames or keyframes)
+    to the index. Files pass their validated OpenFile, hashed through the same
+    descriptor when no hash is known yet; uploaded images pass their content
+    URI and hash instead.
+    """
+    if _RESULT_INDEX is None or envelope.get("mode") not in ("ocr", "ui"):
+        return
+    safe_path = source.path if isinstance(source, OpenFile) else source
+    if "content" in envelope:
+        items = [(None, envelope["content"])]
+    else:
+        entries = envelope.get("frames") or envelope.get("keyframes") or envelope.get("pages") or []
+        items = [(e.get("frame", e.get("index")), e["content"]) for e in entries if "content" in e]
+    try:
+        written = _RESULT_INDEX.add(safe_path, content_hash or _content_hash(source), envelope["mode"], region, items)
+        _METRICS.incr("index.blocks_written", written)
+    except (OSError, sqlite3.Error):
+        # The index is best-effort; a failed write must not fail the analysis
+        _METRICS.incr("index.errors")
+
+# --- CACHE SNAPSHOTS ---
+CONTENT_KEY_PREFIX = "content:"
+_SNAPSHOT_MAGIC = b"AVSNAP\x00\x01"  # last byte: format version
+_SNAPSHOT_INDEX = struct.Struct("<16sQI")  # md5 digest of the key, record offset, record length
+_SNAPSHOT_FOOTER = struct.Struct("<QQQI8s")  # index offset, entries, meta offset, meta length, magic
+
+class SnapshotWriter:
+    """
+    Writes a snapshot: zlib-compressed JSON envelopes back to back, then an
+    index sorted by key, a JSON header (format and prompt version, counts) and
+    a fixed footer. Records are streamed to disk; only the index (28 bytes per
+    entry) is held in memory. The first record added for a key wins.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp = f"{path}.{os.getpid()}.tmp"
+        self.file = open(self.tmp, "wb")
+        self.file.write(_SNAPSHOT_MAGIC)
+        self.index: Dict[bytes, Tuple[int, int]] = {}
+
+    def add(self, key: str, envelope: Optional[Dict[str, Any]] = None, record: Optional[bytes] = None) -> bool:
+        digest = bytes.fromhex(key[len(CONTENT_KEY_PREFIX):])
+        if digest in self.index:
+            return False
+        if record is None:
+            record = zlib.compress(json.dumps(envelope, separators=(",", ":")).encode("utf-8"), 6)
+        self.index[digest] = (self.file.tell(), len(record))
+        self.file.write(record)
+        return True
+
+    def close(self) -> Dict[str, Any]:
+        index_offset = self.file.tell()
+        for digest in sorted(self.index):
+            self.file.write(_SNAPSHOT_INDEX.pack(digest, *self.index[digest]))
+        meta = {"format": 1, "prompt_version": PROMPT_VERSION, "entries": len(self.index), "created_at": time.time()}
+        meta_bytes = json.dumps(meta).encode("utf-8")
+        meta_offset = self.file.tell()
+        self.file.write(meta_bytes)
+        self.file.write(_SNAPSHOT_FOOTER.pack(index_offset, len(self.index), meta_offset, len(meta_bytes),
+                                              _SNAPSHOT_MAGIC))
+        self.file.close()
+        os.replace(self.tmp, self.path)
+        return {**meta, "path": self.path, "bytes": os.path.getsize(self.path)}
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp)
+
+class Snapshot:
+    """A snapshot file opened read-only and memory-mapped; lookups binary-search the index in place."""
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < len(_SNAPSHOT_MAGIC) + _SNAPSHOT_FOOTER.size or self.data[:8] != _SNAPSHOT_MAGIC:
+            raise ValueError(f"Not a cache snapshot (or an unsupported format version): {path}")
+        self.index_offset, self.count, meta_offset, meta_len, magic = _SNAPSHOT_FOOTER.unpack_from(
+            self.data, len(self.data) - _SNAPSHOT_FOOTER.size)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError(f"Truncated cache snapshot: {path}")
+        self.meta = json.loads(self.data[meta_offset:meta_offset + meta_len])
+
+    @property
+    def stale(self) -> bool:
+        return self.meta.get("prompt_version") != PROMPT_VERSION
+
+    def _entry(self, i: int) -> Tuple[bytes, int, int]:
+        return _SNAPSHOT_INDEX.unpack_from(self.data, self.index_offset + i * _SNAPSHOT_INDEX.size)
+
+    def record(self, key: str) -> Optional[bytes]:
+        digest = bytes.fromhex(key[len(CONTENT_KEY_PREFIX):])
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found, offset, length = self._entry(mid)
+            if found == digest:
+                return self.data[offset:offset + length]
+            if found < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        record = self.record(key)
+        return json.loads(zlib.decompress(record)) if record is not None else None
+
+    def records(self):
+        """(key, compressed record) in key order, read one at a time."""
+        for i in range(self.count):
+            digest, offset, length = self._entry(i)
+            yield CONTENT_KEY_PREFIX + digest.hex(), self.data[offset:offset + length]
+
+class SnapshotSet:
+    """Snapshots attached to this process, newest first; a second cache level behind _CACHE."""
+    def __init__(self):
+        self.snapshots: List[Snapshot] = []
+        self.lock = threading.Lock()
+
+    def attach(self, path: str) -> Snapshot:
+        snapshot = Snapshot(path)
+        if not snapshot.stale:
+            with self.lock:
+                self.snapshots = [snapshot] + [s for s in self.snapshots if s.path != snapshot.path]
+        return snapshot
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if not key.startswith(CONTENT_KEY_PREFIX):
+            return None
+        for snapshot in self.snapshots:
+            envelope = snapshot.get(key)
+            if envelope is not None:
+                _METRICS.incr("snapshot.hits")
+                return envelope
+        return None
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [{"path": s.path, "entries": s.count, "created_at": s.meta.get("created_at")} for s in self.snapshots]
+
+def _is_current(envelope: Any) -> bool:
+    return isinstance(envelope, dict) and (envelope.get("metadata") or {}).get("prompt_version") == PROMPT_VERSION
+
+def _export_snapshot(path: str, cache, merge: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Writes the content-addressed entries of `cache` and of the `merge`
+    snapshots to path. The cache wins over snapshots and later snapshots over
+    earlier ones; entries from another prompt version are dropped.
+    """
+    writer = SnapshotWriter(path)
+    skipped = 0
+    try:
+        if cache is not None:
+            for key, envelope in cache.items(CONTENT_KEY_PREFIX):
+                if _is_current(envelope):
+                    writer.add(key, envelope)
+                else:
+                    skipped += 1
+        for source in reversed(merge or []):
+            snapshot = Snapshot(source)
+            if snapshot.stale:
+                skipped += snapshot.count
+                continue
+            for key, record in snapshot.records():
+                writer.add(key, record=record)
+    except BaseException:
+        writer.abort()
+        raise
+    return {**writer.close(), "skipped_stale": skipped}
+
+def _load_snapshot(path: str, cache) -> Dict[str, int]:
+    """Streams a snapshot's current entries into a cache, one record at a time."""
+    snapshot = Snapshot(path)
+    if snapshot.stale:
+        return {"loaded": 0, "skipped_stale": snapshot.count}
+    loaded = 0
+    for key, record in snapshot.records():
+        cache.set(key, json.loads(zlib.decompress(record)))
+        loaded += 1
+    return {"loaded": loaded, "skipped_stale": 0}
+
+def _snapshot_file(name: str) -> str:
+    """Resolves a snapshot file name inside SNAPSHOT_DIR."""
+    if not name or os.path.basename(name) != name or name.startswith("."):
+        raise ValueError(f"Invalid snapshot name '{name}'; use a plain file name inside VISION_SNAPSHOT_DIR")
+    return os.path.join(SNAPSHOT_DIR, name)
+
+_SNAPSHOTS = SnapshotSet()
+for _snapshot_path in SNAPSHOT_PATHS:
+    _SNAPSHOTS.attach(_snapshot_path)
+
+# --- IN-MEMORY IMAGES ---
+CONTENT_URI_PREFIX = "image://sha256/"
+_SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+
+class BlobStore:
+    """Content-addressed LRU of uploaded image bytes, bounded by their total size."""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.blobs: "OrderedDict[str, bytes]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, content_hash: str) -> Optional[bytes]:
+        with self.lock:
+            data = self.blobs.get(content_hash)
+            if data is not None:
+                self.blobs.move_to_end(content_hash)
+            return data
+
+    def put(self, content_hash: str, data: bytes):
+        with self.lock:
+            if content_hash in self.blobs:
+                self.blobs.move_to_end(content_hash)
+                return
+            self.blobs[content_hash] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self.blobs) > 1:
+                _, evicted = self.blobs.popitem(last=False)
+                self.size -= len(evicted)
+
+_BLOBS = BlobStore(int(BLOB_CACHE_MB * 1024 * 1024))
+
+class UploadRequired(LookupError):
+    """A content hash was given without bytes, and neither a result nor the bytes are cached."""
+
+def _normalize_hash(content_hash: str) -> str:
+    value = content_hash.strip().lower()
+    if value.startswith("sha256:"):
+        value = value[len("sha256:"):]
+    if not _SHA256_HEX.match(value):
+        raise ValueError("content_hash must be a hex SHA-256 of the image bytes")
+    return value
+
+def _decode_image_data(image_data: str, max_size_mb: Optional[float] = None) -> bytes:
+    """
+    Base64 (or a base64 data: URL) to bytes. The size limit is checked on the
+    encoded length before decoding, and the bytes must sniff as an image PIL
+    can read; the declared data: URL type is not trusted.
+    """
+    max_size_mb = MAX_FILE_SIZE_MB if max_size_mb is None else max_size_mb
+    limit = max_size_mb * 1024 * 1024
+    if image_data.startswith("data:"):
+        header, _, image_data = image_data.partition(",")
+        if not header.endswith(";base64"):
+            raise ValueError("image_data data: URLs must be base64-encoded")
+    encoded = "".join(image_data.split())
+    if len(encoded) * 3 // 4 > limit + 2:
+        raise ValueError(f"Image data too large (> {max_size_mb}MB)")
+    try:
+        data = binascii.a2b_base64(encoded, strict_mode=True)
+    except (binascii.Error, TypeError):
+        raise ValueError("image_data is not valid base64")
+    if len(data) > limit:
+        raise ValueError(f"Image data too large (> {max_size_mb}MB)")
+    if _is_pdf(data):
+        return data
+    try:
+        with Image.open(BytesIO(data)) as img:
+            img.size  # header parsed; decoding happens later, lazily
+    except (UnidentifiedImageError, OSError):
+        raise ValueError("image_data is not a supported image format")
+    return data
+
+def _resource_input(resource: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+    """
+    An MCP resource reference to (path, image_data): a link ({"uri": ...},
+    optionally typed "resource_link") names an image://sha256/ or file://
+    resource, and an embedded resource ({"type": "resource", "resource":
+    {...}} or the inner object) carries its bytes as a base64 "blob".
+    """
+    if not isinstance(resource, dict):
+        raise ValueError("resource must be an MCP resource link or embedded resource object")
+    if resource.get("type") == "resource":
+        resource = resource.get("resource") or {}
+    if resource.get("blob") is not None:
+        return None, resource["blob"]
+    if resource.get("text") is not None:
+        raise ValueError("Text resources are not images; embed the image as a base64 'blob'")
+    uri = resource.get("uri")
+    if not isinstance(uri, str) or not uri.startswith((CONTENT_URI_PREFIX, "file://")):
+        raise ValueError(f"Unsupported resource URI {uri!r}; use {CONTENT_URI_PREFIX}<hash>, file:// or an embedded blob")
+    return uri, None
+
+@mcp.resource(CONTENT_URI_PREFIX + "{digest}", name="uploaded_image", mime_type="application/octet-stream",
+              description="Image bytes uploaded to examine_image, by SHA-256 (while in the upload cache)")
+def uploaded_image(digest: str) -> bytes:
+    data = _BLOBS.get(_normalize_hash(digest))
+    if data is None:
+        raise ValueError(f"Unknown or expired image {CONTENT_URI_PREFIX}{digest}")
+    return data
+
+def _resolve_source(path: Optional[str], image_data: Optional[str], content_hash: Optional[str],
+                    max_size_mb: Optional[float] = None):
+    """
+    Turns examine_image's inputs into (source, label, content_hash, identity):
+    source is a validated OpenFile, which the caller closes, or the image
+    bytes (None when only a hash is known, so only a cached result can
+    answer), label is what results report as original_path, and identity
+    prefixes the cache key.
+    Accepts a path, a file:// URI, an image://sha256/<hash> URI, a bare
+    content_hash, or image_data (optionally with the hash to verify).
+    `max_size_mb` overrides the file size limit.
+    """
+    if path and path.startswith(CONTENT_URI_PREFIX):
+        uri_hash = _normalize_hash(path[len(CONTENT_URI_PREFIX):])
+        if content_hash and _normalize_hash(content_hash) != uri_hash:
+            raise ValueError("content_hash does not match the image:// URI")
+        content_hash, path = uri_hash, None
+    elif path and path.startswith("file://"):
+        path = urllib.parse.unquote(urllib.parse.urlparse(path).path)
+
+    if image_data is not None:
+        data = _decode_image_data(image_data)
+        actual = hashlib.sha256(data).hexdigest()
+        if content_hash and _normalize_hash(content_hash) != actual:
+            raise ValueError(f"content_hash does not match image_data (sha256 {actual})")
+        _BLOBS.put(actual, data)
+        return data, CONTENT_URI_PREFIX + actual, actual, f"sha256:{actual}"
+    if content_hash:
+        content_hash = _normalize_hash(content_hash)
+        return (_BLOBS.get(content_hash), CONTENT_URI_PREFIX + content_hash, content_hash,
+                f"sha256:{content_hash}")
+    if not path:
+        raise ValueError("Provide path, image_data or content_hash")
+    opened = _open_validated(path, max_size_mb)
+    return opened, path, None, f"{opened.path}|{opened.mtime}"
+
+def _open_image(source: Union[str, bytes, OpenFile]) -> Image.Image:
+    if isinstance(source, OpenFile):
+        return Image.open(source.reader())
+    return Image.open(source if isinstance(source, str) else BytesIO(source))
+
+# --- IMAGE PYRAMIDS ---
+class Pyramid:
+    """
+    Read-only view of a built pyramid. Level n is the image at 1/2**n scale,
+    stored as raw tile x tile blocks in row-major order and memory-mapped, so a
+    region read only touches the tiles it covers.
+    """
+    def __init__(self, root: str):
+        with open(os.path.join(root, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.mode = meta["mode"]
+        self.tile = meta["tile"]
+        self.sizes = [tuple(size) for size in meta["levels"]]
+        self.size = self.sizes[0]
+        self.maps = []
+        for level in range(len(self.sizes)):
+            with open(os.path.join(root, f"level{level}.raw"), "rb") as f:
+                self.maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def level_for(self, box: Tuple[int, int, int, int], target: Tuple[int, int]) -> int:
+        """Coarsest level at which the box is still at least `target` pixels."""
+        w, h = box[2] - box[0], box[3] - box[1]
+        level = 0
+        while level + 1 < len(self.sizes) and w >> (level + 1) >= target[0] and h >> (level + 1) >= target[1]:
+            level += 1
+        return level
+
+    def read(self, box: Tuple[int, int, int, int], target: Tuple[int, int]) -> Image.Image:
+        """The box (level-0 pixels) from the coarsest level that still covers `target`."""
+        level = self.level_for(box, target)
+        data = self.maps[level]
+        return _read_tiles(lambda offset, n: data[offset:offset + n], self.sizes[level], self.mode, self.tile,
+                           tuple(c >> level if i < 2 else -(-c >> level) for i, c in enumerate(box)))
+
+def _read_tiles(read, size: Tuple[int, int], mode: str, tile: int, box: Tuple[int, int, int, int]) -> Image.Image:
+    """Assembles a box of one level from the tiles overlapping it; read(offset, n) returns tile bytes."""
+    x1, y1 = box[0], box[1]
+    x2, y2 = min(size[0], box[2]), min(size[1], box[3])
+    tile_bytes = tile * tile * len(mode)
+    cols = -(-size[0] // tile)
+    out = Image.new(mode, (x2 - x1, y2 - y1))
+    for ty in range(y1 // tile, (y2 - 1) // tile + 1):
+        for tx in range(x1 // tile, (x2 - 1) // tile + 1):
+            offset = (ty * cols + tx) * tile_bytes
+            block = Image.frombytes(mode, (tile, tile), read(offset, tile_bytes))
+            out.paste(block, (tx * tile - x1, ty * tile - y1))
+    return out
+
+def _streamable(img: Image.Image) -> bool:
+    """True for uncompressed single-extent files (BMP, PPM, plain TIFF) that can be read strip by strip."""
+    tiles = img.tile
+    return (len(tiles) == 1 and tiles[0][0] == "raw" and tuple(tiles[0][1]) == (0, 0) + img.size
+            and img.mode in ("L", "RGB", "RGBA") and img.getexif().get(0x0112, 1) == 1)
+
+def _pyramid_bands(img: Image.Image, rows: int, source: OpenFile):
+    """
+    Yields (y, band) strips of `rows` full-width rows. Uncompressed files
+    (BMP, PPM, plain TIFF) are read strip by strip straight from `source`, so
+    the whole image is never in memory; other formats are decoded once.
+    """
+    w, h = img.size
+    tiles = img.tile
+    if _streamable(img):
+        args = tiles[0][3]
+        rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else (tuple(args) + (0, 1))[:3]
+        stride = stride or len(Image.new(img.mode, (w, 1)).tobytes("raw", rawmode))
+        _METRICS.incr("pyramid.streamed_builds")
+        for y in range(0, h, rows):
+            n = min(rows, h - y)
+            data = source.pread(n * stride, tiles[0][2] + (y if orientation > 0 else h - y - n) * stride)
+            yield y, Image.frombytes(img.mode, (w, n), data, "raw", rawmode, stride, orientation)
+        return
+    full = _exif_transpose(img)
+    full.load()
+    for y in range(0, full.height, rows):
+        yield y, full.crop((0, y, full.width, min(full.height, y + rows)))
+
+def _open_large(source: OpenFile) -> Image.Image:
+    """
+    Opens a validated file for the pyramid path, which must take uncompressed
+    images past Pillow's decompression-bomb limit. Image.open applies that
+    limit from a process-wide setting, so instead of raising it for every
+    decode (uploads included) the format plugins are tried directly and the
+    pixel count is checked against PYRAMID_MAX_PIXELS here. Only files that
+    _pyramid_bands streams strip by strip get that allowance: anything else is
+    decoded whole, so it keeps Pillow's limit.
+    """
+    fp = source.reader()
+    prefix = fp.read(16)
+    Image.init()
+    for fmt in Image.ID:
+        factory, accept = Image.OPEN[fmt]
+        if accept:
+            accepted = accept(prefix)
+            if not accepted or isinstance(accepted, str):
+                continue
+        fp.seek(0)
+        try:
+            img = factory(fp, "")
+        except (SyntaxError, IndexError, TypeError, struct.error):
+            continue
+        if img.width * img.height > PYRAMID_MAX_PIXELS:
+            img.close()
+            raise ValueError(f"Image too large ({img.width}x{img.height} > {PYRAMID_MAX_PIXELS // 1_000_000} MP)")
+        if not _streamable(img):
+            try:
+                Image._decompression_bomb_check(img.size)
+            except Image.DecompressionBombError:
+                img.close()
+                raise
+        return img
+    raise UnidentifiedImageError(f"cannot identify image file {source.path}")
+
+class PyramidStore:
+    """
+    Pyramids on disk, one directory per content hash, built once and evicted
+    least recently used beyond max_bytes. A map from path, mtime and size to
+    content hash spares re-hashing a large file on every call.
+    """
+    def __init__(self, root: str, tile: int, max_bytes: int, open_limit: int = 8):
+        self.root = root
+        self.tile = tile
+        self.max_bytes = max_bytes
+        self.open_limit = open_limit
+        self.opened: "OrderedDict[str, Pyramid]" = OrderedDict()
+        self.build_locks: Dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def get(self, source: Union[str, OpenFile]) -> Pyramid:
+        if isinstance(source, str):
+            with OpenFile.open(source) as opened:
+                return self.get(opened)
+        content_hash = self._hash_for(source)
+        with self.lock:
+            pyramid = self.opened.get(content_hash)
+            if pyramid is not None:
+                self.opened.move_to_end(content_hash)
+                return pyramid
+            build_lock = self.build_locks.setdefault(content_hash, threading.Lock())
+        root = os.path.join(self.root, content_hash)
+        with build_lock:
+            if os.path.exists(os.path.join(root, "meta.json")):
+                os.utime(os.path.join(root, "meta.json"))
+            else:
+                start = time.perf_counter()
+                self._build(source, root)
+                _METRICS.observe("pyramid.build_seconds", time.perf_counter() - start)
+                self._evict(keep=content_hash)
+            pyramid = Pyramid(root)
+        with self.lock:
+            # Evicted views stay valid for readers still holding them; the maps close with the last reference
+            self.opened[content_hash] = pyramid
+            while len(self.opened) > self.open_limit:
+                self.opened.popitem(last=False)
+        return pyramid
+
+    def _hash_for(self, source: OpenFile) -> str:
+        key = hashlib.md5(f"{source.path}|{source.mtime_ns}|{source.size}".encode()).hexdigest()
+        map_path = os.path.join(self.root, "paths", key)
+        try:
+            with open(map_path, encoding="utf-8") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+        content_hash = _content_hash(source)
+        os.makedirs(os.path.dirname(map_path), exist_ok=True)
+        tmp = f"{map_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(content_hash)
+        os.replace(tmp, map_path)
+        return content_hash
+
+    def _build(self, source: OpenFile, root: str):
+        """Writes level 0 strip by strip, then each coarser level from the one before it."""
+        tile = self.tile
+        tmp = f"{root}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp)
+        try:
+            with _open_large(source) as img:
+                if img.mode in ("1", "L", "I;16", "I", "F"):
+                    mode = "L"
+                elif img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+                    mode = "RGBA"
+                else:
+                    mode = "RGB"
+                sizes = [img.size if img.getexif().get(0x0112, 1) in (1, 2, 3, 4) else img.size[::-1]]
+                with open(os.path.join(tmp, "level0.raw"), "wb") as out:
+                    for _, band in _pyramid_bands(img, tile, source):
+                        band = band if band.mode == mode else band.convert(mode)
+                        for x in range(0, band.width, tile):
+                            # Crops past the edge come back zero-padded to a full tile
+                            out.write(band.crop((x, 0, x + tile, tile)).tobytes())
+            while max(sizes[-1]) > tile:
+                sizes.append(self._reduce_level(tmp, len(sizes) - 1, sizes[-1], mode))
+            with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"mode": mode, "tile": tile, "levels": sizes, "source": source.path}, f)
+            try:
+                os.rename(tmp, root)
+            except OSError:
+                # Another process finished the same pyramid first
+                if not os.path.exists(os.path.join(root, "meta.json")):
+                    raise
+                shutil.rmtree(tmp, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        _METRICS.incr("pyramid.builds")
+
+    def _reduce_level(self, directory: str, level: int, size: Tuple[int, int], mode: str) -> Tuple[int, int]:
+        """
+        Builds level+1 at half size, one 2x2 block of source tiles at a time.
+        Plain reads rather than a mapping, so a build does not leave the whole
+        level resident in this process.
+        """
+        tile = self.tile
+        half = ((size[0] + 1) // 2, (size[1] + 1) // 2)
+        with open(os.path.join(directory, f"level{level}.raw"), "rb") as f, \
+                open(os.path.join(directory, f"level{level + 1}.raw"), "wb") as out:
+            read = functools.partial(os.pread, f.fileno())
+            for ty in range(-(-half[1] // tile)):
+                for tx in range(-(-half[0] // tile)):
+                    block = _read_tiles(lambda offset, n: read(n, offset), size, mode, tile,
+                                        (tx * 2 * tile, ty * 2 * tile, (tx + 1) * 2 * tile, (ty + 1) * 2 * tile))
+                    out.write(block.reduce(2).crop((0, 0, tile, tile)).tobytes())
+        return half
+
+    def _evict(self, keep: str):
+        entries = []
+        for name in os.listdir(self.root):
+            meta = os.path.join(self.root, name, "meta.json")
+            if name == keep or not os.path.exists(meta):
+                continue
+            directory = os.path.join(self.root, name)
+            size = sum(e.stat().st_size for e in os.scandir(directory) if e.is_file())
+            entries.append((os.path.getmtime(meta), size, directory))
+        total = sum(size for _, size, _ in entries) + sum(
+            e.stat().st_size for e in os.scandir(os.path.join(self.root, keep)) if e.is_file())
+        for _, size, directory in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+            _METRICS.incr("pyramid.evictions")
+
+_PYRAMIDS = PyramidStore(PYRAMID_DIR, PYRAMID_TILE, int(PYRAMID_MAX_GB * 1024 ** 3))
+
+def _pyramid_for(source: Union[OpenFile, bytes, None], oversized: bool, plain: bool) -> Optional[Pyramid]:
+    """The pyramid serving this file, or None when the image is decoded as usual."""
+    if not PYRAMID_ENABLED or not isinstance(source, OpenFile) or not plain:
+        return None
+    with _open_large(source) as img:
+        if oversized and not _streamable(img):
+            # Compressed formats decode whole; past the normal size limit that is unbounded memory
+            raise ValueError(f"Compressed images over {MAX_FILE_SIZE_MB}MB are not supported. "
+                             "Save as uncompressed TIFF, BMP or PPM to read them by region.")
+        if not oversized and img.width * img.height <= PYRAMID_MIN_PIXELS:
+            return None
+    return _PYRAMIDS.get(source)
+
+def _pyramid_process(pyramid: Pyramid, region: Optional[List[int]], mode: str):
+    """_process_image for a pyramid: only the tiles under the region, at the level the target size needs."""
+    crop_bbox = _clamp_region(region, pyramid.size)
+    max_dim = _max_dim(mode)
+    box_size = (crop_bbox[2] - crop_bbox[0], crop_bbox[3] - crop_bbox[1])
+    img = pyramid.read(crop_bbox, _fit_size(box_size, max_dim))
+    _METRICS.incr("pyramid.reads")
+    data_url, mime, _, _, sent_size = _encode_image(img, None, mode, owned=True, max_dim=max_dim)
+    return data_url, mime, pyramid.size, crop_bbox, sent_size
+
+# --- HELPERS ---
+
+def _validate_path(path: str, max_size_mb: Optional[float] = None) -> str:
+    """Securely validates path is within BASE_DIR using strict resolution."""
+    with _open_validated(path, max_size_mb) as opened:
+        return opened.path
+
+def _clamp_region(region: Optional[List[int]], size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """Clamps a requested [x1, y1, x2, y2] region to the image bounds."""
+    orig_w, orig_h = size
+    if not region:
+        return (0, 0, orig_w, orig_h)
+    x1, y1, x2, y2 = region
+    x1, y1 = max(0, x1), max(0, y1)
+    x2, y2 = min(orig_w, x2), min(orig_h, y2)
+    if x2 <= x1 or y2 <= y1:
+        raise ValueError(f"Invalid region {region} for image size {orig_w}x{orig_h}")
+    return (x1, y1, x2, y2)
+
+def _dhash(img: Image.Image, crop_bbox: Tuple[int, int, int, int]) -> int:
+    """Difference hash (NEAR_DUP_HASH_BITS bits) of the cropped area."""
+    size = NEAR_DUP_HASH_SIZE
+    if img.mode not in ("L", "RGB", "RGBA"):
+        img = img.convert("RGB")
+    small = img.resize((size + 1, size), Image.Resampling.BOX, box=crop_bbox, reducing_gap=2.0).convert("L")
+    px = small.tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (px[offset + col] > px[offset + col + 1])
+    return value
+
+def _fit_size(size: Tuple[int, int], max_dim: int) -> Tuple[int, int]:
+    """Aspect-preserving size whose longest side is at most max_dim."""
+    w, h = size
+    scale = min(1.0, max_dim / max(w, h))
+    return (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+
+def _process_image(source: Union[str, OpenFile, Image.Image], region: Optional[List[int]], mode: str,
+                   max_dim: Optional[int] = None):
+    """
+    Loads, crops, resizes, and encodes.
+    Accepts a path, an OpenFile, or an already opened and EXIF-transposed image.
+    Returns: (data_url, mime, orig_size, crop_bbox, sent_size)
+    """
+    if isinstance(source, Image.Image):
+        return _encode_image(source, region, mode, max_dim=max_dim)
+    with _open_image(source) as img:
+        return _encode_image(_exif_transpose(img), region, mode, owned=True, max_dim=max_dim)
+
+def _exif_transpose(img: Image.Image) -> Image.Image:
+    """Applies EXIF orientation, skipping the full-size copy when there is none."""
+    if img.getexif().get(0x0112, 1) == 1:
+        return img
+    return ImageOps.exif_transpose(img)
+
+def _encode_image(img: Image.Image, region: Optional[List[int]], mode: str, owned: bool = False,
+                  max_dim: Optional[int] = None):
+    """
+    Crops, resizes and encodes an open image without mutating it. When `owned`,
+    the decoded source is released as soon as a smaller derived image exists.
+    `max_dim` overrides the per-mode size limit.
+    """
+    source = img
+    orig_w, orig_h = img.size
+
+    # 1. Crop Logic
+    crop_bbox = _clamp_region(region, (orig_w, orig_h))
+    if region:
+        img = img.crop(crop_bbox)
+
+    # 2. Resize Logic
+    max_dim = max_dim or _max_dim(mode)
+    if max(img.size) > max_dim:
+        if mode in ["ocr", "ui"] and SCREENSHOT_FAST_PATH and _looks_like_screenshot(img):
+            img = _screenshot_resize(img, max_dim)
+        else:
+            img = img.resize(_fit_size(img.size, max_dim), Image.Resampling.BICUBIC, reducing_gap=2.0)
+    if owned and img is not source:
+        source.close()
+    del source
+    
+    sent_w, sent_h = img.size 
+
+    # 3. Encoding Logic
+    buffer = BytesIO()
+    if mode in ["ocr", "ui"]:
+        mime = "image/png"
+        if SCREENSHOT_FAST_PATH:
+            img = _exact_palette(img)
+        img.save(buffer, format="PNG", optimize=True)
+    else:
+        mime = "image/jpeg"
+        if img.mode in ("RGBA", "LA"):
+            bg = Image.new("RGB", img.size, (255, 255, 255))
+            bg.paste(img, mask=img.split()[-1])
+            img = bg
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        img.save(buffer, format="JPEG", quality=85, optimize=True)
+    # Drop our reference to the pixels before the payload copies are made
+    del img
+
+    data_url = _data_url(buffer, mime)
+    buffer.close()
+    return (
+        data_url,
+        mime,
+        (orig_w, orig_h),
+        crop_bbox,
+        (sent_w, sent_h)
+    )
+
+def _max_dim(mode: str) -> int:
+    """Longest side sent to the model: text and UI need more pixels than scenes."""
+    return 2560 if mode in ["ocr", "ui"] else 1536
+
+def _looks_like_screenshot(img: Image.Image) -> bool:
+    """
+    UI captures are mostly a handful of flat colours; photos spread over
+    thousands. Decides on a nearest-neighbour sample, which (unlike a
+    filtered thumbnail) does not invent blended colours.
+    """
+    sample = img.convert("RGB") if img.mode not in ("RGB", "L") else img
+    sample = sample.resize(_fit_size(img.size, SCREENSHOT_SAMPLE_PX), Image.Resampling.NEAREST)
+    colors = sample.getcolors(4096)
+    if colors is None:
+        return False
+    top = sorted((count for count, _ in colors), reverse=True)[:SCREENSHOT_TOP_COLORS]
+    return sum(top) >= SCREENSHOT_MIN_FLAT_SHARE * sample.width * sample.height
+
+def _screenshot_resize(img: Image.Image, max_dim: int) -> Image.Image:
+    """
+    Text-preserving downscale: an integer-factor reduce() (exact box average,
+    and the whole job when the factor divides evenly), area averaging for any
+    remainder, then a light unsharp mask to restore thin strokes.
+    """
+    target = _fit_size(img.size, max_dim)
+    factor = min(img.width // target[0], img.height // target[1])
+    if factor > 1:
+        img = img.reduce(factor)
+    if img.size != target:
+        img = img.resize(target, Image.Resampling.BOX)
+    # A threshold keeps flat areas flat, so the PNG stays small
+    return img.filter(ImageFilter.UnsharpMask(radius=1, percent=60, threshold=16))
+
+def _exact_palette(img: Image.Image) -> Image.Image:
+    """
+    Lossless palette conversion for images with at most 256 colours, so PNG
+    stores one byte per pixel. With one palette slot per colour the quantizer
+    keeps every colour, but the result is compared against the source anyway
+    and anything inexact (or over 256 colours) is returned unchanged.
+    """
+    rgb = img
+    if rgb.mode == "RGBA" and rgb.getextrema()[3] == (255, 255):
+        rgb = rgb.convert("RGB")
+    if rgb.mode != "RGB":
+        return img
+    colors = rgb.getcolors(256)
+    if colors is None:
+        return img
+    paletted = rgb.quantize(colors=len(colors), method=Image.Quantize.MAXCOVERAGE, dither=Image.Dither.NONE)
+    if ImageChops.difference(paletted.convert("RGB"), rgb).getbbox() is not None:
+        return img
+    return paletted
+
+_B64_CHUNK = 3 * 256 * 1024  # multiple of 3 so chunks concatenate without padding
+
+def _data_url(buffer: BytesIO, mime: str) -> str:
+    """
+    Builds the data: URL straight from the encoder's buffer. The raw bytes are
+    read through a memoryview (no getvalue() copy) and base64-encoded in chunks
+    into one preallocated bytearray holding the prefix, so the only full-size
+    copies are that bytearray and the final str.
+    """
+    prefix = f"data:{mime};base64,".encode("ascii")
+    with buffer.getbuffer() as view:
+        size = len(view)
+        out = bytearray(len(prefix) + 4 * ((size + 2) // 3))
+        out[:len(prefix)] = prefix
+        pos = len(prefix)
+        for start in range(0, size, _B64_CHUNK):
+            piece = binascii.b2a_base64(view[start:start + _B64_CHUNK], newline=False)
+            out[pos:pos + len(piece)] = piece
+            pos += len(piece)
+    return out.decode("ascii")
+
+def _normalize_content(content: Any) -> str:
+    """Safely converts diverse provider outputs (lists, dicts, None) to string."""
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for item in content:
+            if isinstance(item, str):
+                parts.append(item)
+            elif isinstance(item, dict):
+                parts.append(str(item.get("text", item)))
+            else:
+                parts.append(str(item))
+        return "\n".join(parts)
+    return str(content)
+
+def _adjust_coordinates(result: Dict, crop_bbox: Tuple[int,int,int,int], sent_size: Tuple[int,int], orig_size: Tuple[int,int],
+                        tiles: Optional[List[Tuple[Tuple[int,int,int,int], Tuple[int,int,int,int]]]] = None):
+    """
+    Maps relative VLM coordinates -> Absolute Original coordinates.
+    Handles normalization detection, sorting, rounding, and safe-clamping.
+    With `tiles` (mosaic mode), crop_bbox spans the mosaic canvas and each box
+    is moved from the tile holding its centre back to that tile's source area.
+    """
+    crop_x1, crop_y1, crop_x2, crop_y2 = crop_bbox
+    crop_w = crop_x2 - crop_x1
+    crop_h = crop_y2 - crop_y1
+    sent_w, sent_h = sent_size
+    orig_w, orig_h = orig_size
+    
+    # 0-indexed max boundaries for click safety
+    max_x_safe = max(0, orig_w - 1)
+    max_y_safe = max(0, orig_h - 1)
+
+    sx = crop_w / max(sent_w, 1)
+    sy = crop_h / max(sent_h, 1)
+
+    def sanitize_and_map(bbox):
+        if not isinstance(bbox, list) or len(bbox) != 4:
+            return bbox
+        
+        try:
+            raw_coords = [float(x) for x in bbox]
+            
+            # Heuristic: If largest value <= 1.5, treat as normalized (0.0-1.0)
+            if max(raw_coords) <= 1.5:
+                raw_coords[0] *= sent_w
+                raw_coords[1] *= sent_h
+                raw_coords[2] *= sent_w
+                raw_coords[3] *= sent_h
+
+            # Map Sent-Coords -> Crop-Coords -> Original-Coords
+            x1 = crop_x1 + (raw_coords[0] * sx)
+            y1 = crop_y1 + (raw_coords[1] * sy)
+            x2 = crop_x1 + (raw_coords[2] * sx)
+            y2 = crop_y1 + (raw_coords[3] * sy)
+
+            # Sort coordinates
+            final_x1, final_x2 = sorted((x1, x2))
+            final_y1, final_y2 = sorted((y1, y2))
+
+            if tiles:
+                final_x1, final_y1, final_x2, final_y2 = _unmosaic_box((final_x1, final_y1, final_x2, final_y2), tiles)
+
+            # Round and Clamp
+            return [
+                int(round(max(0, min(final_x1, max_x_safe)))),
+                int(round(max(0, min(final_y1, max_y_safe)))),
+                int(round(max(0, min(final_x2, max_x_safe)))),
+                int(round(max(0, min(final_y2, max_y_safe))))
+            ]
+        except (ValueError, TypeError):
+            return bbox 
+
+    if "elements" in result:
+        for el in result["elements"]:
+            if "bbox" in el: el["bbox"] = sanitize_and_map(el["bbox"])
+            
+    if "text_blocks" in result:
+        for blk in result["text_blocks"]:
+            if "bbox" in blk: blk["bbox"] = sanitize_and_map(blk["bbox"])
+
+def _unmosaic_box(box: Tuple[float, float, float, float],
+                  tiles: List[Tuple[Tuple[int,int,int,int], Tuple[int,int,int,int]]]) -> Tuple[float, float, float, float]:
+    """Maps a box in mosaic-canvas coordinates back to the source image."""
+    cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+
+    def distance(tile):
+        dx1, dy1, dx2, dy2 = tile[1]
+        return max(dx1 - cx, 0, cx - dx2) + max(dy1 - cy, 0, cy - dy2)
+
+    (sx1, sy1, sx2, sy2), (dx1, dy1, _, _) = min(tiles, key=distance)
+    ox, oy = sx1 - dx1, sy1 - dy1
+    return (
+        max(sx1, min(box[0] + ox, sx2)),
+        max(sy1, min(box[1] + oy, sy2)),
+        max(sx1, min(box[2] + ox, sx2)),
+        max(sy1, min(box[3] + oy, sy2)),
+    )
+
+def _repair_json(raw_input: Union[str, Dict, List, None], model: str) -> Dict:
+    """Robust JSON extraction/repair with internal content normalization."""
+    
+    # 1. Handle pre-parsed Dict
+    if isinstance(raw_input, dict):
+        return raw_input
+    
+    # 2. Normalize input to String (handles List/None)
+    raw_text = _normalize_content(raw_input)
+
+    # 3. Slice method
+    try:
+        start = raw_text.find('{')
+        end = raw_text.rfind('}')
+        if start != -1 and end != -1:
+            return json.loads(raw_text[start:end+1])
+    except:
+        pass
+
+    # 4. LLM Repair (Truncated)
+    try:
+        truncated_text = raw_text[:8000]
+        response = _completion(
+            model=model,
+            temperature=0,
+            top_p=1,
+            messages=[{
+                "role": "system", 
+                "content": "You are a JSON fixer. Return ONLY valid JSON. No markdown."
+            }, {
+                "role": "user", 
+                "content": truncated_text
+            }]
+        )
+        
+        # Normalize response content (handle lists/None from repair model)
+        repaired_content = _normalize_content(response.choices[0].message.content)
+        
+        cleaned = re.sub(r"```json|```", "", repaired_content).strip()
+        start = cleaned.find('{')
+        end = cleaned.rfind('}')
+        if start != -1 and end != -1:
+            return json.loads(cleaned[start:end+1])
+        return json.loads(cleaned)
+    except Exception:
+        return {"error": "JSON Parse Failed", "raw_output": raw_text[:500] + "..."}
+
+def _near_duplicate_envelope(cached: Dict, distance: int, path: str) -> Dict:
+    """Copies a cached envelope for a perceptually near-identical image."""
+    envelope = copy.deepcopy(cached)
+    metadata = envelope.setdefault("metadata", {})
+    metadata["near_duplicate"] = {
+        "distance": distance,
+        "hash_bits": NEAR_DUP_HASH_BITS,
+        "source_path": metadata.get("original_path"),
+    }
+    metadata["original_path"] = path
+    return envelope
+
+# --- TOOL ---
+
+@_run_tool_in_thread
+def examine_image(
+    path: Optional[str] = None,
+    mode: str = "general", 
+    question: Optional[str] = None, 
+    region: Optional[List[int]] = None,
+    priority: str = "normal",
+    deadline_ms: Optional[int] = None,
+    frames: Optional[Union[str, List[int]]] = None,
+    content_crop: Optional[str] = None,
+    refine_boxes: bool = False,
+    image_data: Optional[str] = None,
+    content_hash: Optional[str] = None,
+    progressive: bool = False,
+    pages: Optional[Union[str, List[int]]] = None,
+    resource: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Analyzes an image or a PDF.
+    
+    Args:
+        path: Absolute local path (or file:// URI, or image://sha256/<hash> for
+            an image uploaded earlier).
+        mode: 'ui' (elements), 'ocr' (text), 'general' (describe), 'query' (QA).
+        question: Required if mode='query'.
+        region: [x1, y1, x2, y2] pixel crop.
+        priority: 'interactive', 'normal' or 'bulk'; interactive work is sent first.
+        deadline_ms: Drop the request if it cannot reach the model within this many ms.
+        frames: For multi-frame images (TIFF pages, GIF/WebP animations): 'all' or
+            a non-empty list of frame indices. Returns per-frame results under
+            'frames'. Cannot be combined with content_crop or refine_boxes.
+        content_crop: Detect content locally first and send less background:
+            'crop' (tight box around all content) or 'mosaic' (content regions
+            packed together). Coordinates still refer to the original image.
+        refine_boxes: Snap each returned bbox to the nearest visual edges in the
+            full-resolution image. Each item gets 'refinement' with a 0-1
+            'confidence' and an 'empty' flag for boxes on plain background.
+        image_data: Base64 image bytes (or a base64 data: URL) instead of a path,
+            for in-memory captures. Same size limit as files.
+        content_hash: Hex SHA-256 of the image bytes. Send it alone first: a
+            cached result comes back without uploading; otherwise the reply has
+            'upload_required' and the call is repeated with image_data.
+        progressive: ocr/ui only. Read a low-resolution overview first, then
+            re-read at full resolution just the areas the model was unsure of
+            or where text is tiny or boxes are dense, and merge the results.
+        pages: For PDFs: 'all' or a list of 0-based page indices (default: the
+            first page). Returns per-page results under 'pages'; region and
+            boxes are in PDF points from the page's top-left. ocr reads the
+            embedded text layer where there is one, without a model call.
+        resource: An MCP resource reference instead of path/image_data: a
+            resource link ({"uri": "image://sha256/<hash>"} or a file:// URI)
+            or an embedded resource whose 'blob' holds the base64 bytes.
+    """
+    if priority not in PRIORITY_CLASSES:
+        return {"error": f"Invalid priority '{priority}'. Allowed: {list(PRIORITY_CLASSES)}", "path": path}
+    if resource is not None:
+        if path or image_data is not None:
+            return {"error": "Pass one of path, image_data or resource", "path": path}
+        try:
+            path, image_data = _resource_input(resource)
+        except ValueError as e:
+            return {"error": str(e), "path": None}
+    with _request_scope(priority, deadline_ms):
+        return _examine(path, mode, question, region, frames, content_crop, refine_boxes, image_data, content_hash,
+                        progressive=progressive, pages=pages)
+
+@_run_tool_in_thread
+def get_metrics() -> Dict[str, Any]:
+    """Returns server metrics: scheduler queue depth and wait times, provider health."""
+    snapshot = _METRICS.snapshot()
+    snapshot["scheduler"] = _SCHEDULER.snapshot()
+    snapshot["cache"] = _CACHE.stats()
+    counters = snapshot.get("counters", {})
+    if counters.get("prompt.requests"):
+        snapshot["prompt_cache"] = {
+            "request_hit_rate": round(counters.get("prompt.cache_hits", 0) / counters["prompt.requests"], 4),
+            "token_hit_rate": round(counters.get("prompt.cached_tokens", 0) / max(counters.get("prompt.tokens", 0), 1), 4),
+        }
+    if counters.get("hedge.requests"):
+        fired = counters.get("hedge.fired", 0)
+        snapshot["hedging"] = {
+            "hedge_rate": round(fired / counters["hedge.requests"], 4),
+            "win_rate": round(counters.get("hedge.wins", 0) / fired, 4) if fired else 0.0,
+            "budget_denied": counters.get("hedge.budget_denied", 0),
+            "threshold_seconds": round(_hedge_delay(), 3),
+        }
+    if _RESULT_INDEX is not None:
+        snapshot["result_index"] = _RESULT_INDEX.stats()
+    if _SNAPSHOTS.snapshots:
+        snapshot["snapshots"] = _SNAPSHOTS.stats()
+    with _PROVIDER_GUARD.lock:
+        guards = dict(_PROVIDER_GUARD.guards)
+    snapshot["providers"] = {
+        name: {"breaker": breaker.state, "rate": limiter.snapshot()}
+        for name, (limiter, breaker) in guards.items()
+    }
+    return snapshot
+
+@_run_tool_in_thread
+def search_images(
+    query: str,
+    mode: Optional[str] = None,
+    kind: Optional[str] = None,
+    path_prefix: Optional[str] = None,
+    limit: int = 20
+) -> Dict[str, Any]:
+    """
+    Searches the text and UI labels of every image analyzed in 'ocr' or 'ui' mode.
+
+    Args:
+        query: Words or phrases to find, e.g. 'E-4012' or 'Save changes'. Every
+            term must match; end a term with * for prefix matching.
+        mode: Only results from this mode ('ocr' or 'ui').
+        kind: 'text' (OCR blocks) or 'element' (UI labels).
+        path_prefix: Only images whose resolved path starts with this.
+        limit: Maximum matches returned (1-500), best first.
+    """
+    if _RESULT_INDEX is None:
+        return {"error": "Result index disabled (VISION_INDEX_PATH is empty)", "query": query}
+    if not query or not query.strip():
+        return {"error": "Parameter 'query' must not be empty", "query": query}
+    if kind is not None and kind not in ("text", "element"):
+        return {"error": f"Invalid kind '{kind}'. Allowed: ['element', 'text']", "query": query}
+    try:
+        start = time.perf_counter()
+        matches = _RESULT_INDEX.search(query, mode, kind, path_prefix, max(1, min(int(limit), 500)))
+        elapsed = time.perf_counter() - start
+        _METRICS.observe("index.search_seconds", elapsed)
+        return {"query": query, "matches": matches, "elapsed_ms": round(elapsed * 1000, 2)}
+    except Exception as e:
+        return {"error": str(e), "query": query}
+
+@_run_tool_in_thread
+def export_cache_snapshot(name: str, merge: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Writes this server's cached results, keyed by image content, to a snapshot
+    file in VISION_SNAPSHOT_DIR for other nodes to import.
+
+    Args:
+        name: Snapshot file name, e.g. 'fleet-2024-06-01.snap'.
+        merge: Existing snapshot names to fold in. Later ones win over earlier
+            ones, and this server's cache wins over all of them.
+    """
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        return _export_snapshot(_snapshot_file(name), _CACHE, [_snapshot_file(m) for m in merge or []])
+    except Exception as e:
+        return {"error": str(e), "name": name}
+
+@_run_tool_in_thread
+def import_cache_snapshot(name: str, load: bool = False) -> Dict[str, Any]:
+    """
+    Attaches a snapshot from VISION_SNAPSHOT_DIR. examine_image then answers
+    from it for the same image bytes (at any path, or uploaded), reading single
+    entries from the memory-mapped file. Snapshots from another prompt version
+    are not attached.
+
+    Args:
+        name: Snapshot file name.
+        load: Also copy its entries into the result cache (bounded by its size).
+    """
+    try:
+        path = _snapshot_file(name)
+        snapshot = _SNAPSHOTS.attach(path)
+        result = {"name": name, "attached": not snapshot.stale, "entries": snapshot.count,
+                  "prompt_version": snapshot.meta.get("prompt_version"),
+                  "created_at": snapshot.meta.get("created_at")}
+        if load:
+            result.update(_load_snapshot(path, _CACHE))
+        return result
+    except Exception as e:
+        return {"error": str(e), "name": name}
+
+def _examine(path: Optional[str], mode: str, question: Optional[str], region: Optional[List[int]],
+             frames: Optional[Union[str, List[int]]] = None, content_crop: Optional[str] = None,
+             refine_boxes: bool = False, image_data: Optional[str] = None,
+             content_hash: Optional[str] = None, progressive: bool = False,
+             pages: Optional[Union[str, List[int]]] = None) -> Dict[str, Any]:
+    """Single-image (or PDF) analysis behind examine_image; errors become {"error": ...}."""
+    source = None
+    try:
+        # 1. Strict Validation
+        if mode not in ALLOWED_MODES:
+            return {"error": f"Invalid mode '{mode}'. Allowed: {sorted(list(ALLOWED_MODES))}", "path": path}
+
+        if mode == "query" and not question:
+            return {"error": "Parameter 'question' is required when mode='query'", "path": path}
+
+        if content_crop is not None and content_crop not in CONTENT_CROP_MODES:
+            return {"error": f"Invalid content_crop '{content_crop}'. Allowed: {sorted(CONTENT_CROP_MODES)}", "path": path}
+
+        if progressive and (mode not in ("ocr", "ui") or content_crop or frames is not None):
+            return {"error": "progressive is for single-image 'ocr' and 'ui' without content_crop", "path": path}
+
+        if frames is not None and (content_crop or refine_boxes):
+            return {"error": "frames supports mode, question and region only", "path": path}
+
+        if isinstance(frames, list) and not frames:
+            return {"error": "frames must be 'all' or a non-empty list of frame indices", "path": path}
+
+        source, path, content_hash, identity = _resolve_source(
+            path, image_data, content_hash, max(MAX_FILE_SIZE_MB, PYRAMID_MAX_FILE_MB) if PYRAMID_ENABLED else None)
+        region_norm = [int(c) for c in region] if region else None
+        if _is_pdf(source):
+            if frames is not None or content_crop or refine_boxes or progressive:
+                return {"error": "PDFs support mode, question, region and pages only", "path": path}
+            if isinstance(source, OpenFile) and source.size > MAX_FILE_SIZE_MB * 1024 * 1024:
+                raise ValueError(f"File too large (> {MAX_FILE_SIZE_MB}MB)")
+            pdf_key = _cache_key(f"{_cache_key_base(identity, mode, question, region_norm)}|pages={json.dumps(pages)}")
+            cached = _CACHE.get(pdf_key)
+            if cached: return _relabelled(cached, path)
+            return _examine_pdf(path, source, content_hash or _content_hash(source), pdf_key, mode, question,
+                                region_norm, pages, content_hash)
+        if pages is not None:
+            return {"error": "pages is for PDF documents; use frames for multi-frame images", "path": path}
+        plain = not (content_crop or refine_boxes or progressive or frames is not None)
+        oversized = isinstance(source, OpenFile) and source.size > MAX_FILE_SIZE_MB * 1024 * 1024
+        if oversized and not plain:
+            return {"error": f"Files over {MAX_FILE_SIZE_MB}MB support plain analysis only (region allowed)", "path": path}
+
+        # 2. Cache Lookup (uploads are keyed by content hash, files by path and mtime)
+        cache_key_str = _cache_key_base(identity, mode, question, region_norm)
+        if content_crop:
+            cache_key_str += f"|content={content_crop}"
+        if refine_boxes:
+            cache_key_str += "|refine"
+        if progressive:
+            cache_key_str += "|progressive"
+        if frames is not None:
+            if source is None:
+                frames_key = _cache_key(f"{cache_key_str}|frames={json.dumps(frames)}")
+                cached = _CACHE.get(frames_key) or _SNAPSHOTS.get(frames_key)
+                if cached: return cached
+                raise UploadRequired(content_hash)
+            return _examine_frames(path, source, cache_key_str, mode, question, region_norm, frames, content_hash)
+        cache_key = _cache_key(cache_key_str)
+        
+        cached = _CACHE.get(cache_key)
+        if cached: return _relabelled(cached, path)
+        # The same bytes under another path, uploaded, or in an attached snapshot
+        file_hash, content_key = None, cache_key
+        if isinstance(source, OpenFile) and not oversized:
+            file_hash = _content_hash(source)
+            content_key = _cache_key(f"sha256:{file_hash}{cache_key_str[len(identity):]}")
+        cached = _content_result(content_key, cache_key, path)
+        if cached: return cached
+        if source is None:
+            raise UploadRequired(content_hash)
+        index_source = source if isinstance(source, OpenFile) else path
+
+        # 3. Processing (with near-duplicate reuse when enabled)
+        near_context = f"{mode}|{question}|{json.dumps(region_norm)}|{content_crop}|{refine_boxes}|{progressive}|{_prompt_version(mode)}"
+        phash = None
+        plan: Dict[str, Any] = {}
+        hint = None
+        pyramid = _pyramid_for(source, oversized, plain)
+        if pyramid is not None:
+            # Very large images are read from their tile pyramid, never decoded whole
+            data_url, mime, orig_size, crop_bbox, sent_size = _pyramid_process(pyramid, region_norm, mode)
+        else:
+            with _open_image(source) as src:
+                img = _exif_transpose(src)
+                if NEAR_DUP_MAX_DISTANCE >= 0:
+                    phash = _dhash(img, _clamp_region(region_norm, img.size))
+                    near = _PHASH_INDEX.lookup(near_context, phash, img.size, NEAR_DUP_MAX_DISTANCE)
+                    if near:
+                        envelope = _near_duplicate_envelope(near[1], near[0], path)
+                        _CACHE.set(cache_key, envelope)
+                        _index_envelope(index_source, envelope, region_norm, content_hash or file_hash)
+                        return envelope
+                if content_crop:
+                    plan = _plan_content_crop(img, region_norm, content_crop)
+                if progressive:
+                    orig_size = img.size
+                    result_json, crop_bbox, sent_size, progress = _progressive_analysis(img, region_norm, mode, question)
+                elif "canvas" in plan:
+                    orig_size = img.size
+                    data_url, mime, canvas_size, crop_bbox, sent_size = _process_image(plan.pop("canvas"), None, mode)
+                    hint = "The image is a mosaic of separate content regions packed together; gaps are not content."
+                else:
+                    data_url, mime, orig_size, crop_bbox, sent_size = _process_image(img, plan.get("region", region_norm), mode)
+                del img
+
+        # 4-6. Prompting, Inference, Repair
+        if not progressive:
+            result_json = _analyze_payload(data_url, mode, question, sent_size, hint)
+            del data_url
+            _adjust_coordinates(result_json, crop_bbox, sent_size, orig_size, plan.get("tiles"))
+        refinement = None
+        if refine_boxes and "error" not in result_json:
+            with _open_image(source) as src:
+                refinement = _refine_result(result_json, _exif_transpose(src))
+
+        shown_bbox = crop_bbox if (region or "region" in plan) and "tiles" not in plan else None
+        envelope = _envelope(mode, path, orig_size, shown_bbox, sent_size, result_json)
+        if content_crop:
+            envelope["metadata"]["content_crop"] = {
+                "strategy": "mosaic" if "tiles" in plan else ("crop" if plan else "none"),
+                "regions": plan.get("regions", []),
+            }
+        if progressive:
+            envelope["metadata"]["progressive"] = progress
+        if refinement is not None:
+            envelope["metadata"]["refinement"] = refinement
+        if content_hash:
+            envelope["metadata"]["content_hash"] = content_hash
+        
+        _CACHE.set(cache_key, envelope)
+        if content_key != cache_key:
+            _CACHE.set(content_key, envelope)
+        _index_envelope(index_source, envelope, region_norm, content_hash or file_hash)
+        if phash is not None:
+            _PHASH_INDEX.add(near_context, phash, cache_key, orig_size)
+        return envelope
+
+    except UploadRequired as e:
+        return {"error": "Unknown content_hash; call again with image_data", "upload_required": True,
+                "content_hash": e.args[0], "path": path}
+    except Exception as e:
+        return {"error": str(e), "path": path}
+    finally:
+        if isinstance(source, OpenFile):
+            source.close()
+
+def _cache_key_base(identity: str, mode: str, question: Optional[str], region: Optional[List[int]]) -> str:
+    """Cache key of a plain single-image analysis; options append their own suffixes."""
+    return f"{identity}|{mode}|{question}|{json.dumps(region)}|{_prompt_version(mode)}"
+
+def _cache_key(cache_key_str: str) -> str:
+    """Hashed cache key; keys of content-addressed (sha256:) results are marked so snapshots can find them."""
+    digest = hashlib.md5(cache_key_str.encode()).hexdigest()
+    return CONTENT_KEY_PREFIX + digest if cache_key_str.startswith("sha256:") else digest
+
+def _content_result(content_key: str, cache_key: str, path: str) -> Optional[Dict[str, Any]]:
+    """A result for the same image bytes under its content key, cached or in a snapshot, relabelled for path."""
+    found = _CACHE.get(content_key) if content_key != cache_key else None
+    if not found:
+        found = _SNAPSHOTS.get(content_key)
+        if not found:
+            return None
+        _CACHE.set(content_key, found)
+    envelope = _relabelled(found, path)
+    _CACHE.set(cache_key, envelope)
+    return envelope
+
+def _relabelled(envelope: Dict[str, Any], path: str) -> Dict[str, Any]:
+    """The envelope reporting path as original_path; a copy when it was cached for other bytes' path."""
+    metadata = envelope.get("metadata") or {}
+    if metadata.get("original_path", path) == path:
+        return envelope
+    envelope = copy.deepcopy(envelope)
+    envelope["metadata"]["original_path"] = path
+    return envelope
+
+def _envelope(mode: str, path: str, orig_size: Tuple[int, int], crop_bbox: Optional[Tuple[int, int, int, int]],
+              sent_size: Tuple[int, int], content: Dict) -> Dict[str, Any]:
+    return {
+        "mode": mode,
+        "metadata": {
+            "original_path": path,
+            "original_size": {"width": orig_size[0], "height": orig_size[1]},
+            "crop_bbox": list(crop_bbox) if crop_bbox else None,
+            "sent_size": {"width": sent_size[0], "height": sent_size[1]},
+            "prompt_version": PROMPT_VERSION
+        },
+        "content": content
+    }
+
+# Output contracts per mode; part of the static system prompt
+_SCHEMAS = {
+    "ui": "JSON: { \"elements\": [ { \"type\": \"button|input\", \"label\": string, \"bbox\": [x1,y1,x2,y2] } ], \"uncertainties\": [string] }",
+    "ocr": "JSON: { \"text_blocks\": [ { \"text\": string, \"bbox\": [x1,y1,x2,y2] } ], \"uncertainties\": [string] }",
+    "query": "JSON: { \"answer\": string, \"evidence\": [string], \"uncertainties\": [string] }",
+    "general": "JSON: { \"description\": string, \"main_objects\": [string], \"uncertainties\": [string] }"
+}
+
+# Terse line formats for COMPACT_OUTPUT: one "|"-separated line per item, no
+# keys, bbox on the COMPACT_GRID. _COMPACT_FIELDS maps the leading values to item keys.
+_COMPACT_SCHEMAS = {
+    "ui": "JSON: { \"e\": string, \"u\": [string] } where e has one line per element, "
+          "type|label|x1|y1|x2|y2, and type is button|input|...",
+    "ocr": "JSON: { \"t\": string, \"u\": [string] } where t has one line per text block, text|x1|y1|x2|y2"
+}
+_COMPACT_FIELDS = {
+    "ui": ("e", "elements", ("type", "label")),
+    "ocr": ("t", "text_blocks", ("text",))
+}
+
+def _compact_for(mode: str) -> bool:
+    return COMPACT_OUTPUT and mode in _COMPACT_SCHEMAS
+
+def _prompt_version(mode: str) -> str:
+    """Cache-key prompt identity: compact and verbose answers are cached apart."""
+    return f"{PROMPT_VERSION}-compact" if _compact_for(mode) else PROMPT_VERSION
+
+# Providers whose prompt caching is opt-in via cache_control breakpoints
+_CACHE_CONTROL_PROVIDERS = {"anthropic", "bedrock", "vertex_ai", "vertex_ai_beta", "gemini"}
+
+@functools.lru_cache(maxsize=None)
+def _system_prompt(mode: str, compact: bool = False) -> str:
+    """
+    Byte-identical system prompt per (mode, wire schema, PROMPT_VERSION).
+    Nothing request-specific (image size, question, hints) may go in here, or
+    providers' prefix caches never hit.
+    """
+    if compact:
+        return (
+            "You are a machine vision engine. Output strict JSON only. "
+            f"Mode: {mode.upper()}. {_COMPACT_SCHEMAS[mode]} "
+            f"Coordinates are integers from 0 to {COMPACT_GRID} across the image's width (x) and height (y)."
+        )
+    return (
+        "You are a machine vision engine. Output strict JSON only. "
+        f"Mode: {mode.upper()}. {_SCHEMAS.get(mode, _SCHEMAS['general'])} "
+        "Coordinates are pixels in the image size stated in the request."
+    )
+
+@functools.lru_cache(maxsize=64)
+def _supports_cache_control(model: str) -> bool:
+    if _provider_of(model) in _CACHE_CONTROL_PROVIDERS:
+        return True
+    try:
+        _litellm()
+        from litellm.utils import supports_prompt_caching
+        # OpenAI caches prefixes automatically; litellm strips the hint there
+        return bool(supports_prompt_caching(model)) and _provider_of(model) != "openai"
+    except Exception:
+        return False
+
+def _system_message(mode: str, cache_control: bool, compact: bool = False) -> Dict[str, Any]:
+    prompt = _system_prompt(mode, compact)
+    if not cache_control:
+        return {"role": "system", "content": prompt}
+    return {"role": "system", "content": [
+        {"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}
+    ]}
+
+def _record_usage(usage: Any):
+    """Tracks prompt tokens and the provider-reported cached-prefix share."""
+    if usage is None:
+        return
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) if details is not None else 0) or 0
+    cached = cached or getattr(usage, "cache_read_input_tokens", 0) or 0
+    if not isinstance(prompt, (int, float)) or not isinstance(cached, (int, float)):
+        return
+    _METRICS.incr("prompt.requests")
+    _METRICS.incr("prompt.tokens", prompt)
+    _METRICS.incr("prompt.cached_tokens", cached)
+    if cached:
+        _METRICS.incr("prompt.cache_hits")
+
+def _build_messages(data_url: str, mode: str, question: Optional[str], sent_size: Tuple[int, int],
+                   hint: Optional[str] = None, cache_control: Optional[bool] = None) -> List[Dict[str, Any]]:
+    """Static, cacheable system prefix first; everything per-request after it."""
+    compact = _compact_for(mode)
+    text = f"Image is {sent_size[0]}x{sent_size[1]}. "
+    if not compact:
+        text += "Coordinates must be relative to this size. "
+    if hint:
+        text += f"{hint} "
+    if mode == "query" and question:
+        text += f"Answer this question strictly based on the image: {question}"
+    else:
+        text += "Analyze."
+
+    if cache_control is None:
+        cache_control = _supports_cache_control(MODEL_NAME)
+    return [
+        _system_message(mode, cache_control, compact),
+        {"role": "user", "content": [
+            {"type": "text", "text": text},
+            {"type": "image_url", "image_url": {"url": data_url}}
+        ]}
+    ]
+
+def _parse_output(content: Any, mode: str, sent_size: Tuple[int, int]) -> Dict:
+    """Repaired JSON for a model reply, compact lines expanded; still in sent-image coordinates."""
+    # Pass raw content (string/list/none) directly to repair, which now handles normalization
+    result = _repair_json(content, REPAIR_MODEL)
+    if _compact_for(mode):
+        result = _expand_compact(result, mode, sent_size)
+    return result
+
+def _analyze_payload(data_url: str, mode: str, question: Optional[str], sent_size: Tuple[int, int],
+                     hint: Optional[str] = None) -> Dict:
+    """Prompts the model with an encoded image; returns repaired JSON in sent-image coordinates."""
+    # 4. Prompting
+    messages = _build_messages(data_url, mode, question, sent_size, hint)
+
+    # 5. Inference
+    try:
+        response = _hedged_completion(
+            messages,
+            temperature=0, 
+            top_p=1,
+            response_format={"type": "json_object"}
+        )
+    except Exception as e:
+        # Broad fallback for any provider rejection of structured outputs
+        msg = str(e).lower()
+        if _is_litellm_error(e, "UnsupportedParamsError") or any(
+                k in msg for k in ("response_format", "unsupported", "bad request", "invalid_request")):
+            response = _hedged_completion(messages, temperature=0, top_p=1)
+        else:
+            raise e
+    
+    # 6. Repair & Normalize
+    return _parse_output(response.choices[0].message.content, mode, sent_size)
+
+def _expand_compact(result: Dict, mode: str, sent_size: Tuple[int, int]) -> Dict:
+    """
+    Compact lines -> the regular text_blocks/elements envelope, with grid
+    coordinates (and any progressive "uncertain_regions") scaled to sent-image
+    pixels for _adjust_coordinates. The four
+    coordinates are split off the right, so "|" inside text survives. Rows
+    given as JSON arrays are accepted too; a missing or malformed bbox
+    becomes None. A reply already in the verbose schema is returned unchanged.
+    """
+    rows_key, items_key, fields = _COMPACT_FIELDS[mode]
+    if not isinstance(result, dict) or rows_key not in result:
+        return result
+    rows = result.get(rows_key) or []
+    if isinstance(rows, str):
+        rows = [line for line in rows.splitlines() if line.strip()]
+    sx, sy = sent_size[0] / COMPACT_GRID, sent_size[1] / COMPACT_GRID
+    items = []
+    for row in rows:
+        if isinstance(row, str):
+            head, *coords = row.rsplit("|", 4)
+            if len(coords) < 4:
+                head, coords = row, []
+            row = head.split("|", len(fields) - 1) + coords
+        if not isinstance(row, list) or not row:
+            continue
+        item = {name: ("" if value is None else str(value).strip()) for name, value in zip(fields, row)}
+        try:
+            x1, y1, x2, y2 = (float(v) for v in row[len(fields):len(fields) + 4])
+            item["bbox"] = [x1 * sx, y1 * sy, x2 * sx, y2 * sy]
+        except (TypeError, ValueError):
+            item["bbox"] = None
+        items.append(item)
+    expanded = {key: value for key, value in result.items() if key not in (rows_key, "u")}
+    expanded[items_key] = items
+    expanded["uncertainties"] = result.get("u", result.get("uncertainties", []))
+    if isinstance(result.get("uncertain_regions"), list):
+        # Progressive overviews flag regions on the same grid
+        expanded["uncertain_regions"] = [
+            [box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy]
+            for box in result["uncertain_regions"]
+            if isinstance(box, list) and len(box) == 4 and all(isinstance(v, (int, float)) for v in box)
+        ]
+    return expanded
+
+# --- PROGRESSIVE ANALYSIS ---
+_OVERVIEW_HINT = ("This is a reduced overview. Also return \"uncertain_regions\": [[x1,y1,x2,y2]] "
+                  "covering areas whose text or controls are too small or blurry to read.")
+
+def _progressive_analysis(img: Image.Image, region: Optional[List[int]], mode: str, question: Optional[str]):
+    """
+    Coarse-to-fine: one overview call at PROGRESSIVE_OVERVIEW_PX, then
+    concurrent full-resolution calls on the areas that need them (see
+    _progressive_regions). Items the overview found inside a re-read area are
+    replaced by the full-resolution ones. Everything is returned in original
+    coordinates, with (crop_bbox, sent_size) of the overview and a metadata
+    summary comparing the pixels sent against the full-resolution area.
+    """
+    data_url, _, orig_size, crop_bbox, sent_size = _process_image(img, region, mode, PROGRESSIVE_OVERVIEW_PX)
+    overview = _analyze_payload(data_url, mode, question, sent_size, _OVERVIEW_HINT)
+    del data_url
+    if "error" in overview:
+        return overview, crop_bbox, sent_size, {"overview_size": list(sent_size), "regions": []}
+    flagged = {"elements": [{"bbox": box} for box in overview.pop("uncertain_regions", None) or []
+                            if isinstance(box, list)]}
+    _adjust_coordinates(overview, crop_bbox, sent_size, orig_size)
+    _adjust_coordinates(flagged, crop_bbox, sent_size, orig_size)
+
+    key = "text_blocks" if mode == "ocr" else "elements"
+    scale = sent_size[0] / max(1, crop_bbox[2] - crop_bbox[0])
+    regions, skipped = _progressive_regions(overview.get(key) or [], [e["bbox"] for e in flagged["elements"]],
+                                            crop_bbox, scale, _max_dim(mode))
+    pixels = sent_size[0] * sent_size[1]
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max(1, PROGRESSIVE_WORKERS), thread_name_prefix="vision-region") as pool:
+        for box in regions:
+            sub_url, _, _, sub_crop, sub_size = _process_image(img, list(box), mode)
+            pixels += sub_size[0] * sub_size[1]
+            futures.append((box, _submit_in_context(pool, _analyze_region, sub_url, mode, question,
+                                                    sub_crop, sub_size, orig_size)))
+            del sub_url
+        refined, failed = [], 0
+        for box, future in futures:
+            try:
+                refined.append((box, future.result()))
+            except Exception:
+                failed += 1
+
+    def bbox_of(item):
+        bbox = item.get("bbox") if isinstance(item, dict) else None
+        return bbox if isinstance(bbox, list) and len(bbox) == 4 else None
+
+    def centre_in(item, box):
+        bbox = bbox_of(item)
+        return bbox is not None and box[0] <= (bbox[0] + bbox[2]) / 2 < box[2] and box[1] <= (bbox[1] + bbox[3]) / 2 < box[3]
+
+    items = [i for i in overview.get(key) or [] if not any(centre_in(i, box) for box, _ in refined)]
+    uncertainties = list(overview.get("uncertainties") or [])
+    for box, result in refined:
+        for item in result.get(key) or []:
+            # Neighbouring regions overlap by their margins; keep one copy
+            if centre_in(item, box) and not any(_iou(item["bbox"], bbox_of(o)) > 0.5 for o in items if bbox_of(o)):
+                items.append(item)
+        uncertainties += [u for u in result.get("uncertainties") or [] if u not in uncertainties]
+    overview[key] = items
+    overview["uncertainties"] = uncertainties
+
+    progress = {
+        "overview_size": list(sent_size),
+        "regions": [list(box) for box in regions],
+        "pixels_sent": pixels,
+        "full_resolution_pixels": (crop_bbox[2] - crop_bbox[0]) * (crop_bbox[3] - crop_bbox[1]),
+    }
+    if skipped:
+        progress["regions_skipped"] = skipped
+    if failed:
+        progress["regions_failed"] = failed
+    return overview, crop_bbox, sent_size, progress
+
+def _analyze_region(data_url: str, mode: str, question: Optional[str], crop_bbox: Tuple[int, int, int, int],
+                    sent_size: Tuple[int, int], orig_size: Tuple[int, int]) -> Dict:
+    result = _analyze_payload(data_url, mode, question, sent_size)
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    _adjust_coordinates(result, crop_bbox, sent_size, orig_size)
+    return result
+
+def _progressive_regions(items: List[Any], flagged: List[List[int]], crop_bbox: Tuple[int, int, int, int],
+                         scale: float, max_dim: int) -> Tuple[List[Tuple[int, int, int, int]], int]:
+    """
+    Full-resolution areas to re-read, in original coordinates: boxes the
+    model flagged as unreadable, items shorter than PROGRESSIVE_TINY_PX in the
+    overview, and overview cells holding PROGRESSIVE_DENSE_ITEMS or more item
+    centres. They are padded, merged, and split so each fits one unscaled
+    call. Returns the regions (largest first, at most PROGRESSIVE_MAX_REGIONS)
+    and how many were dropped by that cap.
+    """
+    x0, y0, x1, y1 = crop_bbox
+    boxes = [tuple(b) for b in flagged if len(b) == 4]
+    cell_w, cell_h = (x1 - x0) / PROGRESSIVE_CELLS, (y1 - y0) / PROGRESSIVE_CELLS
+    counts: Dict[Tuple[int, int], int] = {}
+    for item in items:
+        bbox = item.get("bbox") if isinstance(item, dict) else None
+        if not (isinstance(bbox, list) and len(bbox) == 4):
+            continue
+        if (bbox[3] - bbox[1]) * scale < PROGRESSIVE_TINY_PX:
+            boxes.append(tuple(bbox))
+        cell = (min(PROGRESSIVE_CELLS - 1, int(((bbox[0] + bbox[2]) / 2 - x0) / cell_w)),
+                min(PROGRESSIVE_CELLS - 1, int(((bbox[1] + bbox[3]) / 2 - y0) / cell_h)))
+        counts[cell] = counts.get(cell, 0) + 1
+    for (cx, cy), count in counts.items():
+        if count >= PROGRESSIVE_DENSE_ITEMS:
+            boxes.append((x0 + cx * cell_w, y0 + cy * cell_h, x0 + (cx + 1) * cell_w, y0 + (cy + 1) * cell_h))
+
+    margin = PROGRESSIVE_MARGIN_PX
+    padded = [(max(x0, int(b[0]) - margin), max(y0, int(b[1]) - margin),
+               min(x1, int(math.ceil(b[2])) + margin), min(y1, int(math.ceil(b[3])) + margin))
+              for b in boxes if b[2] > b[0] and b[3] > b[1]]
+    regions = []
+    for bx1, by1, bx2, by2 in _merge_boxes(padded, margin):
+        cols, rows = math.ceil((bx2 - bx1) / max_dim), math.ceil((by2 - by1) / max_dim)
+        for c in range(cols):
+            for r in range(rows):
+                regions.append((bx1 + (bx2 - bx1) * c // cols, by1 + (by2 - by1) * r // rows,
+                                bx1 + (bx2 - bx1) * (c + 1) // cols, by1 + (by2 - by1) * (r + 1) // rows))
+    regions.sort(key=_box_area, reverse=True)
+    return regions[:PROGRESSIVE_MAX_REGIONS], max(0, len(regions) - PROGRESSIVE_MAX_REGIONS)
+
+# --- CONTENT PRE-DETECTION ---
+def _edge_map(img: Image.Image, box: Tuple[int, int, int, int], size: Tuple[int, int]) -> Image.Image:
+    """Binary (0/255) edge image of `box`, box-filtered down to `size`."""
+    gray = img if img.mode == "L" else img.convert("RGB" if img.mode not in ("RGB", "RGBA") else img.mode)
+    gray = gray.resize(size, Image.Resampling.BOX, box=box, reducing_gap=2.0).convert("L")
+    edges = gray.filter(ImageFilter.FIND_EDGES).point(lambda v: 255 if v >= CONTENT_EDGE_THRESHOLD else 0)
+    # FIND_EDGES leaves a 1px frame of the input; ignore the outermost ring
+    edges.paste(0, (0, 0, edges.width, 1))
+    edges.paste(0, (0, edges.height - 1, edges.width, edges.height))
+    edges.paste(0, (0, 0, 1, edges.height))
+    edges.paste(0, (edges.width - 1, 0, edges.width, edges.height))
+    return edges
+
+def _connected_boxes(mask: Image.Image) -> List[Tuple[int, int, int, int]]:
+    """Bounding boxes (end-exclusive) of 8-connected non-zero regions of a mask."""
+    gw, gh = mask.size
+    occupied = mask.tobytes()
+    seen = bytearray(gw * gh)
+    boxes = []
+    for start in range(gw * gh):
+        if not occupied[start] or seen[start]:
+            continue
+        seen[start] = 1
+        stack = [start]
+        bx1, by1, bx2, by2 = gw, gh, 0, 0
+        while stack:
+            idx = stack.pop()
+            cy, cx = divmod(idx, gw)
+            bx1, by1, bx2, by2 = min(bx1, cx), min(by1, cy), max(bx2, cx), max(by2, cy)
+            for ny in (cy - 1, cy, cy + 1):
+                if not 0 <= ny < gh:
+                    continue
+                for nx in (cx - 1, cx, cx + 1):
+                    if 0 <= nx < gw:
+                        n = ny * gw + nx
+                        if occupied[n] and not seen[n]:
+                            seen[n] = 1
+                            stack.append(n)
+        boxes.append((bx1, by1, bx2 + 1, by2 + 1))
+    return boxes
+
+def _detect_content_boxes(img: Image.Image, crop_bbox: Tuple[int, int, int, int]) -> List[Tuple[int, int, int, int]]:
+    """
+    CPU-only pass that finds content (text, widgets, pictures) inside crop_bbox.
+    The area is reduced to an occupancy grid of at most CONTENT_GRID_CELLS
+    per side: edges are found at 4x grid resolution, any edge marks its cell,
+    cells are dilated by one so letters join into blocks, and 8-connected
+    components become boxes in original-image coordinates.
+    """
+    x0, y0, x1, y1 = crop_bbox
+    w, h = x1 - x0, y1 - y0
+    cell = max(2, math.ceil(max(w, h) / CONTENT_GRID_CELLS))
+    gw, gh = math.ceil(w / cell), math.ceil(h / cell)
+
+    edges = _edge_map(img, crop_bbox, (gw * 4, gh * 4))
+    grid = edges.reduce(4).point(lambda v: 255 if v else 0).filter(ImageFilter.MaxFilter(3))
+    return [
+        (x0 + bx1 * cell, y0 + by1 * cell, min(x1, x0 + bx2 * cell), min(y1, y0 + by2 * cell))
+        for bx1, by1, bx2, by2 in _connected_boxes(grid)
+    ]
+
+def _merge_boxes(boxes: List[Tuple[int, int, int, int]], gap: int) -> List[Tuple[int, int, int, int]]:
+    """Merges boxes that overlap or sit within `gap` pixels of each other."""
+    merged = list(boxes)
+    changed = True
+    while changed:
+        changed = False
+        out: List[Tuple[int, int, int, int]] = []
+        for box in merged:
+            for i, other in enumerate(out):
+                if (box[0] - gap < other[2] and other[0] - gap < box[2]
+                        and box[1] - gap < other[3] and other[1] - gap < box[3]):
+                    out[i] = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+                    changed = True
+                    break
+            else:
+                out.append(box)
+        merged = out
+    return merged
+
+def _box_area(box: Tuple[int, int, int, int]) -> int:
+    return max(0, box[2] - box[0]) * max(0, box[3] - box[1])
+
+def _background_color(img: Image.Image, crop_bbox: Tuple[int, int, int, int]) -> Any:
+    """Most common colour of a small thumbnail, used to fill mosaic gaps."""
+    thumb = img.resize((64, 64), Image.Resampling.BOX, box=crop_bbox)
+    return max(thumb.getcolors(64 * 64), key=lambda c: c[0])[1]
+
+def _build_mosaic(img: Image.Image, boxes: List[Tuple[int, int, int, int]], background: Any):
+    """
+    Shelf-packs content boxes (tallest first) into a compact canvas separated
+    by MOSAIC_GAP. Returns (canvas, tiles) where tiles are (source_box, canvas_box).
+    """
+    order = sorted(boxes, key=lambda b: (b[3] - b[1], b[2] - b[0]), reverse=True)
+    total = sum(_box_area(b) for b in order)
+    width = max(max(b[2] - b[0] for b in order), int(math.sqrt(total) * 1.2))
+    placements = []
+    x = y = shelf_h = 0
+    for box in order:
+        bw, bh = box[2] - box[0], box[3] - box[1]
+        if x and x + bw > width:
+            x, y, shelf_h = 0, y + shelf_h + MOSAIC_GAP, 0
+        placements.append((box, (x, y, x + bw, y + bh)))
+        x += bw + MOSAIC_GAP
+        shelf_h = max(shelf_h, bh)
+    height = y + shelf_h
+    canvas_w = max(dst[2] for _, dst in placements)
+    canvas = Image.new(img.mode, (canvas_w, height), background)
+    if img.palette is not None:
+        # Pasting copies indices only; without the source palette P/PA tiles come out greyscale
+        canvas.putpalette(img.palette)
+        if "transparency" in img.info:
+            canvas.info["transparency"] = img.info["transparency"]
+    for src, dst in placements:
+        canvas.paste(img.crop(src), dst[:2])
+    return canvas, placements
+
+def _plan_content_crop(img: Image.Image, region: Optional[List[int]], strategy: str) -> Dict[str, Any]:
+    """
+    Decides how much of the (region-cropped) image actually needs sending.
+    Returns {"region": [...]} for a tighter crop, {"canvas", "tiles"} for a
+    mosaic, or {} when cropping would not save enough pixels to matter.
+    """
+    crop_bbox = _clamp_region(region, img.size)
+    boxes = _detect_content_boxes(img, crop_bbox)
+    if not boxes:
+        return {}
+    union = (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+    if _box_area(union) >= 0.9 * _box_area(crop_bbox) and strategy == "crop":
+        return {}
+
+    if strategy == "mosaic":
+        cell = max(2, math.ceil(max(crop_bbox[2] - crop_bbox[0], crop_bbox[3] - crop_bbox[1]) / CONTENT_GRID_CELLS))
+        merged = _merge_boxes(boxes, cell)
+        if len(merged) > 1:
+            canvas, tiles = _build_mosaic(img, merged, _background_color(img, crop_bbox))
+            if canvas.width * canvas.height < 0.9 * _box_area(union):
+                return {"canvas": canvas, "tiles": tiles, "regions": [list(src) for src, _ in tiles]}
+        if _box_area(union) >= 0.9 * _box_area(crop_bbox):
+            return {}
+    return {"region": list(union), "regions": [list(union)]}
+
+# --- BOX REFINEMENT ---
+def _iou(a: Tuple[float, float, float, float], b: Tuple[float, float, float, float]) -> float:
+    inter = _box_area((max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])))
+    union = _box_area(a) + _box_area(b) - inter
+    return inter / union if union else 0.0
+
+def _refine_box(img: Image.Image, bbox: List[int]) -> Tuple[List[int], Dict[str, Any]]:
+    """
+    Snaps a model box to the visual component(s) it overlaps. A window around
+    the box (plus a margin proportional to its size) is edge-filtered at no
+    more than REFINE_WINDOW_PX, edges are dilated so glyphs and borders join,
+    and the union of components touching the box becomes the candidate.
+    The box moves there unless most of the candidate lies outside the model's
+    box (a larger panel, a neighbour). Confidence is the IoU between the
+    model's box and the candidate; a box with no edges inside is flagged empty.
+    """
+    x1, y1, x2, y2 = bbox
+    bw, bh = max(1, x2 - x1), max(1, y2 - y1)
+    margin = max(16, min(64, max(bw, bh) // 2))
+    window = (max(0, x1 - margin), max(0, y1 - margin), min(img.width, x2 + margin), min(img.height, y2 + margin))
+    ww, wh = window[2] - window[0], window[3] - window[1]
+    scale = min(1.0, REFINE_WINDOW_PX / max(ww, wh))
+    size = (max(3, round(ww * scale)), max(3, round(wh * scale)))
+    sx, sy = size[0] / ww, size[1] / wh
+
+    mask = _edge_map(img, window, size).filter(ImageFilter.MaxFilter(3))
+    inner = (int((x1 - window[0]) * sx), int((y1 - window[1]) * sy),
+             math.ceil((x2 - window[0]) * sx), math.ceil((y2 - window[1]) * sy))
+    if not mask.crop(inner).getbbox():
+        return bbox, {"confidence": 0.0, "empty": True}
+
+    # Components cut off by the window (not the image edge) have unknown extent
+    clipped = (window[0] > 0, window[1] > 0, window[2] < img.width, window[3] < img.height)
+    touching = [c for c in _connected_boxes(mask)
+                if c[0] < inner[2] and inner[0] < c[2] and c[1] < inner[3] and inner[1] < c[3]
+                and not (clipped[0] and c[0] <= 1 or clipped[1] and c[1] <= 1
+                         or clipped[2] and c[2] >= size[0] - 1 or clipped[3] and c[3] >= size[1] - 1)]
+    if not touching:
+        return bbox, {"confidence": 0.0, "empty": False}
+    cx1, cy1 = min(c[0] for c in touching), min(c[1] for c in touching)
+    cx2, cy2 = max(c[2] for c in touching), max(c[3] for c in touching)
+    # Dilation grew components by one cell on each side; take it back
+    candidate = [
+        max(window[0], round(window[0] + (cx1 + 1) / sx)),
+        max(window[1], round(window[1] + (cy1 + 1) / sy)),
+        min(window[2], round(window[0] + (cx2 - 1) / sx)),
+        min(window[3], round(window[1] + (cy2 - 1) / sy)),
+    ]
+    if candidate[2] <= candidate[0] or candidate[3] <= candidate[1]:
+        return bbox, {"confidence": 0.0, "empty": False}
+    iou = _iou(tuple(bbox), tuple(candidate))
+    inside = _box_area((max(x1, candidate[0]), max(y1, candidate[1]), min(x2, candidate[2]), min(y2, candidate[3])))
+    if inside < REFINE_MIN_COVERAGE * _box_area(tuple(candidate)):
+        return bbox, {"confidence": round(iou, 3), "empty": False}
+    return candidate, {"confidence": round(iou, 3), "empty": False, "model_bbox": list(bbox)}
+
+def _refine_result(result: Dict, img: Image.Image) -> Dict[str, int]:
+    """Refines every bbox of elements/text_blocks in place; returns counts for metadata."""
+    stats = {"boxes": 0, "moved": 0, "empty": 0}
+    for key in ("elements", "text_blocks"):
+        for item in result.get(key) or []:
+            bbox = item.get("bbox") if isinstance(item, dict) else None
+            if not (isinstance(bbox, list) and len(bbox) == 4 and all(isinstance(v, (int, float)) for v in bbox)):
+                continue
+            if bbox[2] <= bbox[0] or bbox[3] <= bbox[1]:
+                continue
+            refined, info = _refine_box(img, [int(v) for v in bbox])
+            item["bbox"] = refined
+            item["refinement"] = info
+            stats["boxes"] += 1
+            stats["moved"] += "model_bbox" in info and refined != info["model_bbox"]
+            stats["empty"] += info["empty"]
+    _METRICS.incr("refine.boxes", stats["boxes"])
+    _METRICS.incr("refine.empty", stats["empty"])
+    return stats
+
+# --- MULTI-FRAME IMAGES ---
+def _select_frames(spec: Union[str, List[int]], n_frames: int, unit: str = "frame") -> List[int]:
+    """Resolves a frames (or PDF pages) argument ('all' or indices) against the count."""
+    if isinstance(spec, str):
+        if spec != "all":
+            raise ValueError(f"Invalid {unit}s '{spec}'. Use 'all' or a list of {unit} indices.")
+        indices = list(range(n_frames))
+    else:
+        indices = sorted({int(i) for i in spec})
+        if not indices:
+            raise ValueError(f"No {unit}s requested. Use 'all' or a list of {unit} indices.")
+        bad = [i for i in indices if not 0 <= i < n_frames]
+        if bad:
+            raise ValueError(f"{unit.capitalize()} indices {bad} out of range ({n_frames} {unit}s)")
+    if len(indices) > MAX_FRAMES:
+        raise ValueError(f"Too many {unit}s requested ({len(indices)} > {MAX_FRAMES})")
+    return indices
+
+def _frame_image(frame: Image.Image) -> Image.Image:
+    """Detached copy of the current frame (the sequence iterator reuses one object)."""
+    if frame.mode in ("1", "L", "RGB", "RGBA"):
+        return frame.copy()
+    if frame.mode in ("LA", "PA") or "transparency" in frame.info:
+        return frame.convert("RGBA")
+    return frame.convert("RGB")
+
+def _submit_in_context(executor: ThreadPoolExecutor, fn, *args) -> Future:
+    """Runs fn on the executor under a copy of the caller's context (priority, deadline)."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def _analyze_frame(index: int, data_url: str, mode: str, question: Optional[str],
+                   crop_bbox: Tuple[int, int, int, int], sent_size: Tuple[int, int],
+                   orig_size: Tuple[int, int], frame_key: str) -> Dict[str, Any]:
+    content = _analyze_payload(data_url, mode, question, sent_size)
+    _adjust_coordinates(content, crop_bbox, sent_size, orig_size)
+    entry = {
+        "index": index,
+        "original_size": {"width": orig_size[0], "height": orig_size[1]},
+        "sent_size": {"width": sent_size[0], "height": sent_size[1]},
+        "content": content,
+    }
+    if "error" not in content:
+        _CACHE.set(frame_key, entry)
+    return entry
+
+def _examine_frames(path: str, source: Union[OpenFile, bytes], cache_key_str: str, mode: str, question: Optional[str],
+                    region: Optional[List[int]], frames: Union[str, List[int]],
+                    content_hash: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Analyzes frames of a multi-frame image (paged TIFF, animated GIF/WebP, ICO).
+    Frames are decoded one at a time, consecutive identical frames are skipped,
+    and each distinct frame is sent to the model as soon as it is encoded, so
+    only in-flight payloads are held in memory. Each frame is cached on its own.
+    """
+    cache_key = _cache_key(f"{cache_key_str}|frames={json.dumps(frames)}")
+    cached = _CACHE.get(cache_key)
+    if cached: return cached
+
+    results: Dict[int, Dict[str, Any]] = {}
+    futures: Dict[int, Future] = {}
+    in_flight = threading.BoundedSemaphore(FRAME_WORKERS * 2)
+    with _open_image(source) as src, ThreadPoolExecutor(max_workers=FRAME_WORKERS, thread_name_prefix="vision-frame") as pool:
+        n_frames = getattr(src, "n_frames", 1)
+        wanted = _select_frames(frames, n_frames)
+        wanted_set = set(wanted)
+        prev_digest, prev_index = None, None
+        for index, frame in enumerate(ImageSequence.Iterator(src)):
+            if index > wanted[-1]:
+                break
+            if index not in wanted_set:
+                # Identical-frame dedupe is about consecutive *analyzed* frames
+                prev_digest = None
+                continue
+            img = _exif_transpose(_frame_image(frame))
+            digest = hashlib.blake2b(img.tobytes(), digest_size=16)
+            digest.update(repr((img.mode, img.size)).encode())
+            digest = digest.digest()
+            if digest == prev_digest:
+                results[index] = {"index": index, "duplicate_of": prev_index}
+                continue
+            prev_digest, prev_index = digest, index
+
+            frame_key = hashlib.md5(f"{cache_key_str}|frame={index}".encode()).hexdigest()
+            hit = _CACHE.get(frame_key)
+            if hit:
+                results[index] = hit
+                continue
+            data_url, _, orig_size, crop_bbox, sent_size = _process_image(img, region, mode)
+            del img
+            in_flight.acquire()
+            future = _submit_in_context(pool, _analyze_frame, index, data_url, mode, question,
+                                        crop_bbox, sent_size, orig_size, frame_key)
+            future.add_done_callback(lambda _f: in_flight.release())
+            futures[index] = future
+            del data_url
+
+        for index, future in futures.items():
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                results[index] = {"index": index, "error": str(e)}
+
+    envelope = {
+        "mode": mode,
+        "metadata": {
+            "original_path": path,
+            "frame_count": n_frames,
+            "frames_requested": len(wanted),
+            "frames_analyzed": len(futures),
+            "crop_bbox": list(region) if region else None,
+            "prompt_version": PROMPT_VERSION
+        },
+        "frames": [results[i] for i in wanted],
+    }
+    if content_hash:
+        envelope["metadata"]["content_hash"] = content_hash
+    if not any("error" in r or "error" in r.get("content", {}) for r in envelope["frames"]):
+        _CACHE.set(cache_key, envelope)
+    _index_envelope(source if isinstance(source, OpenFile) else path, envelope, region, content_hash)
+    return envelope
+
+# --- VIDEO KEYFRAMES ---
+def _frame_signature(small: Image.Image) -> Tuple[int, List[float]]:
+    """(dHash, 32-bin luma histogram) of a small grayscale frame."""
+    hist = small.histogram()
+    bins = [sum(hist[i:i + 8]) for i in range(0, 256, 8)]
+    total = float(sum(bins)) or 1.0
+    return _dhash(small, (0, 0) + small.size), [b / total for b in bins]
+
+def _scene_delta(a: Tuple[int, List[float]], b: Tuple[int, List[float]]) -> float:
+    """0..1 scene-change score: the larger of layout (dHash) and tone (histogram) change."""
+    hash_delta = (a[0] ^ b[0]).bit_count() / NEAR_DUP_HASH_BITS
+    hist_delta = sum(abs(x - y) for x, y in zip(a[1], b[1])) / 2
+    return max(hash_delta, hist_delta)
+
+def _extract_keyframes(source: OpenFile, max_keyframes: int, threshold: float,
+                       sample_fps: float) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Samples frames at `sample_fps` and keeps one whenever it differs from the
+    last keyframe by at least `threshold`. Only a 64x36 grayscale thumbnail is
+    made per sample; full frames are converted just for keyframes. When more
+    scenes than `max_keyframes` turn up, the weakest changes are dropped. The
+    clip is demuxed from the validated descriptor, never reopened by path.
+    """
+    try:
+        import av
+    except ImportError:
+        raise RuntimeError("Video support needs PyAV: pip install 'mcp-eyes-8k[video]'")
+
+    keyframes: List[Dict[str, Any]] = []
+    last_sig = None
+    sampled = 0
+    next_sample = 0.0
+    with av.open(source.reader()) as container:
+        if not container.streams.video:
+            raise ValueError("No video stream found")
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        rate = float(stream.average_rate or 30)
+        duration = float(container.duration / 1_000_000) if container.duration else None
+        for index, frame in enumerate(container.decode(stream)):
+            t = float(frame.time) if frame.time is not None else index / rate
+            if t + 1e-6 < next_sample:
+                continue
+            next_sample = t + 1.0 / sample_fps
+            sampled += 1
+            if sampled > VIDEO_MAX_SAMPLES:
+                break
+            sig = _frame_signature(frame.reformat(width=64, height=36, format="gray").to_image())
+            score = 1.0 if last_sig is None else _scene_delta(sig, last_sig)
+            if last_sig is not None and score < threshold:
+                continue
+            keyframes.append({"timestamp": round(t, 3), "frame": index, "scene_score": round(score, 3),
+                              "image": frame.to_image()})
+            last_sig = sig
+            if len(keyframes) > max_keyframes:
+                # Keep the opening frame and the strongest scene changes
+                weakest = min(range(1, len(keyframes)), key=lambda i: keyframes[i]["scene_score"])
+                keyframes.pop(weakest)
+    return keyframes, {"duration": duration, "frames_sampled": min(sampled, VIDEO_MAX_SAMPLES)}
+
+@_run_tool_in_thread
+def examine_video(
+    path: str,
+    mode: str = "general",
+    question: Optional[str] = None,
+    region: Optional[List[int]] = None,
+    max_keyframes: int = 8,
+    scene_threshold: Optional[float] = None,
+    sample_fps: Optional[float] = None,
+    priority: str = "normal",
+    deadline_ms: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Analyzes a video or screen recording (MP4, WebM, ...) via its keyframes.
+
+    Frames are sampled and keyframes picked by scene-change detection; only the
+    keyframes are sent to the model, concurrently. Returns timestamped results.
+
+    Args:
+        path: Absolute local path.
+        mode: 'ui', 'ocr', 'general' or 'query', applied to each keyframe.
+        question: Required if mode='query'.
+        region: [x1, y1, x2, y2] pixel crop applied to every keyframe.
+        max_keyframes: Upper bound on keyframes sent to the model.
+        scene_threshold: 0..1 change needed to start a new keyframe (default 0.25).
+        sample_fps: Frames per second examined for scene changes (default 2).
+        priority: 'interactive', 'normal' or 'bulk'.
+        deadline_ms: Drop the request if it cannot reach the model within this many ms.
+    """
+    if priority not in PRIORITY_CLASSES:
+        return {"error": f"Invalid priority '{priority}'. Allowed: {list(PRIORITY_CLASSES)}", "path": path}
+    with _request_scope(priority, deadline_ms):
+        try:
+            if mode not in ALLOWED_MODES:
+                return {"error": f"Invalid mode '{mode}'. Allowed: {sorted(list(ALLOWED_MODES))}", "path": path}
+            if mode == "query" and not question:
+                return {"error": "Parameter 'question' is required when mode='query'", "path": path}
+            if not 1 <= max_keyframes <= MAX_FRAMES:
+                return {"error": f"max_keyframes must be between 1 and {MAX_FRAMES}", "path": path}
+            threshold = SCENE_CHANGE_THRESHOLD if scene_threshold is None else float(scene_threshold)
+            fps = VIDEO_SAMPLE_FPS if sample_fps is None else float(sample_fps)
+            if not fps > 0:
+                return {"error": "sample_fps must be greater than 0", "path": path}
+            if not 0 < threshold <= 1:
+                return {"error": "scene_threshold must be greater than 0 and at most 1", "path": path}
+
+            with _open_validated(path, MAX_VIDEO_SIZE_MB) as opened:
+                safe_path, mtime = opened.path, opened.mtime
+                region_norm = [int(c) for c in region] if region else None
+
+                cache_key_str = (f"{safe_path}|{mtime}|{mode}|{question}|{json.dumps(region_norm)}|{_prompt_version(mode)}"
+                                 f"|video|{max_keyframes}|{threshold}|{fps}")
+                cache_key = hashlib.md5(cache_key_str.encode()).hexdigest()
+                cached = _CACHE.get(cache_key)
+                if cached: return cached
+
+                keyframes, stats = _extract_keyframes(opened, max_keyframes, threshold, fps)
+
+                results = []
+                with ThreadPoolExecutor(max_workers=FRAME_WORKERS, thread_name_prefix="vision-frame") as pool:
+                    futures = []
+                    for kf in keyframes:
+                        data_url, _, orig_size, crop_bbox, sent_size = _process_image(kf.pop("image"), region_norm, mode)
+                        frame_key = hashlib.md5(f"{cache_key_str}|frame={kf['frame']}".encode()).hexdigest()
+                        futures.append((kf, _submit_in_context(pool, _analyze_frame, kf["frame"], data_url, mode,
+                                                               question, crop_bbox, sent_size, orig_size, frame_key)))
+                        del data_url
+                    for kf, future in futures:
+                        try:
+                            entry = dict(future.result())
+                        except Exception as e:
+                            entry = {"error": str(e)}
+                        entry.pop("index", None)
+                        results.append({**kf, **entry})
+
+                envelope = {
+                    "mode": mode,
+                    "metadata": {
+                        "original_path": path,
+                        "duration": stats["duration"],
+                        "frames_sampled": stats["frames_sampled"],
+                        "keyframes": len(results),
+                        "scene_threshold": threshold,
+                        "crop_bbox": region_norm,
+                        "prompt_version": PROMPT_VERSION
+                    },
+                    "keyframes": results,
+                }
+                if not any("error" in r or "error" in r.get("content", {}) for r in results):
+                    _CACHE.set(cache_key, envelope)
+                _index_envelope(opened, envelope, region_norm)
+                return envelope
+
+        except Exception as e:
+            return {"error": str(e), "path": path}
+
+# --- PDF DOCUMENTS ---
+# pdfium is not thread-safe: every call into it, including closing its objects, holds this lock
+_PDFIUM_LOCK = threading.Lock()
+
+def _pdfium():
+    try:
+        import pypdfium2
+    except ImportError:
+        raise RuntimeError("PDF support needs pypdfium2: pip install 'mcp-eyes-8k[pdf]'")
+    return pypdfium2
+
+def _is_pdf(source: Union[OpenFile, bytes, None]) -> bool:
+    if isinstance(source, OpenFile):
+        return source.pread(5, 0) == b"%PDF-"
+    return isinstance(source, bytes) and source.startswith(b"%PDF-")
+
+def _pdf_dpi(box: Tuple[float, float, float, float], mode: str) -> int:
+    """DPI at which the box (in points) fills the mode's max_dim, within the PDF DPI bounds."""
+    long_side = max(box[2] - box[0], box[3] - box[1], 1)
+    return int(min(PDF_MAX_DPI, max(PDF_MIN_DPI, _max_dim(mode) * 72 / long_side)))
+
+def _pdf_text_blocks(pdfium, page, size: Tuple[float, float],
+                     box: Tuple[float, float, float, float]) -> Optional[List[Dict[str, Any]]]:
+    """
+    The text layer's lines whose centre lies in box, as ocr text_blocks in
+    points from the top-left; None when the page has no text or the box is
+    mostly covered by images (a scan, whose text layer may be partial).
+    """
+    height = size[1]
+    covered = 0.0
+    for obj in page.get_objects(filter=[pdfium.raw.FPDF_PAGEOBJ_IMAGE]):
+        left, bottom, right, top = obj.get_bounds()
+        covered += (max(0.0, min(right, box[2]) - max(left, box[0])) *
+                    max(0.0, min(height - bottom, box[3]) - max(height - top, box[1])))
+    if covered >= PDF_SCANNED_COVERAGE * (box[2] - box[0]) * (box[3] - box[1]):
+        return None
+    textpage = page.get_textpage()
+    try:
+        if not textpage.count_chars():
+            return None
+        blocks = []
+        for i in range(textpage.count_rects()):
+            left, bottom, right, top = textpage.get_rect(i)
+            bbox = [left, height - top, right, height - bottom]
+            if not (box[0] <= (bbox[0] + bbox[2]) / 2 < box[2] and box[1] <= (bbox[1] + bbox[3]) / 2 < box[3]):
+                continue
+            text = textpage.get_text_bounded(left, bottom, right, top).strip()
+            if text:
+                blocks.append({"text": text, "bbox": [int(round(c)) for c in bbox]})
+        return blocks
+    finally:
+        textpage.close()
+
+def _page_entry(index: int, size: Tuple[float, float], content: Dict[str, Any], dpi: Optional[int] = None,
+                sent_size: Optional[Tuple[int, int]] = None) -> Dict[str, Any]:
+    entry = {"index": index, "page_size": {"width": round(size[0], 2), "height": round(size[1], 2)},
+             "source": "model" if dpi else "text_layer"}
+    if dpi:
+        entry["dpi"] = dpi
+        entry["sent_size"] = {"width": sent_size[0], "height": sent_size[1]}
+    entry["content"] = content
+    return entry
+
+def _analyze_page(index: int, data_url: str, mode: str, question: Optional[str],
+                  box: Tuple[float, float, float, float], sent_size: Tuple[int, int],
+                  size: Tuple[float, float], dpi: int, page_key: str) -> Dict[str, Any]:
+    content = _analyze_payload(data_url, mode, question, sent_size)
+    # The rendered image is exactly the box, so sent pixels map straight to points
+    _adjust_coordinates(content, box, sent_size, size)
+    entry = _page_entry(index, size, content, dpi, sent_size)
+    if "error" not in content:
+        _CACHE.set(page_key, entry)
+    return entry
+
+def _examine_pdf(path: str, source: Union[OpenFile, bytes], file_hash: str, cache_key: str, mode: str,
+                 question: Optional[str], region: Optional[List[int]], pages: Optional[Union[str, List[int]]],
+                 content_hash: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Analyzes pages of a PDF (the first unless `pages` says otherwise). Only the
+    requested pages are loaded, and only the region of each is rasterized, at
+    the DPI that makes it fill the mode's max_dim. Pages go to the model
+    concurrently as they are rendered, and each is cached by content hash,
+    page and DPI. With ocr, a page's embedded text layer answers without a
+    model call. Region and results are in PDF points from the page's top-left.
+    """
+    pdfium = _pdfium()
+    key_base = f"sha256:{file_hash}|{mode}|{question}|{json.dumps(region)}|{_prompt_version(mode)}"
+    results: Dict[int, Dict[str, Any]] = {}
+    futures: Dict[int, Future] = {}
+    in_flight = threading.BoundedSemaphore(FRAME_WORKERS * 2)
+    with ThreadPoolExecutor(max_workers=FRAME_WORKERS, thread_name_prefix="vision-page") as pool:
+        with _PDFIUM_LOCK:
+            document = pdfium.PdfDocument(source.reader() if isinstance(source, OpenFile) else source)
+        try:
+            n_pages = len(document)
+            wanted = _select_frames([0] if pages is None else pages, n_pages, "page")
+            for index in wanted:
+                img = None
+                with _PDFIUM_LOCK:
+                    page = document[index]
+                    try:
+                        size = page.get_size()
+                        box = _clamp_region(region, size)
+                        if mode == "ocr" and PDF_TEXT_LAYER:
+                            text_key = hashlib.md5(f"{key_base}|page={index}|text".encode()).hexdigest()
+                            results[index] = _CACHE.get(text_key)
+                            if not results[index]:
+                                blocks = _pdf_text_blocks(pdfium, page, size, box)
+                                if blocks is not None:
+                                    results[index] = _page_entry(index, size, {"text_blocks": blocks, "uncertainties": []})
+                                    _CACHE.set(text_key, results[index])
+                            if results[index]:
+                                _METRICS.incr("pdf.text_layer_pages")
+                                continue
+                        dpi = _pdf_dpi(box, mode)
+                        page_key = hashlib.md5(f"{key_base}|page={index}|dpi={dpi}".encode()).hexdigest()
+                        results[index] = _CACHE.get(page_key)
+                        if results[index]:
+                            continue
+                        bitmap = page.render(scale=dpi / 72, crop=(box[0], size[1] - box[3], size[0] - box[2], box[1]))
+                        img = bitmap.to_pil()
+                        bitmap.close()
+                    finally:
+                        page.close()
+                _METRICS.incr("pdf.rendered_pages")
+                data_url, _, _, _, sent_size = _process_image(img, None, mode)
+                del img
+                in_flight.acquire()
+                future = _submit_in_context(pool, _analyze_page, index, data_url, mode, question,
+                                            box, sent_size, size, dpi, page_key)
+                future.add_done_callback(lambda _f: in_flight.release())
+                futures[index] = future
+                del data_url
+        finally:
+            with _PDFIUM_LOCK:
+                document.close()
+
+        for index, future in futures.items():
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                results[index] = {"index": index, "error": str(e)}
+
+    envelope = {
+        "mode": mode,
+        "metadata": {
+            "original_path": path,
+            "page_count": n_pages,
+            "pages_requested": len(wanted),
+            "pages_analyzed": len(futures),
+            "pages_from_text_layer": sum(1 for i in wanted if results[i].get("source") == "text_layer"),
+            "crop_bbox": list(region) if region else None,
+            "prompt_version": PROMPT_VERSION
+        },
+        "pages": [results[i] for i in wanted],
+    }
+    if content_hash:
+        envelope["metadata"]["content_hash"] = content_hash
+    if not any("error" in r or "error" in r.get("content", {}) for r in envelope["pages"]):
+        _CACHE.set(cache_key, envelope)
+    _index_envelope(source if isinstance(source, OpenFile) else path, envelope, region, file_hash)
+    return envelope
+
+# --- SPATIAL QUERIES ---
+_SPATIAL_KINDS = {"ui": ("elements", "label"), "ocr": ("text_blocks", "text")}
+
+class SpatialIndex:
+    """
+    Uniform grid over the boxes of one ui/ocr result, sized for about one box
+    per cell, so point and region queries only test nearby boxes.
+    """
+    def __init__(self, items: List[Dict[str, Any]], size: Tuple[int, int], label_field: str):
+        self.label_field = label_field
+        self.items = []
+        self.boxes = []
+        for item in items:
+            bbox = item.get("bbox") if isinstance(item, dict) else None
+            if isinstance(bbox, list) and len(bbox) == 4 and bbox[2] > bbox[0] and bbox[3] > bbox[1]:
+                self.items.append(item)
+                self.boxes.append(tuple(bbox))
+        self.cell = max(16, int(math.sqrt(size[0] * size[1] / max(len(self.items), 1))))
+        self.grid: Dict[Tuple[int, int], List[int]] = {}
+        for i, box in enumerate(self.boxes):
+            for key in self._cells(box):
+                self.grid.setdefault(key, []).append(i)
+
+    def _cells(self, box: Tuple[float, float, float, float]):
+        c = self.cell
+        for gx in range(int(box[0] // c), int(box[2] // c) + 1):
+            for gy in range(int(box[1] // c), int(box[3] // c) + 1):
+                yield (gx, gy)
+
+    def at(self, x: float, y: float) -> List[int]:
+        """Boxes containing the point, innermost (smallest) first."""
+        hits = [i for i in self.grid.get((int(x // self.cell), int(y // self.cell)), [])
+                if self.boxes[i][0] <= x <= self.boxes[i][2] and self.boxes[i][1] <= y <= self.boxes[i][3]]
+        return sorted(hits, key=lambda i: _box_area(self.boxes[i]))
+
+    def within(self, region: Tuple[float, float, float, float], contained: bool = False) -> List[int]:
+        """Boxes overlapping (or, with `contained`, entirely inside) the region, in reading order."""
+        candidates = set()
+        for key in self._cells(region):
+            candidates.update(self.grid.get(key, ()))
+        hits = []
+        for i in candidates:
+            b = self.boxes[i]
+            if contained:
+                ok = b[0] >= region[0] and b[1] >= region[1] and b[2] <= region[2] and b[3] <= region[3]
+            else:
+                ok = b[0] < region[2] and b[2] > region[0] and b[1] < region[3] and b[3] > region[1]
+            if ok:
+                hits.append(i)
+        return sorted(hits, key=lambda i: (self.boxes[i][1], self.boxes[i][0]))
+
+_SPATIAL = TTLCache(CACHE_MAX_SIZE, CACHE_TTL)
+
+class _SpatialUnavailable(Exception):
+    """Carries examine_image's error reply when no result could be produced."""
+
+def _spatial_lookup(path: Optional[str], mode: Optional[str]) -> Tuple[Dict[str, Any], SpatialIndex, str]:
+    """
+    The whole-image ui/ocr result for path and its spatial index. A cached
+    result is preferred (ui before ocr when mode is None); only when there is
+    none is the image analyzed, in `mode` or 'ui'.
+    """
+    if mode is not None and mode not in _SPATIAL_KINDS:
+        raise ValueError(f"Invalid mode '{mode}'. Allowed: {sorted(_SPATIAL_KINDS)}")
+    source, _, _, identity = _resolve_source(path, None, None)
+    if isinstance(source, OpenFile):
+        source.close()
+    envelope, origin = None, "cache"
+    for candidate in ([mode] if mode else list(_SPATIAL_KINDS)):
+        cache_key = _cache_key(_cache_key_base(identity, candidate, None, None))
+        envelope = _CACHE.get(cache_key)
+        if envelope:
+            break
+    if not envelope:
+        candidate, origin = mode or "ui", "inference"
+        envelope = _examine(path, candidate, None, None)
+        if "error" in envelope:
+            raise _SpatialUnavailable(envelope)
+        cache_key = _cache_key(_cache_key_base(identity, candidate, None, None))
+    _METRICS.incr(f"spatial.{origin}")
+
+    content = envelope.get("content") or {}
+    entry = _SPATIAL.get(cache_key)
+    if entry is None or entry[0] != content:
+        meta = envelope.get("metadata", {}).get("original_size") or {}
+        items_field, label_field = _SPATIAL_KINDS[candidate]
+        size = (meta.get("width", 1), meta.get("height", 1))
+        entry = (content, SpatialIndex(content.get(items_field) or [], size, label_field))
+        _SPATIAL.set(cache_key, entry)
+    return envelope, entry[1], origin
+
+def _label_similarity(wanted: str, text: str) -> float:
+    """
+    0-1 similarity of normalized labels: the whole label, or (scaled by how
+    much of the label it covers) its best run of as many words as `wanted`.
+    """
+    score = difflib.SequenceMatcher(None, wanted, text).ratio()
+    words, n = text.split(), len(wanted.split())
+    for i in range(len(words) - n + 1):
+        window = " ".join(words[i:i + n])
+        partial = difflib.SequenceMatcher(None, wanted, window).ratio()
+        score = max(score, partial * (0.8 + 0.2 * len(window) / len(text)))
+    return score
+
+def _spatial_item(index: SpatialIndex, i: int, **extra) -> Dict[str, Any]:
+    x1, y1, x2, y2 = index.boxes[i]
+    return {**index.items[i], "center": [int((x1 + x2) // 2), int((y1 + y2) // 2)], **extra}
+
+def _spatial_tool(path: Optional[str], mode: Optional[str], query) -> Dict[str, Any]:
+    """Runs a query against the spatial index; errors become {"error": ...}."""
+    try:
+        start = time.perf_counter()
+        envelope, index, origin = _spatial_lookup(path, mode)
+        matches = query(index)
+        elapsed = time.perf_counter() - start
+        return {"path": path, "mode": envelope["mode"], "source": origin, "matches": matches,
+                "elapsed_ms": round(elapsed * 1000, 3)}
+    except _SpatialUnavailable as e:
+        return e.args[0]
+    except Exception as e:
+        return {"error": str(e), "path": path}
+
+@_run_tool_in_thread
+def element_at(path: str, x: int, y: int, mode: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Returns the UI elements (or OCR text blocks) under a pixel, innermost first.
+    Answers from the cached analysis of the whole image; the image is only
+    sent to the model when it has not been analyzed yet.
+
+    Args:
+        path: Image path (or image://sha256/<hash>), as given to examine_image.
+        x: Pixel column in the original image.
+        y: Pixel row in the original image.
+        mode: 'ui' or 'ocr'; default uses whichever is cached (ui first).
+    """
+    return _spatial_tool(path, mode, lambda index: [_spatial_item(index, i) for i in index.at(x, y)])
+
+@_run_tool_in_thread
+def elements_in_region(path: str, region: List[int], contained: bool = False,
+                       mode: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Returns the UI elements (or OCR text blocks) in a region, in reading order,
+    from the cached analysis of the whole image (analyzed first if needed).
+
+    Args:
+        path: Image path (or image://sha256/<hash>), as given to examine_image.
+        region: [x1, y1, x2, y2] in original image pixels.
+        contained: Only boxes entirely inside the region (default: any overlap).
+        mode: 'ui' or 'ocr'; default uses whichever is cached (ui first).
+    """
+    if not region or len(region) != 4 or region[2] <= region[0] or region[3] <= region[1]:
+        return {"error": f"Invalid region {region}; expected [x1, y1, x2, y2]", "path": path}
+    box = tuple(float(c) for c in region)
+    return _spatial_tool(path, mode, lambda index: [_spatial_item(index, i) for i in index.within(box, contained)])
+
+@_run_tool_in_thread
+def find_element(path: str, label: str, fuzzy: bool = True, element_type: Optional[str] = None,
+                 mode: Optional[str] = None, limit: int = 5) -> Dict[str, Any]:
+    """
+    Finds UI elements by label (or OCR text blocks by text), best match first,
+    each with its bbox and a 'center' point to click. Answers from the cached
+    analysis of the whole image (analyzed first if needed).
+
+    Args:
+        path: Image path (or image://sha256/<hash>), as given to examine_image.
+        label: Text to look for, e.g. 'Save'. Case and spacing are ignored.
+        fuzzy: Also accept near matches and labels containing the text,
+            scored 0-1; otherwise the label must match exactly.
+        element_type: Only UI elements of this type, e.g. 'button'.
+        mode: 'ui' or 'ocr'; default uses whichever is cached (ui first).
+        limit: Maximum matches returned.
+    """
+    if not label or not label.strip():
+        return {"error": "Parameter 'label' must not be empty", "path": path}
+    wanted = " ".join(label.lower().split())
+
+    def query(index: SpatialIndex) -> List[Dict[str, Any]]:
+        scored = []
+        for i, item in enumerate(index.items):
+            if element_type is not None and str(item.get("type", "")).lower() != element_type.lower():
+                continue
+            text = " ".join(str(item.get(index.label_field) or "").lower().split())
+            if text == wanted:
+                score = 1.0
+            elif not fuzzy or not text:
+                continue
+            else:
+                score = _label_similarity(wanted, text)
+                if score < SPATIAL_FUZZY_CUTOFF:
+                    continue
+            scored.append((score, i))
+        scored.sort(key=lambda pair: (-pair[0], index.boxes[pair[1]][1], index.boxes[pair[1]][0]))
+        return [_spatial_item(index, i, score=round(score, 3)) for score, i in scored[:max(1, int(limit))]]
+
+    return _spatial_tool(path, mode, query)
+
+# --- BATCH JOBS ---
+_BATCH_JOB_ID = re.compile(r"^batch-[0-9a-f]{16}$")
+_BATCH_TERMINAL = {"completed", "failed", "expired", "cancelled"}
+
+class BatchJobStore:
+    """
+    Batch job state, one JSON file per job replaced atomically on every change,
+    so a restarted server picks polling up where it stopped. Applied results
+    are appended to <job>.results.jsonl beside it; the in-memory cache is far
+    too small to be the only copy of a large job.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.Lock()
+        self.job_locks: Dict[str, threading.Lock] = {}
+
+    def path(self, job_id: str, suffix: str = ".json") -> str:
+        if not _BATCH_JOB_ID.match(job_id or ""):
+            raise ValueError(f"Invalid batch job id '{job_id}'")
+        return os.path.join(self.root, job_id + suffix)
+
+    def job_lock(self, job_id: str) -> threading.Lock:
+        with self.lock:
+            return self.job_locks.setdefault(job_id, threading.Lock())
+
+    def load(self, job_id: str) -> Dict[str, Any]:
+        try:
+            with open(self.path(job_id), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise ValueError(f"Unknown batch job '{job_id}'")
+
+    def save(self, job: Dict[str, Any]):
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(job["id"])
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job, f)
+        os.replace(tmp, path)
+
+    def append_results(self, job_id: str, envelopes: List[Dict[str, Any]]):
+        if envelopes:
+            with open(self.path(job_id, ".results.jsonl"), "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(e) + "\n" for e in envelopes)
+
+    def read_results(self, job_id: str, offset: int, limit: int) -> List[Dict[str, Any]]:
+        try:
+            with open(self.path(job_id, ".results.jsonl"), encoding="utf-8") as f:
+                return [json.loads(line) for line in itertools.islice(f, offset, offset + limit)]
+        except FileNotFoundError:
+            return []
+
+_BATCH_JOBS = BatchJobStore(BATCH_DIR)
+
+def _batch_request(method: str, path: str, **kwargs) -> httpx.Response:
+    """Calls the Batch/Files API on the pooled client."""
+    key = os.getenv("VISION_BATCH_API_KEY") or os.getenv("OPENAI_API_KEY")
+    if not key:
+        raise ValueError("Batch jobs need VISION_BATCH_API_KEY or OPENAI_API_KEY")
+    base = (BATCH_API_BASE or API_BASE or _PROVIDER_BASES["openai"]).rstrip("/")
+    response = _HTTP_POOL.get_client().request(method, base + path, headers={"Authorization": f"Bearer {key}"}, **kwargs)
+    response.raise_for_status()
+    return response
+
+def _batch_inputs(paths: List[str]) -> List[str]:
+    """
+    Files as given; directories inside BASE_DIR expanded (recursively) to the
+    images they hold. Paths outside the base are passed through untouched, so
+    each is rejected as one item without being listed; symlinked directories
+    are followed only while they resolve inside the base, and each once.
+    """
+    base_abs = _base_dir()
+    found = []
+    for path in paths:
+        real_path = os.path.realpath(os.path.abspath(path))
+        if not (_within_base(real_path, base_abs) and os.path.isdir(real_path)):
+            found.append(path)
+            continue
+        seen = {real_path}
+        for root, dirs, files in os.walk(path, followlinks=True):
+            kept = []
+            for name in sorted(dirs):
+                real_dir = os.path.realpath(os.path.join(root, name))
+                if _within_base(real_dir, base_abs) and real_dir not in seen:
+                    seen.add(real_dir)
+                    kept.append(name)
+            dirs[:] = kept
+            found.extend(os.path.join(root, name) for name in sorted(files)
+                         if os.path.splitext(name)[1].lower() in BATCH_IMAGE_EXTENSIONS)
+    return found
+
+def _submit_batch(paths: List[str], mode: str, question: Optional[str], region: Optional[List[int]]) -> Dict[str, Any]:
+    if BATCH_API_BASE or API_BASE or _provider_of(MODEL_NAME) == "openai":
+        model = MODEL_NAME.split("/", 1)[1] if MODEL_NAME.startswith("openai/") else MODEL_NAME
+    else:
+        raise ValueError(f"Model '{MODEL_NAME}' has no OpenAI-compatible Batch API; set VISION_BATCH_API_BASE")
+    region_norm = [int(c) for c in region] if region else None
+    job_id = f"batch-{os.urandom(8).hex()}"
+    job = {"id": job_id, "status": "submitting", "created_at": time.time(), "model": model, "mode": mode,
+           "question": question, "region": region_norm, "items": {}, "shards": []}
+    os.makedirs(_BATCH_JOBS.root, exist_ok=True)
+
+    # 1. Preprocess straight into JSONL shards on disk, within the provider's per-file limits
+    shard_paths: List[str] = []
+    shard, shard_bytes, shard_lines = None, 0, 0
+    try:
+        for index, path in enumerate(_batch_inputs(paths)):
+            custom_id = str(index)
+            try:
+                source, label, _, identity = _resolve_source(path, None, None)
+                try:
+                    safe_path = source.path if isinstance(source, OpenFile) else label
+                    cache_key = _cache_key(_cache_key_base(identity, mode, question, region_norm))
+                    if _CACHE.get(cache_key):
+                        job["items"][custom_id] = {"path": label, "status": "cached"}
+                        continue
+                    data_url, _, orig_size, crop_bbox, sent_size = _process_image(source, region_norm, mode)
+                finally:
+                    if isinstance(source, OpenFile):
+                        source.close()
+            except Exception as e:
+                job["items"][custom_id] = {"path": path, "status": "skipped", "error": str(e)}
+                continue
+            line = json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": {
+                "model": model,
+                "messages": _build_messages(data_url, mode, question, sent_size, cache_control=False),
+                "temperature": 0, "top_p": 1, "response_format": {"type": "json_object"},
+            }}) + "\n"
+            del data_url
+            if shard is None or shard_lines >= BATCH_MAX_REQUESTS or shard_bytes + len(line) > BATCH_MAX_FILE_MB * 1024 * 1024:
+                if shard is not None:
+                    shard.close()
+                shard_paths.append(_BATCH_JOBS.path(job_id, f".input{len(shard_paths)}.jsonl"))
+                shard, shard_bytes, shard_lines = open(shard_paths[-1], "w", encoding="utf-8"), 0, 0
+            shard.write(line)
+            shard_bytes += len(line)
+            shard_lines += 1
+            job["items"][custom_id] = {
+                "path": label, "safe_path": safe_path, "identity": identity, "cache_key": cache_key,
+                "shard": len(shard_paths) - 1, "orig_size": orig_size, "crop_bbox": crop_bbox,
+                "sent_size": sent_size, "status": "pending",
+            }
+    finally:
+        if shard is not None:
+            shard.close()
+    if not job["items"]:
+        raise ValueError("No images found in paths")
+
+    # 2. Upload and start one provider batch per shard
+    try:
+        for shard_path in shard_paths:
+            with open(shard_path, "rb") as f:
+                uploaded = _batch_request("POST", "/files", data={"purpose": "batch"},
+                                          files={"file": (os.path.basename(shard_path), f, "application/jsonl")}).json()
+            batch = _batch_request("POST", "/batches", json={
+                "input_file_id": uploaded["id"], "endpoint": "/v1/chat/completions",
+                "completion_window": "24h", "metadata": {"vision_job": job_id},
+            }).json()
+            job["shards"].append({"batch_id": batch["id"], "status": batch.get("status", "validating"),
+                                  "request_counts": batch.get("request_counts")})
+            os.remove(shard_path)
+    except Exception as e:
+        # Shards already submitted are still tracked; the rest are reported as failed
+        for item in job["items"].values():
+            if item["status"] == "pending" and item["shard"] >= len(job["shards"]):
+                item.update(status="failed", error=f"Submission failed: {e}")
+        for shard_path in shard_paths[len(job["shards"]):]:
+            os.remove(shard_path)
+        if not job["shards"]:
+            job["status"] = "failed"
+            _BATCH_JOBS.save(job)
+            raise
+    job["status"] = "in_progress" if job["shards"] else "completed"
+    _BATCH_JOBS.save(job)
+    _METRICS.incr("batch.jobs_submitted")
+    if job["shards"]:
+        threading.Thread(target=_batch_poller, args=(job_id,), name=f"vision-{job_id}", daemon=True).start()
+    return job
+
+def _batch_poller(job_id: str):
+    """Polls a job in the background until every shard is done and applied."""
+    while True:
+        time.sleep(BATCH_POLL_SECONDS)
+        try:
+            if _poll_batch_job(job_id)["status"] != "in_progress":
+                return
+        except ValueError:
+            return
+        except Exception:
+            _METRICS.incr("batch.poll_errors")
+
+def _poll_batch_job(job_id: str) -> Dict[str, Any]:
+    """Refreshes shard status from the provider and applies finished shards once."""
+    with _BATCH_JOBS.job_lock(job_id):
+        job = _BATCH_JOBS.load(job_id)
+        if job["status"] != "in_progress":
+            return job
+        for index, shard in enumerate(job["shards"]):
+            if shard.get("applied"):
+                continue
+            if shard["status"] not in _BATCH_TERMINAL:
+                batch = _batch_request("GET", f"/batches/{shard['batch_id']}").json()
+                shard.update(status=batch["status"], request_counts=batch.get("request_counts"),
+                             output_file_id=batch.get("output_file_id"), error_file_id=batch.get("error_file_id"))
+            if shard["status"] in _BATCH_TERMINAL:
+                _apply_batch_shard(job, index, shard)
+                shard["applied"] = True
+        if all(shard.get("applied") for shard in job["shards"]):
+            job["status"] = "completed"
+            job["completed_at"] = time.time()
+        _BATCH_JOBS.save(job)
+        return job
+
+def _apply_batch_shard(job: Dict[str, Any], index: int, shard: Dict[str, Any]):
+    """
+    Parses a finished shard like a synchronous call would (repair, compact
+    expansion, coordinate mapping), then caches and indexes each result whose
+    file is unchanged since submission.
+    """
+    mode, region = job["mode"], job["region"]
+    envelopes = []
+    for file_id in (shard.get("output_file_id"), shard.get("error_file_id")):
+        if not file_id:
+            continue
+        for line in _batch_request("GET", f"/files/{file_id}/content").text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            item = job["items"].get(record.get("custom_id"))
+            if item is None or item["status"] != "pending":
+                continue
+            response = record.get("response") or {}
+            try:
+                if record.get("error") or response.get("status_code") != 200:
+                    error = record.get("error") or (response.get("body") or {}).get("error") or response.get("status_code")
+                    raise RuntimeError(f"Provider error: {error}")
+                sent_size, orig_size = tuple(item["sent_size"]), tuple(item["orig_size"])
+                result = _parse_output(response["body"]["choices"][0]["message"]["content"], mode, sent_size)
+                _adjust_coordinates(result, tuple(item["crop_bbox"]), sent_size, orig_size)
+            except Exception as e:
+                item.update(status="failed", error=str(e))
+                continue
+            envelope = _envelope(mode, item["path"], orig_size, item["crop_bbox"] if region else None, sent_size, result)
+            envelope["metadata"]["batch_job"] = job["id"]
+            try:
+                with _open_validated(item["safe_path"]) as opened:
+                    if item["identity"] == f"{opened.path}|{opened.mtime}":
+                        _CACHE.set(item["cache_key"], envelope)
+                        _index_envelope(opened, envelope, region)
+            except (OSError, ValueError):
+                pass  # changed, moved or uploaded since submission: the result is returned but not cached
+            item["status"] = "succeeded"
+            envelopes.append(envelope)
+    for item in job["items"].values():
+        if item["status"] == "pending" and item["shard"] == index:
+            item.update(status="failed", error=f"No result (batch {shard['status']})")
+    _BATCH_JOBS.append_results(job["id"], envelopes)
+    _METRICS.incr("batch.results", len(envelopes))
+
+def _batch_summary(job: Dict[str, Any]) -> Dict[str, Any]:
+    counts = {"total": len(job["items"]), "cached": 0, "skipped": 0, "pending": 0, "succeeded": 0, "failed": 0}
+    errors = []
+    for item in job["items"].values():
+        counts[item["status"]] += 1
+        if "error" in item and len(errors) < 20:
+            errors.append({"path": item["path"], "status": item["status"], "error": item["error"]})
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "mode": job["mode"],
+        "model": job["model"],
+        "created_at": job["created_at"],
+        "counts": counts,
+        "shards": [{"batch_id": s["batch_id"], "status": s["status"], "request_counts": s.get("request_counts")}
+                   for s in job["shards"]],
+        "errors": errors,
+        "results_path": _BATCH_JOBS.path(job["id"], ".results.jsonl"),
+    }
+
+@_run_tool_in_thread
+def submit_batch_job(
+    paths: List[str],
+    mode: str = "ocr",
+    question: Optional[str] = None,
+    region: Optional[List[int]] = None
+) -> Dict[str, Any]:
+    """
+    Queues many images for offline analysis through the provider's Batch API
+    (cheaper, results within 24h). Returns a job_id for get_batch_job.
+
+    Images that already have a cached result are not sent again. Finished
+    results are loaded into the cache, so examine_image with the same
+    arguments answers from it.
+
+    Args:
+        paths: Image files and/or directories (searched recursively for images).
+        mode: 'ui', 'ocr', 'general' or 'query', applied to every image.
+        question: Required if mode='query'.
+        region: [x1, y1, x2, y2] pixel crop applied to every image.
+    """
+    try:
+        if mode not in ALLOWED_MODES:
+            return {"error": f"Invalid mode '{mode}'. Allowed: {sorted(list(ALLOWED_MODES))}", "paths": paths}
+        if mode == "query" and not question:
+            return {"error": "Parameter 'question' is required when mode='query'", "paths": paths}
+        if not paths:
+            return {"error": "Parameter 'paths' must not be empty", "paths": paths}
+        return _batch_summary(_submit_batch(paths, mode, question, region))
+    except Exception as e:
+        return {"error": str(e), "paths": paths}
+
+@_run_tool_in_thread
+def get_batch_job(job_id: str, wait_seconds: float = 0, offset: int = 0, limit: int = 0) -> Dict[str, Any]:
+    """
+    Reports a batch job's progress; once shards finish, their results are
+    applied and stored. Jobs survive restarts and are polled again here.
+
+    Args:
+        job_id: As returned by submit_batch_job.
+        wait_seconds: Keep polling up to this long for the job to complete.
+        offset: First result to return (results are in completion order).
+        limit: Number of results to return (0 returns counts only).
+    """
+    try:
+        deadline = time.monotonic() + max(0.0, float(wait_seconds))
+        while True:
+            job = _poll_batch_job(job_id)
+            remaining = deadline - time.monotonic()
+            if job["status"] != "in_progress" or remaining <= 0:
+                break
+            time.sleep(min(BATCH_POLL_SECONDS, remaining))
+        summary = _batch_summary(job)
+        if limit > 0:
+            summary["results"] = _BATCH_JOBS.read_results(job_id, max(0, int(offset)), int(limit))
+        return summary
+    except Exception as e:
+        return {"error": str(e), "job_id": job_id}
+
+# --- STARTUP ---
+_WARM_UP_LOCK = threading.Lock()
+_WARM_UP_STARTED = False
+
+def _warm_up():
+    """Imports litellm and opens pooled provider connections (idempotent, runs once)."""
+    global _WARM_UP_STARTED
+    with _WARM_UP_LOCK:
+        if _WARM_UP_STARTED:
+            return
+        _WARM_UP_STARTED = True
+    start = time.perf_counter()
+    _HTTP_POOL.warm(_warm_targets())
+    _METRICS.observe("startup.warm_up_seconds", time.perf_counter() - start)
+
+async def _on_initialized(_notification: mcp_types.InitializedNotification):
+    # The handshake has been answered; load the heavy parts off the event loop
+    threading.Thread(target=_warm_up, name="vision-warm-up", daemon=True).start()
+
+def _transport_security(host: str):
+    """
+    DNS-rebinding protection for the HTTP transports. The Host header must be
+    one of VISION_ALLOWED_HOSTS (default: the bind host, or this machine's
+    name when bound to all interfaces), with any port unless one is given;
+    an Origin header, when sent, must be one of them over http or https.
+    """
+    from mcp.server.transport_security import TransportSecuritySettings
+    names = [h.strip() for h in os.getenv("VISION_ALLOWED_HOSTS", "").split(",") if h.strip()]
+    if not names:
+        names = [socket.gethostname()] if host in ("0.0.0.0", "::", "") else [f"[{host}]" if ":" in host else host]
+    hosts, origins = [], []
+    for name in names:
+        has_port = ":" in name.rsplit("]", 1)[-1]
+        variants = [name] if has_port else [name, f"{name}:*"]
+        hosts += variants
+        origins += [f"{scheme}://{v}" for scheme in ("http", "https") for v in variants]
+    return TransportSecuritySettings(enable_dns_rebinding_protection=True, allowed_hosts=hosts,
+                                     allowed_origins=origins)
+
+def _http_app():
+    """
+    ASGI app for the HTTP transports; uvicorn calls this in every worker.
+    With several workers, streamable HTTP runs stateless so any worker can
+    answer any request. Only streamable HTTP drains in-flight calls on
+    shutdown; SSE streams close immediately.
+    """
+    transport = os.getenv("VISION_TRANSPORT", "streamable-http")
+    host = os.getenv("VISION_HOST", "127.0.0.1")
+    if host not in ("127.0.0.1", "localhost", "::1") or os.getenv("VISION_ALLOWED_HOSTS"):
+        # The default Host check only admits localhost; widen it to the names clients use, never drop it
+        mcp.settings.transport_security = _transport_security(host)
+    if transport == "sse":
+        app = mcp.sse_app()
+    else:
+        mcp.settings.stateless_http = int(os.getenv("VISION_WORKERS", "1")) > 1
+        # Plain JSON responses: SSE response streams are cut as soon as shutdown
+        # starts, which would defeat draining in-flight calls
+        mcp.settings.json_response = True
+        app = mcp.streamable_http_app()
+    if WARM_UP_ENABLED:
+        threading.Thread(target=_warm_up, name="vision-warm-up", daemon=True).start()
+    atexit.register(_HTTP_POOL.close)
+    return app
+
+def _default_shared_store(port: int) -> str:
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), f"mcp-eyes-8k-{port}.sqlite")
+
+def _snapshot_cli(argv: List[str]):
+    import argparse
+    parser = argparse.ArgumentParser(prog="active_vision.py snapshot", description="Cache snapshots for warm-starting nodes")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="write the shared store's results (VISION_SHARED_STORE) to a snapshot")
+    export.add_argument("output")
+    export.add_argument("--merge", nargs="*", default=[], help="snapshots to fold in (the store wins)")
+    merge = sub.add_parser("merge", help="combine snapshots into one; later inputs win")
+    merge.add_argument("output")
+    merge.add_argument("inputs", nargs="+")
+    load = sub.add_parser("load", help="stream snapshots into the shared store")
+    load.add_argument("inputs", nargs="+")
+    info = sub.add_parser("info", help="show snapshot headers")
+    info.add_argument("inputs", nargs="+")
+    args = parser.parse_args(argv)
+
+    if args.command in ("export", "load") and _SHARED_STORE is None:
+        parser.error(f"'{args.command}' works on the shared store; set VISION_SHARED_STORE")
+    if args.command == "export":
+        result = _export_snapshot(args.output, _CACHE, args.merge)
+    elif args.command == "merge":
+        result = _export_snapshot(args.output, None, args.inputs)
+    elif args.command == "load":
+        result = {path: _load_snapshot(path, _CACHE) for path in args.inputs}
+    else:
+        result = {}
+        for path in args.inputs:
+            snapshot = Snapshot(path)
+            result[path] = {**snapshot.meta, "stale": snapshot.stale, "bytes": os.path.getsize(path)}
+    print(json.dumps(result, indent=2))
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["snapshot"]:
+        _snapshot_cli(argv[1:])
+        return
+    parser = argparse.ArgumentParser(description="MCP Eyes 8K vision server")
+    parser.add_argument("--transport", choices=["stdio", "sse", "streamable-http"],
+                        default=os.getenv("VISION_TRANSPORT", "stdio"))
+    parser.add_argument("--host", default=os.getenv("VISION_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("VISION_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("VISION_WORKERS", "1")),
+                        help="worker processes for streamable-http (they share one cache and rate limiter)")
+    args = parser.parse_args(argv)
+
+    if args.transport == "stdio":
+        if WARM_UP_ENABLED:
+            mcp._mcp_server.notification_handlers[mcp_types.InitializedNotification] = _on_initialized
+        mcp.run()
+        return
+
+    if args.workers > 1:
+        if args.transport != "streamable-http":
+            parser.error("--workers > 1 needs --transport streamable-http (SSE sessions live in one process)")
+        # Workers import the module afresh and read these at import time
+        os.environ.setdefault("VISION_SHARED_STORE", _default_shared_store(args.port))
+        if os.getenv("VISION_INDEX_PATH", ":memory:") == ":memory:":
+            os.environ["VISION_INDEX_PATH"] = os.environ["VISION_SHARED_STORE"]
+    os.environ["VISION_TRANSPORT"] = args.transport
+    os.environ["VISION_HOST"] = args.host
+    os.environ["VISION_WORKERS"] = str(args.workers)
+
+    import uvicorn
+    # SIGTERM/SIGINT stop accepting connections and let in-flight requests
+    # finish for up to DRAIN_SECONDS before workers exit
+    uvicorn.run(
+        "active_vision:_http_app",
+        factory=True,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_graceful_shutdown=DRAIN_SECONDS,
+        log_level=os.getenv("VISION_LOG_LEVEL", "info"),
+    )
 
 if __name__ == "__main__":
-    mcp.run()
+    main()
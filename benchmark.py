@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for MCP Eyes 8K. No API key needed.
+
+    python benchmark.py memory [--size 7680x4320] [--concurrency 1,4,8]
+    python benchmark.py startup [--runs 3] [--idle 5]
+    python benchmark.py resize [--sizes 7680x4320,5120x2880,3840x2160,2560x1440]
+    python benchmark.py tokens [--items 50,200,500] [--token-ms 1]
+    python benchmark.py progressive [--size 7680x4320] [--panels 3]
+    python benchmark.py pyramid [--size 12000x9000] [--crops 8]
+
+Memory, startup and pyramid measurements run in a fresh subprocess so peak RSS
+(ru_maxrss) is not polluted by earlier runs.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_screenshot(path, width, height):
+    """Synthetic UI-like capture: flat panels, borders and lots of small text."""
+    from PIL import Image, ImageDraw
+
+    img = Image.new("RGB", (width, height), (246, 247, 249))
+    draw = ImageDraw.Draw(img)
+    for y in range(0, height, 180):
+        draw.rectangle([40, y + 20, width - 40, y + 160], outline=(200, 204, 210), width=2)
+        for x in range(60, width - 400, 420):
+            draw.text((x, y + 40), f"Row {y // 180} item {x // 420}: status OK, 12.5 ms", fill=(30, 30, 30))
+            draw.rectangle([x, y + 90, x + 160, y + 130], fill=(37, 99, 235))
+    img.save(path, format="PNG")
+
+
+def _peak_rss_mb():
+    import resource
+    # Linux keeps ru_maxrss across exec, so a worker started by a big parent
+    # would report the parent's peak; VmHWM starts fresh with the new image
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _legacy_payload(path, mode):
+    """The pre-streaming encode path: getvalue() copy, b64 bytes, str, f-string."""
+    import base64
+    from io import BytesIO
+    from PIL import Image, ImageOps
+    from active_vision import _fit_size
+
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        max_dim = 2560 if mode in ("ocr", "ui") else 1536
+        if max(img.size) > max_dim:
+            img.thumbnail((max_dim, max_dim))
+        buffer = BytesIO()
+        img.save(buffer, format="PNG", optimize=True)
+        b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+        return f"data:image/png;base64,{b64}"
+
+
+def memory_worker(path, concurrency, variant):
+    """Runs `concurrency` encodes at once in this process and prints peak RSS."""
+    os.environ.setdefault("VISION_BASE_DIR", os.path.dirname(path))
+    import active_vision
+
+    baseline = _peak_rss_mb()
+    barrier = threading.Barrier(concurrency)
+    payloads = []
+
+    def run():
+        barrier.wait()
+        if variant == "legacy":
+            url = _legacy_payload(path, "ui")
+        else:
+            url = active_vision._process_image(path, None, "ui")[0]
+        payloads.append(len(url))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    peak = _peak_rss_mb()
+    print(json.dumps({
+        "variant": variant,
+        "concurrency": concurrency,
+        "peak_rss_mb": round(peak, 1),
+        "delta_mb": round(peak - baseline, 1),
+        "per_request_mb": round((peak - baseline) / concurrency, 1),
+        "payload_mb": round(payloads[0] / 1e6, 2),
+        "seconds": round(elapsed, 2),
+    }))
+
+
+def bench_memory(args):
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    levels = [int(v) for v in args.concurrency.split(",")]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "capture.png")
+        make_screenshot(path, width, height)
+        print(f"Peak RSS per concurrent request, {width}x{height} PNG, ui mode\n")
+        print(f"{'variant':<10}{'conc':>6}{'peak MB':>10}{'delta MB':>10}{'MB/req':>9}{'secs':>7}")
+        for variant in ("legacy", "streaming"):
+            for level in levels:
+                out = subprocess.run(
+                    [sys.executable, __file__, "_memory_worker", path, str(level), variant],
+                    capture_output=True, text=True, cwd=HERE,
+                    env={**os.environ, "LITELLM_LOCAL_MODEL_COST_MAP": "True"},
+                )
+                line = out.stdout.strip().splitlines()[-1] if out.stdout.strip() else ""
+                if not line.startswith("{"):
+                    print(f"{variant:<10}{level:>6}  failed: {out.stderr.strip()[-200:]}")
+                    continue
+                r = json.loads(line)
+                print(f"{variant:<10}{level:>6}{r['peak_rss_mb']:>10}{r['delta_mb']:>10}{r['per_request_mb']:>9}{r['seconds']:>7}")
+
+
+def _rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def _startup_run(command, env, idle):
+    """Spawns the server over stdio; returns handshake/list_tools timings and RSS."""
+    import anyio
+    from mcp import ClientSession, StdioServerParameters
+    from mcp.client.stdio import stdio_client
+
+    params = StdioServerParameters(command=command[0], args=command[1:], env=env, cwd=HERE)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        async with stdio_client(params, errlog=devnull) as (read, write):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                handshake = time.perf_counter() - start
+                tools = await session.list_tools()
+                first_list = time.perf_counter() - start
+                pid = _server_pid(command)
+                rss_ready = _rss_mb(pid) if pid else float("nan")
+                await anyio.sleep(idle)
+                rss_idle = _rss_mb(pid) if pid else float("nan")
+    return {"handshake": handshake, "list_tools": first_list, "tools": len(tools.tools),
+            "rss_ready": rss_ready, "rss_idle": rss_idle}
+
+
+def _server_pid(command):
+    """Newest child of this process running `command` (stdio_client hides the Popen)."""
+    me = str(os.getpid())
+    found = None
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                ppid = f.read().rsplit(")", 1)[1].split()[1]
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmdline = f.read().split(b"\0")
+        except OSError:
+            continue
+        if ppid == me and command[-1].encode() in cmdline:
+            found = max(found or 0, int(pid))
+    return found
+
+
+def bench_startup(args):
+    import anyio
+
+    server = os.path.join(HERE, "active_vision.py")
+    variants = [
+        ("eager", [sys.executable, "-c", f"import litellm, runpy; runpy.run_path({server!r}, run_name='__main__')"], "0"),
+        ("lazy", [sys.executable, server], "0"),
+        ("lazy+warm-up", [sys.executable, server], "1"),
+    ]
+    print(f"Time to first list_tools and server RSS (median of {args.runs}), idle RSS after {args.idle}s\n")
+    print(f"{'variant':<14}{'handshake s':>12}{'list_tools s':>13}{'RSS ready MB':>14}{'RSS idle MB':>13}")
+    for name, command, warm in variants:
+        env = {**os.environ, "LITELLM_LOCAL_MODEL_COST_MAP": "True", "VISION_WARMUP": warm,
+               "VISION_BASE_DIR": os.environ.get("VISION_BASE_DIR", HERE)}
+        runs = [anyio.run(_startup_run, command, env, args.idle) for _ in range(args.runs)]
+        median = lambda key: sorted(r[key] for r in runs)[len(runs) // 2]
+        print(f"{name:<14}{median('handshake'):>12.2f}{median('list_tools'):>13.2f}"
+              f"{median('rss_ready'):>14.1f}{median('rss_idle'):>13.1f}")
+
+
+def stroke_contrast(img):
+    """
+    OCR-free legibility proxy: mean local contrast (3x3 max - min) over the
+    pixels on text and widget edges. Blurred thin strokes lose contrast first.
+    """
+    from PIL import ImageChops, ImageFilter, ImageStat
+
+    gray = img.convert("L")
+    local = ImageChops.subtract(gray.filter(ImageFilter.MaxFilter(3)), gray.filter(ImageFilter.MinFilter(3)))
+    edges = local.point(lambda v: 255 if v > 24 else 0)
+    return ImageStat.Stat(local, edges).mean[0]
+
+
+def bench_resize(args):
+    import base64
+    from io import BytesIO
+    from PIL import Image
+
+    os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+    import active_vision
+
+    print("ui-mode encode: generic bicubic vs screenshot path (median of "
+          f"{args.runs}); contrast = edge contrast kept vs the original\n")
+    print(f"{'size':<11}{'variant':<12}{'encode ms':>10}{'payload KB':>12}{'contrast':>10}{'png mode':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes.split(","):
+            width, height = (int(v) for v in size.lower().split("x"))
+            path = os.path.join(tmp, f"{size}.png")
+            make_screenshot(path, width, height)
+            with Image.open(path) as original:
+                reference = stroke_contrast(original)
+            for variant, enabled in (("generic", False), ("screenshot", True)):
+                active_vision.SCREENSHOT_FAST_PATH = enabled
+                times = []
+                for _ in range(args.runs):
+                    start = time.perf_counter()
+                    url = active_vision._process_image(path, None, "ui")[0]
+                    times.append(time.perf_counter() - start)
+                png = base64.b64decode(url.split(",", 1)[1])
+                with Image.open(BytesIO(png)) as sent:
+                    png_mode = sent.mode
+                    kept = stroke_contrast(sent.convert("RGB")) / reference
+                print(f"{size:<11}{variant:<12}{sorted(times)[len(times) // 2] * 1000:>10.0f}"
+                      f"{len(png) / 1024:>12.0f}{kept:>10.2f}{png_mode:>10}")
+
+
+def _synthetic_items(mode, count, width, height):
+    """Deterministic OCR lines or UI widgets laid out down a page, in pixels."""
+    import random
+
+    rng = random.Random(count)
+    words = ["Invoice", "total", "status", "pending", "approved", "Customer", "ID", "2024-118", "EUR", "Settings"]
+    items = []
+    for i in range(count):
+        x = rng.randrange(0, width - 400)
+        y = int(i * (height - 30) / count)
+        box = [x, y, x + rng.randrange(80, 400), y + rng.randrange(14, 30)]
+        label = " ".join(rng.choice(words) for _ in range(rng.randrange(1, 6)))
+        if mode == "ocr":
+            items.append({"text": label, "bbox": box})
+        else:
+            items.append({"type": rng.choice(["button", "input", "link", "checkbox"]), "label": label, "bbox": box})
+    return items
+
+
+def _wire_responder(mode, count):
+    """Mock model: answers in whichever schema the system prompt asked for."""
+    import re
+
+    def respond(body):
+        system = body["messages"][0]["content"]
+        system = system if isinstance(system, str) else system[0]["text"]
+        user = body["messages"][1]["content"][0]["text"]
+        width, height = (int(v) for v in re.search(r"Image is (\d+)x(\d+)", user).groups())
+        items = _synthetic_items(mode, count, width, height)
+        if "one line per" not in system:
+            key = "text_blocks" if mode == "ocr" else "elements"
+            return {key: items, "uncertainties": []}
+        grid = lambda box: (round(box[0] * 1000 / width), round(box[1] * 1000 / height),
+                            round(box[2] * 1000 / width), round(box[3] * 1000 / height))
+        lead = (lambda item: [item["text"]]) if mode == "ocr" else (lambda item: [item["type"], item["label"]])
+        lines = "\n".join("|".join(map(str, [*lead(item), *grid(item["bbox"])])) for item in items)
+        return {"t" if mode == "ocr" else "e": lines, "u": []}
+    return respond
+
+
+def bench_tokens(args):
+    os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+    os.environ.setdefault("OPENAI_API_KEY", "sk-mock")
+    import logging
+    import litellm
+    from mock_provider import MockProvider
+
+    logging.getLogger("LiteLLM").setLevel(logging.WARNING)
+    litellm.suppress_debug_info = True
+
+    count_tokens = lambda content: litellm.token_counter(model="gpt-4o", text=content)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["VISION_BASE_DIR"] = tmp
+        import active_vision
+
+        path = os.path.join(tmp, "capture.png")
+        make_screenshot(path, 2560, 1440)
+        print(f"Output tokens (gpt-4o tokenizer) and wall time at {args.token_ms} ms/token, mock provider\n")
+        print(f"{'mode':<6}{'items':>6}{'verbose tok':>13}{'compact tok':>13}{'saved':>7}"
+              f"{'verbose s':>11}{'compact s':>11}{'max bbox err px':>17}")
+        for mode in ("ocr", "ui"):
+            for count in (int(v) for v in args.items.split(",")):
+                runs = {}
+                for compact in (False, True):
+                    with MockProvider(_wire_responder(mode, count), token_latency=args.token_ms / 1000,
+                                      count_tokens=count_tokens) as provider:
+                        active_vision.API_BASE = provider.url
+                        active_vision.MODEL_NAME = "openai/mock-vision"
+                        active_vision.COMPACT_OUTPUT = compact
+                        active_vision._CACHE = active_vision.TTLCache(10, 60)
+                        active_vision._PROVIDER_GUARD = active_vision.ProviderGuard()
+                        start = time.perf_counter()
+                        result = active_vision.examine_image(path, mode=mode)
+                        elapsed = time.perf_counter() - start
+                    if "error" in result:
+                        raise SystemExit(f"{mode}/{count}: {result['error']}")
+                    key = "text_blocks" if mode == "ocr" else "elements"
+                    runs[compact] = (provider.completion_tokens, elapsed, result["content"][key])
+                (v_tok, v_s, v_items), (c_tok, c_s, c_items) = runs[False], runs[True]
+                err = max((abs(a - b) for v, c in zip(v_items, c_items) for a, b in zip(v["bbox"], c["bbox"])), default=0)
+                print(f"{mode:<6}{count:>6}{v_tok:>13}{c_tok:>13}{1 - c_tok / v_tok:>7.0%}"
+                      f"{v_s:>11.2f}{c_s:>11.2f}{err:>17}")
+
+
+def make_dashboard(path, width, height, panels):
+    """
+    8K-style capture with ground truth: large headings and buttons across the
+    page, plus `panels` log panels packed with small 12px text lines.
+    """
+    import random
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(panels)
+    img = Image.new("RGB", (width, height), (246, 247, 249))
+    draw = ImageDraw.Draw(img)
+    items = []
+    for y in range(80, height - 200, 600):
+        for x in range(80, width - 1200, 1800):
+            items.append({"text": f"Heading {len(items)}", "bbox": [x, y, x + 900, y + 60]})
+            items.append({"text": f"Button {len(items)}", "bbox": [x, y + 120, x + 320, y + 200]})
+    for _ in range(panels):
+        px, py = rng.randrange(0, width - 1600), rng.randrange(0, height - 1000)
+        draw.rectangle([px, py, px + 1600, py + 1000], fill=(255, 255, 255), outline=(200, 204, 210))
+        items = [i for i in items if not (px - 900 < i["bbox"][0] < px + 1600 and py - 200 < i["bbox"][1] < py + 1000)]
+        for line in range(0, 960, 24):
+            items.append({"text": f"log {len(items)}", "bbox": [px + 20, py + 20 + line, px + 20 + rng.randrange(400, 1500), py + 32 + line]})
+    for item in items:
+        draw.rectangle(item["bbox"], fill=(60, 60, 60))
+    img.save(path)
+    return items
+
+
+def _simulated_model(items, views):
+    """
+    Stands in for _analyze_payload: reads every ground-truth item whose
+    centre is in view and whose height is at least 8 sent pixels. With the
+    overview hint, items too small to read are reported as uncertain regions.
+    """
+    import active_vision
+
+    def analyze(data_url, mode, question, sent_size, hint=None):
+        (cx1, cy1, cx2, cy2), _ = views[data_url]
+        scale = sent_size[0] / (cx2 - cx1)
+        to_sent = lambda b: [(b[0] - cx1) * scale, (b[1] - cy1) * scale, (b[2] - cx1) * scale, (b[3] - cy1) * scale]
+        blocks, unreadable = [], []
+        for item in items:
+            x1, y1, x2, y2 = item["bbox"]
+            if not (cx1 <= (x1 + x2) / 2 < cx2 and cy1 <= (y1 + y2) / 2 < cy2):
+                continue
+            if (y2 - y1) * scale >= 8:
+                blocks.append({"text": item["text"], "bbox": to_sent(item["bbox"])})
+            else:
+                unreadable.append(tuple(to_sent(item["bbox"])))
+        result = {"text_blocks": blocks, "uncertainties": ["small text"] if unreadable else []}
+        if hint and unreadable:
+            result["uncertain_regions"] = [list(b) for b in active_vision._merge_boxes(unreadable, 20)]
+        return result
+    return analyze
+
+
+def bench_progressive(args):
+    os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["VISION_BASE_DIR"] = tmp
+        import active_vision
+
+        path = os.path.join(tmp, "dashboard.png")
+        truth = make_dashboard(path, width, height, args.panels)
+        views = {}
+        process_image = active_vision._process_image
+
+        def recording_process_image(*a, **kw):
+            out = process_image(*a, **kw)
+            views[out[0]] = (out[3], out[4])
+            return out
+
+        active_vision._process_image = recording_process_image
+        active_vision._analyze_payload = _simulated_model(truth, views)
+        tile = active_vision._max_dim("ocr")
+        tiles = [[x, y, min(x + tile, width), min(y + tile, height)]
+                 for y in range(0, height, tile) for x in range(0, width, tile)]
+        variants = [
+            ("single call", lambda: [active_vision.examine_image(path, mode="ocr")]),
+            (f"tiling x{len(tiles)}", lambda: [active_vision.examine_image(path, mode="ocr", region=t) for t in tiles]),
+            ("progressive", lambda: [active_vision.examine_image(path, mode="ocr", progressive=True)]),
+        ]
+        print(f"{width}x{height} capture, {len(truth)} text items ({args.panels} panels of 12px text); "
+              "simulated model reads text >= 8 sent px\n")
+        print(f"{'variant':<14}{'calls':>6}{'MP sent':>9}{'recall':>8}")
+        for name, run in variants:
+            views.clear()
+            active_vision._CACHE = active_vision.TTLCache(100, 60)
+            results = run()
+            found = [b for r in results for b in r["content"]["text_blocks"]]
+            hits = sum(1 for item in truth if any(b["text"] == item["text"] and
+                                                  active_vision._iou(b["bbox"], item["bbox"]) >= 0.5 for b in found))
+            pixels = sum(size[0] * size[1] for _, size in views.values())
+            print(f"{name:<14}{len(views):>6}{pixels / 1e6:>9.1f}{hits / len(truth):>8.0%}")
+
+
+def pyramid_worker(path, store_dir, variant, crops):
+    """Reads `crops` ocr-mode regions of one large image and prints timings and peak RSS."""
+    os.environ.setdefault("VISION_BASE_DIR", os.path.dirname(path))
+    import active_vision
+    from PIL import Image
+
+    with Image.open(path) as img:
+        width, height = img.size
+    store = active_vision.PyramidStore(store_dir, active_vision.PYRAMID_TILE, 1 << 40)
+    times, reads = [], []
+    for i in range(crops):
+        x = (i * 1597) % (width - 3000)
+        y = (i * 1009) % (height - 2000)
+        box = (x, y, x + 3000, y + 2000)
+        start = time.perf_counter()
+        if variant == "decode":
+            with Image.open(path) as img:
+                pixels = img.crop(box)
+        else:
+            pixels = store.get(path).read(box, active_vision._fit_size((3000, 2000), active_vision._max_dim("ocr")))
+        reads.append(time.perf_counter() - start)
+        active_vision._encode_image(pixels, None, "ocr", owned=True)
+        times.append(time.perf_counter() - start)
+    print(json.dumps({
+        "first_s": round(times[0], 2),
+        "read_ms": round(sorted(reads[1:])[len(reads) // 2 - 1] * 1000, 1),
+        "total_ms": round(sorted(times[1:])[len(times) // 2 - 1] * 1000, 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }))
+
+
+def bench_pyramid(args):
+    from PIL import Image
+
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    with tempfile.TemporaryDirectory() as tmp:
+        png = os.path.join(tmp, "scan.png")
+        make_screenshot(png, width, height)
+        bmp = os.path.join(tmp, "scan.bmp")
+        Image.MAX_IMAGE_PIXELS = None
+        with Image.open(png) as img:
+            img.save(bmp)
+        print(f"{width}x{height} image, {args.crops} ocr-mode 3000x2000 crops; first = first crop "
+              "(includes the one-time pyramid build); read and read+encode are medians of the rest\n")
+        print(f"{'file':<8}{'MB':>6}{'variant':>9}{'first s':>9}{'read ms':>9}{'+encode':>9}{'peak MB':>9}")
+        for path in (bmp, png):
+            for variant in ("decode", "pyramid"):
+                store_dir = os.path.join(tmp, f"pyramids-{os.path.basename(path)}")
+                out = subprocess.run(
+                    [sys.executable, __file__, "_pyramid_worker", path, store_dir, variant, str(args.crops)],
+                    capture_output=True, text=True, cwd=HERE,
+                    env={**os.environ, "LITELLM_LOCAL_MODEL_COST_MAP": "True"},
+                )
+                line = out.stdout.strip().splitlines()[-1] if out.stdout.strip() else ""
+                name = os.path.splitext(path)[1][1:].upper()
+                size_mb = os.path.getsize(path) / 1e6
+                if not line.startswith("{"):
+                    print(f"{name:<8}{size_mb:>6.0f}{variant:>9}  failed: {out.stderr.strip()[-200:]}")
+                    continue
+                r = json.loads(line)
+                print(f"{name:<8}{size_mb:>6.0f}{variant:>9}{r['first_s']:>9}{r['read_ms']:>9}{r['total_ms']:>9}"
+                      f"{r['peak_rss_mb']:>9}")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "_memory_worker":
+        memory_worker(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "_pyramid_worker":
+        pyramid_worker(sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    mem = sub.add_parser("memory", help="peak RSS per concurrent _process_image call")
+    mem.add_argument("--size", default="7680x4320")
+    mem.add_argument("--concurrency", default="1,4,8")
+    mem.set_defaults(func=bench_memory)
+
+    start = sub.add_parser("startup", help="time to first list_tools and idle RSS of the stdio server")
+    start.add_argument("--runs", type=int, default=3)
+    start.add_argument("--idle", type=float, default=5.0)
+    start.set_defaults(func=bench_startup)
+
+    resize = sub.add_parser("resize", help="ui-mode encode time, payload size and text contrast")
+    resize.add_argument("--sizes", default="7680x4320,5120x2880,3840x2160,2560x1440")
+    resize.add_argument("--runs", type=int, default=3)
+    resize.set_defaults(func=bench_resize)
+
+    tokens = sub.add_parser("tokens", help="output tokens and latency, verbose vs compact wire schema")
+    tokens.add_argument("--items", default="50,200,500")
+    tokens.add_argument("--token-ms", type=float, default=1.0)
+    tokens.set_defaults(func=bench_tokens)
+
+    prog = sub.add_parser("progressive", help="pixels sent and recall: single call, tiling, progressive")
+    prog.add_argument("--size", default="7680x4320")
+    prog.add_argument("--panels", type=int, default=3)
+    prog.set_defaults(func=bench_progressive)
+
+    pyr = sub.add_parser("pyramid", help="crop latency and peak RSS on a large image: full decode vs pyramid")
+    pyr.add_argument("--size", default="12000x9000")
+    pyr.add_argument("--crops", type=int, default=8)
+    pyr.set_defaults(func=bench_pyramid)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Local OpenAI-compatible stand-in for the vision provider.
+
+Serves /v1/chat/completions on 127.0.0.1 so tests and benchmarks can drive the
+full examine_image pipeline offline, plus the /v1/files and /v1/batches
+endpoints of the OpenAI Batch API for the batch job tools. It records every
+request body and counts the TCP connections opened, which is what the
+connection pool tests assert on, and totals the completion tokens it reports.
+"""
+
+import email.parser
+import email.policy
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def default_responder(body):
+    """Returns a minimal valid result for whatever mode was requested."""
+    return {"description": "mock", "main_objects": [], "uncertainties": []}
+
+
+class MockProvider:
+    """
+    Usage:
+        with MockProvider(responder) as provider:
+            os.environ["VISION_API_BASE"] = provider.url
+
+    responder(body) may return a string or dict (the message content), or a
+    (status, payload, headers) tuple to send a raw HTTP response such as a 429.
+
+    count_tokens(content) sets the reported completion tokens (default: one
+    per 4 characters); with token_latency, each of them adds that many seconds
+    to the response time, like a model generating its output.
+
+    Batches go validating -> in_progress -> completed, finishing batch_delay
+    seconds after creation; every input line is answered by the responder.
+    """
+
+    def __init__(self, responder=None, latency=0.0, token_latency=0.0, count_tokens=None, batch_delay=0.0):
+        self.responder = responder or default_responder
+        self.latency = latency
+        self.token_latency = token_latency
+        self.count_tokens = count_tokens or (lambda content: max(1, len(content) // 4))
+        self.connections = 0
+        self.requests = []
+        self.completion_tokens = 0
+        self.batch_delay = batch_delay
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with provider.lock:
+                    provider.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, payload, headers=None):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, str(value))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                path = self.path.rstrip("/")
+                if path.startswith("/v1/batches/"):
+                    batch = provider.batches.get(path.rsplit("/", 1)[1])
+                    if batch is None:
+                        self._send(404, {"error": {"message": "No such batch"}})
+                    else:
+                        self._send(200, batch)
+                elif path.startswith("/v1/files/") and path.endswith("/content"):
+                    data = provider.files.get(path.split("/")[3], {}).get("data")
+                    if data is None:
+                        self._send(404, {"error": {"message": "No such file"}})
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/jsonl")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                else:
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length)
+                path = self.path.rstrip("/")
+                if path.endswith("/v1/files"):
+                    self._send(200, provider.add_file(self.headers.get("Content-Type", ""), raw))
+                    return
+                if path.endswith("/v1/batches"):
+                    self._send(200, provider.create_batch(json.loads(raw)))
+                    return
+                body = json.loads(raw or b"{}")
+                with provider.lock:
+                    provider.requests.append(body)
+                if provider.latency:
+                    time.sleep(provider.latency)
+
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+
+                reply = provider.responder(body)
+                if isinstance(reply, tuple):
+                    self._send(*reply)
+                    return
+                content = reply if isinstance(reply, str) else json.dumps(reply)
+                tokens = provider.count_tokens(content)
+                with provider.lock:
+                    provider.completion_tokens += tokens
+                if provider.token_latency:
+                    time.sleep(tokens * provider.token_latency)
+                self._send(200, provider.completion_payload(body, content, tokens))
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def add_file(self, content_type, raw):
+        """Stores a multipart upload (fields 'purpose' and 'file')."""
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + raw)
+        fields = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                  for part in message.iter_parts()}
+        with self.lock:
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = {"data": fields.get("file", b""), "purpose": (fields.get("purpose") or b"").decode()}
+        return {"id": file_id, "object": "file", "bytes": len(fields.get("file", b"")),
+                "purpose": self.files[file_id]["purpose"]}
+
+    def create_batch(self, body):
+        with self.lock:
+            batch_id = f"batch_{len(self.batches) + 1}"
+            lines = self.files[body["input_file_id"]]["data"].decode("utf-8").splitlines()
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": body.get("endpoint"),
+                "input_file_id": body["input_file_id"], "completion_window": body.get("completion_window"),
+                "status": "validating", "output_file_id": None, "error_file_id": None,
+                "created_at": int(time.time()), "metadata": body.get("metadata"),
+                "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+            }
+        threading.Thread(target=self._run_batch, args=(batch_id, lines), daemon=True).start()
+        return dict(self.batches[batch_id])
+
+    def _run_batch(self, batch_id, lines):
+        batch = self.batches[batch_id]
+        batch["status"] = "in_progress"
+        output = []
+        for line in lines:
+            request = json.loads(line)
+            reply = self.responder(request["body"])
+            if isinstance(reply, tuple):
+                status, payload = reply[0], reply[1]
+            else:
+                content = reply if isinstance(reply, str) else json.dumps(reply)
+                status, payload = 200, self.completion_payload(request["body"], content)
+            output.append(json.dumps({"id": f"req_{len(output)}", "custom_id": request["custom_id"],
+                                      "response": {"status_code": status, "body": payload}, "error": None}))
+        time.sleep(self.batch_delay)
+        with self.lock:
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = {"data": ("\n".join(output) + "\n").encode("utf-8"), "purpose": "batch_output"}
+            failed = sum(1 for line in output if json.loads(line)["response"]["status_code"] != 200)
+            batch.update(status="completed", output_file_id=file_id,
+                         request_counts={"total": len(lines), "completed": len(lines) - failed, "failed": failed})
+
+    @staticmethod
+    def completion_payload(body, content, completion_tokens=None):
+        completion_tokens = completion_tokens or max(1, len(content) // 4)
+        return {
+            "id": f"chatcmpl-mock-{int(time.time() * 1000)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": 100,
+                "completion_tokens": completion_tokens,
+                "total_tokens": 100 + completion_tokens,
+            },
+        }
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    with MockProvider() as provider:
+        print(f"Mock provider listening on {provider.url} (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -6,14 +6,28 @@ This script tests the code without requiring actual API calls.
 
 import os
 import sys
+import json
+import hashlib
+import asyncio
+import base64
+import random
+import subprocess
+import sqlite3
+import tempfile
+import threading
+import time
 import traceback
+from contextlib import contextmanager
+from io import BytesIO
 from pathlib import Path
+from types import SimpleNamespace
 
 # Set up environment
 os.environ["VISION_BASE_DIR"] = str(Path(__file__).parent / "test_images")
 os.environ["VISION_MODEL"] = "gpt-4o"
 
 # Import the module
+import active_vision
 from active_vision import (
     _validate_path,
     _process_image,
@@ -21,8 +35,42 @@ from active_vision import (
     _adjust_coordinates,
     _repair_json,
     examine_image,
+    BKTree,
     BASE_DIR
 )
+from PIL import Image, ImageChops, ImageDraw
+from mock_provider import MockProvider
+
+class FakeCompletion:
+    """Stands in for litellm's completion() and counts calls."""
+    def __init__(self, payload, usage=None):
+        self.payload = payload
+        self.usage = usage
+        self.calls = 0
+        self.requests = []
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        self.requests.append(kwargs)
+        message = SimpleNamespace(content=json.dumps(self.payload))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=self.usage)
+
+@contextmanager
+def patched(**overrides):
+    """Temporarily overrides active_vision globals, with fresh provider guards."""
+    overrides.setdefault("_PROVIDER_GUARD", active_vision.ProviderGuard())
+    original = {name: getattr(active_vision, name) for name in overrides}
+    had_key = "OPENAI_API_KEY" in os.environ
+    os.environ.setdefault("OPENAI_API_KEY", "sk-mock")
+    for name, value in overrides.items():
+        setattr(active_vision, name, value)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            setattr(active_vision, name, value)
+        if not had_key:
+            os.environ.pop("OPENAI_API_KEY", None)
 
 def test_path_validation():
     """Test the path validation function."""
@@ -62,20 +110,20 @@ def test_image_processing():
     
     # Test without region
     try:
-        b64, mime, orig_size, crop_bbox, sent_size = _process_image(test_img, None, "ui")
+        data_url, mime, orig_size, crop_bbox, sent_size = _process_image(test_img, None, "ui")
         print(f"✓ Image processing (no region) passed:")
         print(f"  - MIME type: {mime}")
         print(f"  - Original size: {orig_size}")
         print(f"  - Crop bbox: {crop_bbox}")
         print(f"  - Sent size: {sent_size}")
-        print(f"  - Base64 length: {len(b64)}")
+        print(f"  - Data URL length: {len(data_url)}")
     except Exception as e:
         print(f"✗ Image processing (no region) failed: {e}")
     
     # Test with region
     try:
         region = [100, 100, 400, 300]
-        b64, mime, orig_size, crop_bbox, sent_size = _process_image(test_img, region, "ocr")
+        data_url, mime, orig_size, crop_bbox, sent_size = _process_image(test_img, region, "ocr")
         print(f"✓ Image processing (with region) passed:")
         print(f"  - MIME type: {mime}")
         print(f"  - Original size: {orig_size}")
@@ -84,6 +132,18 @@ def test_image_processing():
     except Exception as e:
         print(f"✗ Image processing (with region) failed: {e}")
 
+    # The chunked data URL must round-trip to the exact encoded image
+    try:
+        data_url, mime, _, _, sent_size = _process_image(os.path.join(BASE_DIR, "general_test.png"), None, "general")
+        header, payload = data_url.split(",", 1)
+        decoded = Image.open(BytesIO(base64.b64decode(payload, validate=True)))
+        if header == f"data:{mime};base64" and decoded.size == sent_size:
+            print(f"✓ Data URL round-trips ({decoded.format}, {decoded.size})")
+        else:
+            print(f"✗ Data URL mismatch: {header}, {decoded.size}")
+    except Exception as e:
+        print(f"✗ Data URL round-trip failed: {e}")
+
 def test_normalize_content():
     """Test content normalization."""
     print("\n" + "="*60)
@@ -216,6 +276,1284 @@ def test_all_modes():
             print(f"    Metadata: {result.get('metadata', {})}")
             print(f"    Content keys: {list(result.get('content', {}).keys())}")
 
+def test_near_duplicate_index():
+    """Test BK-tree search and near-duplicate cache reuse."""
+    print("\n" + "="*60)
+    print("TEST 8: Near-Duplicate Index")
+    print("="*60)
+
+    # BK-tree radius search must agree with a brute-force scan
+    rng = random.Random(7)
+    values = [rng.getrandbits(64) for _ in range(2000)]
+    values += [values[123] ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64)) for _ in range(50)]
+    tree = BKTree()
+    for i, v in enumerate(values):
+        tree.add(v, i)
+    probe = values[123] ^ 0b1011
+    expected = sorted(i for i, v in enumerate(values) if (v ^ probe).bit_count() <= 6)
+    got = sorted(i for _, i in tree.search(probe, 6))
+    if got == expected:
+        print(f"✓ BK-tree search matches brute force ({len(got)} hits)")
+    else:
+        print(f"✗ BK-tree search mismatch: {got} != {expected}")
+
+    # Two screenshots that differ only by a blinking cursor
+    base = Image.open(os.path.join(BASE_DIR, "ui_test.png")).convert("RGB")
+    first = os.path.join(BASE_DIR, "near_dup_a.png")
+    second = os.path.join(BASE_DIR, "near_dup_b.png")
+    base.save(first)
+    cursor = base.copy()
+    ImageDraw.Draw(cursor).line([(112, 160), (112, 190)], fill="black", width=2)
+    cursor.save(second)
+
+    fake = FakeCompletion({"elements": [{"type": "button", "label": "Submit", "bbox": [300, 350, 500, 400]}], "uncertainties": []})
+    try:
+        with patched(completion=fake, NEAR_DUP_MAX_DISTANCE=8):
+            examine_image(first, mode="ui")
+            result = examine_image(second, mode="ui")
+        near = result.get("metadata", {}).get("near_duplicate")
+        if fake.calls == 1 and near:
+            print(f"✓ Near-duplicate reused cached result (distance {near['distance']})")
+        else:
+            print(f"✗ Near-duplicate lookup failed: calls={fake.calls}, result={result}")
+    finally:
+        os.remove(first)
+        os.remove(second)
+
+    # A long-running server: the index stays bounded and probing evicted keys is not a cache miss
+    with tempfile.TemporaryDirectory() as tmp:
+        store = active_vision.SharedStore(os.path.join(tmp, "shared.sqlite"))
+        cache = active_vision.SharedCache(store, max_size=10, ttl=60)
+        index = active_vision.NearDuplicateIndex(10)
+        with patched(_CACHE=cache):
+            for i in range(500):
+                key = f"k{i}"
+                cache.set(key, {"n": i})
+                index.add("ui", rng.getrandbits(64), key, (100, 100))
+            index.add("ui", 0, "gone", (100, 100))
+            missing = index.lookup("ui", 1, (100, 100), 4)
+            stats = cache.stats()
+        entries = sum(tree.size for tree in index.trees.values())
+        store.conn.close()
+    if entries <= 20 and missing is None and stats["misses"] == 0:
+        print(f"✓ Index bounded at {entries} entries after 501 adds; evicted-key probes not counted as misses")
+    else:
+        print(f"✗ Index unbounded or probes counted: {entries} entries, {stats}")
+
+def test_connection_pooling():
+    """Test that provider calls reuse one pooled keep-alive connection."""
+    print("\n" + "="*60)
+    print("TEST 9: Connection Pooling")
+    print("="*60)
+
+    with MockProvider() as provider, patched(API_BASE=provider.url, MODEL_NAME="openai/mock-vision"):
+        active_vision._HTTP_POOL.warm([provider.url])
+        for name in ("general_test.png", "query_test.png", "ocr_test.png"):
+            result = examine_image(os.path.join(BASE_DIR, name), mode="general")
+            if "error" in result:
+                print(f"✗ Mock provider call failed: {result['error']}")
+        calls = len(provider.requests)
+        if calls == 3 and provider.connections == 1:
+            print(f"✓ {calls} calls (after warm-up) shared {provider.connections} connection")
+        else:
+            print(f"✗ Expected 3 calls over 1 connection, got {calls} over {provider.connections}")
+
+def test_rate_limit_and_breaker():
+    """Test AIMD rate control, Retry-After retries and the circuit breaker."""
+    print("\n" + "="*60)
+    print("TEST 10: Rate Limiting, Retries and Circuit Breaker")
+    print("="*60)
+
+    limiter = active_vision.AdaptiveRateLimiter(rpm=600)
+    limiter.on_throttle({})
+    halved = limiter.rpm
+    limiter.on_success({})
+    if halved == 300 and limiter.rpm == 330:
+        print(f"✓ AIMD: halved to {halved} rpm on 429, grew to {limiter.rpm} on success")
+    else:
+        print(f"✗ AIMD adjustment wrong: {halved} -> {limiter.rpm}")
+
+    image = os.path.join(BASE_DIR, "general_test.png")
+    with patched(RETRY_BASE_DELAY=0.01, BREAKER_FAILURE_THRESHOLD=3, MODEL_NAME="openai/mock-vision"):
+        # Two 429s with Retry-After, then success
+        replies = iter([
+            (429, {"error": {"message": "rate limited"}}, {"Retry-After": "0.05"}),
+            (429, {"error": {"message": "rate limited"}}, {"Retry-After": "0.05"}),
+        ])
+        responder = lambda body: next(replies, {"description": "ok", "main_objects": [], "uncertainties": []})
+        with MockProvider(responder) as provider, patched(API_BASE=provider.url):
+            result = examine_image(image, mode="general", region=[0, 0, 300, 300])
+            if "error" not in result and len(provider.requests) == 3:
+                print("✓ Recovered from two 429s by honouring Retry-After")
+            else:
+                print(f"✗ Retry failed: {result.get('error')} after {len(provider.requests)} requests")
+
+        # Provider down: breaker opens and later calls never reach it
+        down = lambda body: (503, {"error": {"message": "unavailable"}}, {})
+        with MockProvider(down) as provider, patched(API_BASE=provider.url):
+            for i in range(3):
+                examine_image(image, mode="general", region=[i, 0, 300, 300])
+            sent = len(provider.requests)
+            result = examine_image(image, mode="general", region=[9, 0, 300, 300])
+            if "circuit open" in result.get("error", "") and len(provider.requests) == sent:
+                print(f"✓ Circuit breaker failed fast after {sent} provider errors")
+            else:
+                print(f"✗ Circuit breaker did not open: {result}")
+
+    # Deadline expires while the half-open trial waits for the limiter: the trial is given back
+    guard = active_vision.ProviderGuard()
+    with patched(_PROVIDER_GUARD=guard, completion=FakeCompletion({"description": "ok"}), API_BASE=None):
+        limiter, breaker = guard.get(active_vision.MODEL_NAME)
+        breaker.opened_at = time.monotonic() - breaker.reset_seconds
+        limiter.acquire = lambda tokens: time.sleep(0.1)
+        token = active_vision._REQUEST_CTX.set(active_vision.RequestContext(deadline=time.monotonic() + 0.05))
+        try:
+            active_vision._completion(active_vision.MODEL_NAME, [])
+            expired = None
+        except active_vision.DeadlineExceeded as e:
+            expired = e
+        finally:
+            active_vision._REQUEST_CTX.reset(token)
+        try:
+            active_vision._completion(active_vision.MODEL_NAME, [])
+            state = breaker.state
+        except active_vision.CircuitOpenError as e:
+            state = str(e)
+    if expired is not None and state == "closed":
+        print("✓ Half-open trial released when its deadline passed; next call closed the circuit")
+    else:
+        print(f"✗ Breaker stuck after an expired trial: {expired!r}, {state}")
+
+def test_priority_scheduler():
+    """Test priority ordering, per-caller fairness, deadlines and cancellation."""
+    print("\n" + "="*60)
+    print("TEST 11: Priority Scheduler")
+    print("="*60)
+
+    RequestContext = active_vision.RequestContext
+    scheduler = active_vision.InferenceScheduler(1)
+    order = []
+
+    def worker(request, label):
+        try:
+            with scheduler.slot(request):
+                order.append(label)
+        except Exception as e:
+            order.append(f"{label}:{type(e).__name__}")
+
+    jobs = [
+        (RequestContext("bulk", caller="batch"), "bulk-1"),
+        (RequestContext("bulk", caller="batch"), "bulk-2"),
+        (RequestContext("bulk", caller="other"), "bulk-other"),
+        (RequestContext("interactive", caller="agent"), "click"),
+        (RequestContext("normal", deadline=time.monotonic() + 0.2, caller="agent"), "expiring"),
+        (RequestContext("normal", caller="agent"), "cancelled"),
+    ]
+    threads = []
+    with scheduler.slot(RequestContext(caller="holder")):
+        for request, label in jobs:
+            threads.append(threading.Thread(target=worker, args=(request, label)))
+            threads[-1].start()
+            time.sleep(0.01)
+        depth = scheduler.snapshot()["queue_depth"]
+        jobs[5][0].cancel()
+        scheduler.wake()
+        time.sleep(0.3)
+    for thread in threads:
+        thread.join(timeout=5)
+
+    expected = ["cancelled:RequestCancelled", "expiring:DeadlineExceeded", "click", "bulk-1", "bulk-other", "bulk-2"]
+    if depth == {"interactive": 1, "normal": 2, "bulk": 3} and order == expected:
+        print(f"✓ Queue depth {depth}; grant order {order}")
+    else:
+        print(f"✗ Unexpected scheduling: depth={depth}, order={order}")
+
+    result = examine_image(os.path.join(BASE_DIR, "ui_test.png"), mode="ui", priority="urgent")
+    if "Invalid priority" in result.get("error", ""):
+        print("✓ Unknown priority rejected")
+    else:
+        print(f"✗ Unknown priority accepted: {result}")
+
+def test_multi_frame():
+    """Test per-frame analysis of a multi-page TIFF with a duplicate page."""
+    print("\n" + "="*60)
+    print("TEST 12: Multi-Frame Images")
+    print("="*60)
+
+    pages = [Image.new("RGB", (400, 300), "red"), Image.new("RGB", (200, 100), "blue"),
+             Image.new("RGB", (200, 100), "blue"), Image.new("RGB", (300, 300), "green")]
+    path = os.path.join(BASE_DIR, "multi_page.tiff")
+    pages[0].save(path, save_all=True, append_images=pages[1:])
+
+    fake = FakeCompletion({"elements": [{"type": "button", "label": "OK", "bbox": [0.5, 0.5, 1.0, 1.0]}], "uncertainties": []})
+    try:
+        with patched(completion=fake):
+            result = examine_image(path, mode="ui", frames="all")
+            again = examine_image(path, mode="ui", frames=[1, 3])
+            empty = examine_image(path, mode="ui", frames=[])
+            cropped = examine_image(path, mode="ui", frames="all", content_crop="crop")
+            refined = examine_image(path, mode="ui", frames="all", refine_boxes=True)
+        frames = result.get("frames", [])
+        boxes = [f["content"]["elements"][0]["bbox"] for f in frames if "content" in f]
+        if (fake.calls == 3 and len(frames) == 4 and frames[2].get("duplicate_of") == 1
+                and boxes == [[200, 150, 399, 299], [100, 50, 199, 99], [150, 150, 299, 299]]):
+            print(f"✓ 4 pages, 3 model calls, page 2 deduped, per-page boxes {boxes}")
+        else:
+            print(f"✗ Unexpected multi-frame result: calls={fake.calls}, {result}")
+        if fake.calls == 3 and [f["index"] for f in again.get("frames", [])] == [1, 3]:
+            print("✓ Frame subset served from per-frame cache")
+        else:
+            print(f"✗ Per-frame cache miss: calls={fake.calls}, {again}")
+        if ("non-empty" in empty.get("error", "") and "frames supports" in cropped.get("error", "")
+                and "frames supports" in refined.get("error", "")):
+            print("✓ Empty frame list and frames with content_crop/refine_boxes rejected")
+        else:
+            print(f"✗ Unsupported frames arguments accepted: {empty} / {cropped} / {refined}")
+    finally:
+        os.remove(path)
+
+def make_test_clip(path, fps=10):
+    """Three 1-second scenes; the first has small motion that must not split it."""
+    import av
+    frames = []
+    for i in range(10):
+        img = Image.new("RGB", (160, 120), "white")
+        ImageDraw.Draw(img).rectangle([20 + i, 40, 60 + i, 80], fill="black")
+        frames.append(img)
+    frames += [Image.new("RGB", (160, 120), (20, 30, 120))] * 10
+    scene = Image.new("RGB", (160, 120), (240, 240, 240))
+    ImageDraw.Draw(scene).rectangle([10, 10, 150, 40], fill=(200, 30, 30))
+    frames += [scene] * 10
+    with av.open(path, "w") as container:
+        stream = container.add_stream("mpeg4", rate=fps)
+        stream.width, stream.height, stream.pix_fmt = 160, 120, "yuv420p"
+        for img in frames:
+            for packet in stream.encode(av.VideoFrame.from_image(img)):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+def make_text_pdf(pages, size=(612, 792)):
+    """A minimal PDF with a Helvetica text layer; pages are lists of (text, x, y, font size), y from the top."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for lines in pages:
+        stream = "".join(f"BT /F1 {pt} Tf {x} {size[1] - y - pt} Td ({text}) Tj ET\n" for text, x, y, pt in lines)
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}endstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {size[0]} {size[1]}] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{k} 0 R' for k in kids)}] /Count {len(kids)} >>"
+    out, offsets = "%PDF-1.4\n", []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return out.encode("latin-1")
+
+def test_video_keyframes():
+    """Test scene-change keyframe extraction on a synthetic clip."""
+    print("\n" + "="*60)
+    print("TEST 13: Video Keyframes")
+    print("="*60)
+
+    bad = [active_vision.examine_video("clip.mp4", sample_fps=0), active_vision.examine_video("clip.mp4", sample_fps=-2),
+           active_vision.examine_video("clip.mp4", scene_threshold=0), active_vision.examine_video("clip.mp4", scene_threshold=1.5)]
+    if all("sample_fps" in r.get("error", "") for r in bad[:2]) and all("scene_threshold" in r.get("error", "") for r in bad[2:]):
+        print("✓ Non-positive sample_fps and out-of-range scene_threshold rejected")
+    else:
+        print(f"✗ Bad sampling arguments accepted: {bad}")
+
+    try:
+        import av  # noqa: F401
+    except ImportError:
+        print("⚠ PyAV not installed (pip install -e '.[video]'), skipping")
+        return
+
+    path = os.path.join(BASE_DIR, "clip_test.mp4")
+    make_test_clip(path)
+    fake = FakeCompletion({"description": "scene", "main_objects": [], "uncertainties": []})
+    try:
+        with patched(completion=fake):
+            result = active_vision.examine_video(path, mode="general", sample_fps=5)
+        times = [kf["timestamp"] for kf in result.get("keyframes", [])]
+        if fake.calls == 3 and len(times) == 3 and times[1] == 1.0 and times[2] == 2.0:
+            print(f"✓ {result['metadata']['frames_sampled']} samples -> 3 keyframes at {times}")
+        else:
+            print(f"✗ Unexpected keyframes: calls={fake.calls}, {result}")
+
+        # Decoding and indexing read the validated descriptor; nothing reopens the path
+        index = active_vision.ResultIndex()
+        def refuse(cls, reopened):
+            raise AssertionError(f"reopened {reopened}")
+        reopen = active_vision.OpenFile.open
+        active_vision.OpenFile.open = classmethod(refuse)
+        try:
+            ocr_fake = FakeCompletion({"text_blocks": [{"text": "EXIT", "bbox": [1, 1, 20, 10]}], "uncertainties": []})
+            with patched(completion=ocr_fake, _RESULT_INDEX=index, _CACHE=active_vision.TTLCache(10, 60)):
+                indexed = active_vision.examine_video(path, mode="ocr", sample_fps=5)
+        finally:
+            active_vision.OpenFile.open = reopen
+        if "error" not in indexed and index.search("EXIT"):
+            print("✓ Keyframes decoded and indexed through the validated descriptor")
+        else:
+            print(f"✗ Video path reopened or not indexed: {indexed}")
+    finally:
+        os.remove(path)
+
+def test_content_crop():
+    """Test local content detection and the crop/mosaic coordinate mapping."""
+    print("\n" + "="*60)
+    print("TEST 14: Content Pre-Detection")
+    print("="*60)
+
+    img = Image.new("RGB", (1600, 1000), "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([100, 100, 300, 180], fill=(30, 30, 200))
+    draw.text((110, 200), "Hello world", fill="black")
+    draw.rectangle([1300, 800, 1500, 900], outline="black", width=3)
+    path = os.path.join(BASE_DIR, "sparse_test.png")
+    img.save(path)
+
+    boxes = active_vision._detect_content_boxes(img, (0, 0, 1600, 1000))
+    covered = [any(b[0] <= x1 and b[1] <= y1 and b[2] >= x2 and b[3] >= y2 for b in boxes)
+               for x1, y1, x2, y2 in ((100, 100, 300, 180), (1300, 800, 1500, 900))]
+    if len(boxes) == 2 and all(covered):
+        print(f"✓ Two content blocks detected: {boxes}")
+    else:
+        print(f"✗ Unexpected content boxes: {boxes}")
+
+    fake = FakeCompletion({"elements": [{"type": "button", "label": "OK", "bbox": [0.1, 0.1, 0.5, 0.4]}], "uncertainties": []})
+    try:
+        with patched(completion=fake):
+            cropped = examine_image(path, mode="ui", content_crop="crop")
+            mosaic = examine_image(path, mode="ui", content_crop="mosaic")
+            bad = examine_image(path, mode="ui", content_crop="zoom")
+        crop_meta = cropped["metadata"]["content_crop"]
+        sent = cropped["metadata"]["sent_size"]
+        if crop_meta["strategy"] == "crop" and sent["width"] * sent["height"] < 1600 * 1000:
+            print(f"✓ Crop sends {sent['width']}x{sent['height']} instead of 1600x1000")
+        else:
+            print(f"✗ Unexpected crop result: {cropped}")
+        meta = mosaic["metadata"]["content_crop"]
+        bbox = mosaic["content"]["elements"][0]["bbox"]
+        first = meta["regions"][0] if meta["regions"] else [0, 0, 0, 0]
+        if (meta["strategy"] == "mosaic" and len(meta["regions"]) == 2
+                and first[0] <= bbox[0] < bbox[2] <= first[2] and first[1] <= bbox[1] < bbox[3] <= first[3]):
+            print(f"✓ Mosaic of {meta['regions']} maps the box back to {bbox}")
+        else:
+            print(f"✗ Unexpected mosaic result: {mosaic}")
+        if "error" in bad:
+            print("✓ Unknown content_crop rejected")
+        else:
+            print(f"✗ Unknown content_crop accepted: {bad}")
+
+        paletted = img.convert("P", palette=Image.Palette.ADAPTIVE, colors=16)
+        plan = active_vision._plan_content_crop(paletted, None, "mosaic")
+        canvas = plan.get("canvas")
+        tile = next((dst for src, dst in plan.get("tiles", []) if src[0] <= 100 and src[1] <= 100), None)
+        colour = canvas.convert("RGB").getpixel((tile[0] + 50, tile[1] + 30)) if canvas and tile else None
+        if canvas is not None and canvas.mode == "P" and colour == (30, 30, 200):
+            print(f"✓ Palette kept on P-mode mosaics: {colour}")
+        else:
+            print(f"✗ Palette lost on mosaic: {colour}")
+    finally:
+        os.remove(path)
+
+def test_result_index():
+    """Test incremental indexing of OCR/UI results and search_images latency."""
+    print("\n" + "="*60)
+    print("TEST 15: Result Index")
+    print("="*60)
+
+    index = active_vision.ResultIndex()
+    path = os.path.join(BASE_DIR, "ocr_test.png")
+    fake = FakeCompletion({"text_blocks": [{"text": "Fatal: error code E-4012", "bbox": [10, 10, 200, 30]},
+                                           {"text": "Retry later", "bbox": [10, 40, 120, 60]}],
+                           "uncertainties": []})
+    with patched(completion=fake, _RESULT_INDEX=index):
+        examine_image(path, mode="ocr")
+        hit = active_vision.search_images("E-4012")
+        miss = active_vision.search_images("E-4013")
+    matches = hit.get("matches", [])
+    if (len(matches) == 1 and matches[0]["text"] == "Fatal: error code E-4012"
+            and matches[0]["bbox"] == [10, 10, 200, 30] and len(matches[0]["content_hash"]) == 64
+            and miss.get("matches") == []):
+        print(f"✓ Found E-4012 in {os.path.basename(matches[0]['path'])} at {matches[0]['bbox']}")
+    else:
+        print(f"✗ Unexpected search result: {hit} / {miss}")
+
+    rng = random.Random(7)
+    words = ["save", "cancel", "status", "error", "retry", "login", "submit", "warning", "ok", "total"]
+    for i in range(100):
+        content = {"text_blocks": [{"text": f"{rng.choice(words)} {rng.choice(words)} {i}-{j}", "bbox": [0, j, 10, j + 10]}
+                                   for j in range(1000)]}
+        index.add(f"/bulk/{i}.png", f"{i:064x}", "ocr", None, [(None, content)])
+    start = time.perf_counter()
+    result = index.search("login warning", limit=20)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if index.stats()["blocks"] >= 100000 and len(result) == 20 and elapsed_ms < 100:
+        print(f"✓ {index.stats()['blocks']} blocks, query in {elapsed_ms:.1f} ms")
+    else:
+        print(f"✗ Slow or wrong bulk query: {len(result)} matches in {elapsed_ms:.1f} ms")
+
+    index.add(f"/bulk/0.png", "f" * 64, "ocr", None, [(None, {"text_blocks": [{"text": "replaced", "bbox": None}]})])
+    if [m["path"] for m in index.search("replaced")] == ["/bulk/0.png"] and not index.search("0-5"):
+        print("✓ Changed content hash replaces the old rows")
+    else:
+        print("✗ Stale rows survived a content change")
+
+def test_prompt_prefix():
+    """Test that the system prompt is a stable, cacheable prefix."""
+    print("\n" + "="*60)
+    print("TEST 16: Prompt Prefix Reuse")
+    print("="*60)
+
+    usage = SimpleNamespace(prompt_tokens=2000, total_tokens=2100,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=1536))
+    fake = FakeCompletion({"text_blocks": [], "uncertainties": []}, usage=usage)
+    with patched(completion=fake, _METRICS=active_vision.Metrics(), _RESULT_INDEX=None,
+                 _CACHE=active_vision.TTLCache(10, 60)):
+        examine_image(os.path.join(BASE_DIR, "ocr_test.png"), mode="ocr")
+        examine_image(os.path.join(BASE_DIR, "ui_test.png"), mode="ocr")
+        metrics = active_vision.get_metrics()
+    systems = [r["messages"][0]["content"] for r in fake.requests]
+    user_texts = [r["messages"][1]["content"][0]["text"] for r in fake.requests]
+    if len(systems) == 2 and systems[0] == systems[1] and "Image is" not in systems[0]:
+        print("✓ Identical system prompt for different images")
+    else:
+        print(f"✗ System prompt varies: {systems}")
+    if all(t.startswith("Image is ") for t in user_texts) and user_texts[0] != user_texts[1]:
+        print(f"✓ Image size moved to the user message: {user_texts[0]!r}")
+    else:
+        print(f"✗ Unexpected user text: {user_texts}")
+    cache = metrics.get("prompt_cache", {})
+    if cache.get("token_hit_rate") == 0.768 and cache.get("request_hit_rate") == 1.0:
+        print(f"✓ Cached-prefix rates surfaced: {cache}")
+    else:
+        print(f"✗ Missing prompt cache metrics: {metrics}")
+
+    system = active_vision._system_message("ocr", True)
+    if system["content"][0]["cache_control"] == {"type": "ephemeral"} and active_vision._supports_cache_control("claude-3-5-sonnet-20241022"):
+        print("✓ cache_control breakpoint set for Anthropic models")
+    else:
+        print(f"✗ Missing cache_control: {system}")
+
+def test_box_refinement():
+    """Test snapping model boxes to local edges and flagging empty boxes."""
+    print("\n" + "="*60)
+    print("TEST 17: Grounded Box Refinement")
+    print("="*60)
+
+    img = Image.new("RGB", (1200, 800), (245, 245, 245))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([200, 300, 360, 340], fill=(37, 99, 235))
+    draw.text((220, 312), "Submit", fill="white")
+    path = os.path.join(BASE_DIR, "refine_test.png")
+    img.save(path)
+
+    fake = FakeCompletion({"elements": [{"type": "button", "label": "Submit", "bbox": [215, 285, 380, 330]},
+                                        {"type": "button", "label": "Ghost", "bbox": [900, 500, 1000, 560]}],
+                           "uncertainties": []})
+    try:
+        with patched(completion=fake):
+            result = examine_image(path, mode="ui", refine_boxes=True)
+        submit, ghost = result["content"]["elements"]
+        if all(abs(a - b) <= 3 for a, b in zip(submit["bbox"], [200, 300, 361, 341])) and not submit["refinement"]["empty"]:
+            print(f"✓ Box snapped {submit['refinement']['model_bbox']} -> {submit['bbox']} "
+                  f"(confidence {submit['refinement']['confidence']})")
+        else:
+            print(f"✗ Box not snapped to the button: {submit}")
+        if ghost["refinement"] == {"confidence": 0.0, "empty": True} and ghost["bbox"] == [900, 500, 1000, 560]:
+            print("✓ Box on empty background flagged")
+        else:
+            print(f"✗ Empty box not flagged: {ghost}")
+        if result["metadata"]["refinement"] == {"boxes": 2, "moved": 1, "empty": 1}:
+            print(f"✓ Refinement summary: {result['metadata']['refinement']}")
+        else:
+            print(f"✗ Unexpected refinement summary: {result['metadata']}")
+    finally:
+        os.remove(path)
+
+def test_lazy_imports():
+    """Test that importing the server does not pull in litellm."""
+    print("\n" + "="*60)
+    print("TEST 18: Lazy Imports")
+    print("="*60)
+
+    probe = ("import sys, time; start = time.perf_counter(); import active_vision; "
+             "print('litellm' in sys.modules, round(time.perf_counter() - start, 2))")
+    out = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    loaded, seconds = (out.stdout.split() + ["?", "?"])[:2]
+    if loaded == "False":
+        print(f"✓ import active_vision took {seconds}s without loading litellm")
+    else:
+        print(f"✗ litellm imported eagerly: {out.stdout} {out.stderr[-300:]}")
+
+    import litellm
+    error = litellm.exceptions.RateLimitError("slow down", llm_provider="openai", model="gpt-4o")
+    if active_vision._is_throttle(error) and active_vision._is_retryable(error):
+        print("✓ litellm exceptions recognised once loaded")
+    else:
+        print("✗ RateLimitError not classified as a throttle")
+
+def test_shared_store():
+    """Test the cache and rate limiter shared by worker processes through SQLite."""
+    print("\n" + "="*60)
+    print("TEST 19: Shared Cache and Rate Limiter")
+    print("="*60)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "shared.sqlite")
+        # Two stores on one file stand in for two worker processes
+        worker_a, worker_b = active_vision.SharedStore(db), active_vision.SharedStore(db)
+        cache_a = active_vision.SharedCache(worker_a, max_size=2, ttl=60)
+        cache_b = active_vision.SharedCache(worker_b, max_size=2, ttl=60)
+        cache_a.set("k1", {"mode": "ocr", "content": {"text_blocks": []}})
+        hit, miss = cache_b.get("k1"), cache_b.get("k2")
+        cache_b.set("k2", {"n": 2})
+        cache_b.set("k3", {"n": 3})
+        stats = cache_a.stats()
+        if (hit == {"mode": "ocr", "content": {"text_blocks": []}} and miss is None
+                and stats["entries"] == 2 and stats["hits"] == 1 and stats["misses"] == 1):
+            print(f"✓ Worker B hits worker A's entry; LRU bound kept; fleet stats {stats}")
+        else:
+            print(f"✗ Unexpected shared cache state: hit={hit}, miss={miss}, stats={stats}")
+
+        # Lookups are read-only: they go through while another worker holds the write lock
+        worker_b.conn.execute("PRAGMA busy_timeout = 200")
+        worker_a.conn.execute("BEGIN IMMEDIATE")
+        try:
+            locked_hit = cache_b.get("k3")
+        except sqlite3.OperationalError as e:
+            locked_hit = e
+        finally:
+            worker_a.conn.execute("ROLLBACK")
+        hits = cache_a.stats()["hits"]
+        if locked_hit == {"n": 3} and hits == 1 and cache_b.stats()["hits"] == 2:
+            print("✓ Hit served under another worker's write lock; counters flushed in a batch")
+        else:
+            print(f"✗ Lookup blocked or miscounted: {locked_hit}, hits before/after flush {hits}")
+
+        # 60 rpm allows a burst of 10 requests in total, not 10 per worker
+        limiter_a = active_vision.SharedRateLimiter(worker_a, "openai|", rpm=60)
+        limiter_b = active_vision.SharedRateLimiter(worker_b, "openai|", rpm=60)
+        for _ in range(5):
+            limiter_a.acquire()
+            limiter_b.acquire()
+        start = time.perf_counter()
+        limiter_b.acquire()
+        waited = time.perf_counter() - start
+        if 0.5 < waited < 3:
+            print(f"✓ Burst shared across workers; 11th request waited {waited:.2f}s")
+        else:
+            print(f"✗ Limiter not shared: 11th request waited {waited:.2f}s")
+        worker_a.conn.close()
+        worker_b.conn.close()
+
+    # Serving beyond loopback widens the DNS-rebinding check instead of dropping it
+    from mcp.server.transport_security import TransportSecurityMiddleware
+    previous = os.environ.pop("VISION_ALLOWED_HOSTS", None)
+    try:
+        bound = TransportSecurityMiddleware(active_vision._transport_security("10.0.0.5"))
+        os.environ["VISION_ALLOWED_HOSTS"] = "vision.internal"
+        named = TransportSecurityMiddleware(active_vision._transport_security("0.0.0.0"))
+    finally:
+        os.environ.pop("VISION_ALLOWED_HOSTS", None)
+        if previous is not None:
+            os.environ["VISION_ALLOWED_HOSTS"] = previous
+    if (bound.settings.enable_dns_rebinding_protection and bound._validate_host("10.0.0.5:8000")
+            and not bound._validate_host("evil.example:8000") and named._validate_host("vision.internal:8000")
+            and named._validate_origin("https://vision.internal") and not named._validate_origin("http://evil.example")):
+        print("✓ Host/Origin checks kept for non-loopback binds, widened to VISION_ALLOWED_HOSTS")
+    else:
+        print(f"✗ Unexpected transport security: {bound.settings} / {named.settings}")
+
+def test_in_memory_images():
+    """Test examining uploaded bytes and the hash-first, upload-on-miss flow."""
+    print("\n" + "="*60)
+    print("TEST 20: In-Memory Images")
+    print("="*60)
+
+    buffer = BytesIO()
+    Image.new("RGB", (320, 200), (200, 30, 30)).save(buffer, format="PNG")
+    data = buffer.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+    encoded = base64.b64encode(data).decode()
+
+    fake = FakeCompletion({"description": "red", "main_objects": [], "uncertainties": []})
+    with patched(completion=fake, _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None,
+                 _BLOBS=active_vision.BlobStore(1024 * 1024)):
+        first = examine_image(content_hash=digest)
+        uploaded = examine_image(image_data=f"data:image/png;base64,{encoded}", content_hash=digest)
+        again = examine_image(content_hash=digest)
+        by_uri = examine_image(f"image://sha256/{digest}")
+        mismatch = examine_image(image_data=encoded, content_hash="0" * 64)
+        not_image = examine_image(image_data=base64.b64encode(b"#!/bin/sh\necho hi").decode())
+        linked = examine_image(resource={"type": "resource_link", "uri": f"image://sha256/{digest}"})
+        embedded = examine_image(resource={"type": "resource", "resource": {
+            "uri": "screen://capture/1", "mimeType": "image/png", "blob": encoded}})
+        foreign = examine_image(resource={"uri": "https://example.com/shot.png"})
+        served = asyncio.run(active_vision.mcp.read_resource(f"image://sha256/{digest}"))
+
+    if first.get("upload_required") and first.get("content_hash") == digest:
+        print("✓ Unknown hash asks for an upload")
+    else:
+        print(f"✗ Unknown hash not reported: {first}")
+    if (uploaded.get("content", {}).get("description") == "red" and uploaded["metadata"]["content_hash"] == digest
+            and uploaded["metadata"]["original_size"] == {"width": 320, "height": 200}):
+        print(f"✓ Examined uploaded bytes as {uploaded['metadata']['original_path']}")
+    else:
+        print(f"✗ Upload not examined: {uploaded}")
+    if again == uploaded and by_uri == uploaded and fake.calls == 1:
+        print("✓ Hash-only and image:// calls served from cache")
+    else:
+        print(f"✗ Hash-only call missed the cache ({fake.calls} provider calls)")
+    if "does not match" in mismatch.get("error", "") and "not a supported image" in not_image.get("error", ""):
+        print("✓ Hash mismatch and non-image bytes rejected")
+    else:
+        print(f"✗ Bad uploads accepted: {mismatch} / {not_image}")
+    if (linked == uploaded and embedded.get("metadata", {}).get("content_hash") == digest
+            and "Unsupported resource URI" in foreign.get("error", "") and served and served[0].content == data):
+        print("✓ MCP resource links and embedded resources accepted; uploads readable as resources")
+    else:
+        print(f"✗ Resource input not handled: {linked} / {embedded} / {foreign}")
+
+def test_screenshot_fast_path():
+    """Test the text-preserving screenshot downscale and lossless palette PNGs."""
+    print("\n" + "="*60)
+    print("TEST 21: Screenshot Fast Path")
+    print("="*60)
+
+    # Flat UI with 1px rules and small text, at twice the ui-mode limit
+    img = Image.new("RGB", (5120, 2880), (250, 250, 250))
+    draw = ImageDraw.Draw(img)
+    for y in range(40, 2880, 60):
+        draw.line([(40, y), (5080, y)], fill=(60, 60, 60), width=1)
+        draw.text((60, y + 12), "Invoice 2024-118 total 1,204.50 EUR", fill=(20, 20, 20))
+    noise = Image.frombytes("RGB", (640, 480), random.Random(3).randbytes(640 * 480 * 3))
+    if active_vision._looks_like_screenshot(img) and not active_vision._looks_like_screenshot(noise):
+        print("✓ Screenshot detected, noise rejected")
+    else:
+        print("✗ Screenshot detection wrong")
+
+    def sent(fast):
+        with patched(SCREENSHOT_FAST_PATH=fast):
+            url, _, _, _, size = active_vision._process_image(img, None, "ui")
+        return Image.open(BytesIO(base64.b64decode(url.split(",", 1)[1]))).convert("L"), size
+
+    def rule_darkness(gray):
+        # Darkest pixel down a column crossing the rules (at half scale)
+        return 255 - min(gray.getpixel((1200, y)) for y in range(15, 45))
+
+    fast, fast_size = sent(True)
+    generic, _ = sent(False)
+    if fast_size == (2560, 1440) and rule_darkness(fast) > rule_darkness(generic):
+        print(f"✓ 1px rules kept darker: {rule_darkness(fast)} vs {rule_darkness(generic)} (bicubic)")
+    else:
+        print(f"✗ Fast path lost contrast: {rule_darkness(fast)} vs {rule_darkness(generic)}, size {fast_size}")
+
+    small = img.crop((0, 0, 1280, 720))
+    paletted = active_vision._exact_palette(small)
+    if paletted.mode == "P" and ImageChops.difference(paletted.convert("RGB"), small).getbbox() is None:
+        print(f"✓ Exact palette for {len(small.getcolors(256))} colours")
+    else:
+        print(f"✗ Palette conversion not lossless: {paletted.mode}")
+    if active_vision._exact_palette(noise) is noise:
+        print("✓ Many-colour images left as RGB")
+    else:
+        print("✗ Noise image was paletted")
+
+def test_compact_schema():
+    """Test that compact wire output expands into the usual envelope."""
+    print("\n" + "="*60)
+    print("TEST 22: Compact Wire Schema")
+    print("="*60)
+
+    path = os.path.join(BASE_DIR, "ocr_test.png")  # 800x400, sent unscaled
+    fake = FakeCompletion({"t": "Total | EUR|125|100|375|150\nno box here\n", "u": ["faint footer"]})
+    with patched(completion=fake, COMPACT_OUTPUT=True, _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None):
+        result = examine_image(path, mode="ocr")
+    system = fake.requests[0]["messages"][0]["content"]
+    blocks = result.get("content", {}).get("text_blocks", [])
+    if "one line per text block" in system and "bbox" not in system:
+        print("✓ Model asked for compact lines")
+    else:
+        print(f"✗ Verbose prompt sent: {system}")
+    if (blocks[:1] == [{"text": "Total | EUR", "bbox": [100, 40, 300, 60]}] and blocks[1]["bbox"] is None
+            and result["content"]["uncertainties"] == ["faint footer"]):
+        print(f"✓ Expanded to text_blocks with pixel boxes: {blocks[0]}")
+    else:
+        print(f"✗ Wrong expansion: {result}")
+
+    rows = active_vision._expand_compact({"e": [["button", "Save", 500, 500, 600, 550]], "u": []}, "ui", (1000, 800))
+    verbose = {"elements": [{"type": "button", "label": "Save", "bbox": [1, 2, 3, 4]}], "uncertainties": []}
+    if (rows["elements"] == [{"type": "button", "label": "Save", "bbox": [500.0, 400.0, 600.0, 440.0]}]
+            and active_vision._expand_compact(verbose, "ui", (1000, 800)) is verbose):
+        print("✓ Array rows expanded, verbose replies passed through")
+    else:
+        print(f"✗ Fallback parsing wrong: {rows}")
+
+def test_progressive():
+    """Test coarse-to-fine analysis: overview, full-resolution re-reads, merge."""
+    print("\n" + "="*60)
+    print("TEST 23: Progressive Analysis")
+    print("="*60)
+
+    path = os.path.join(BASE_DIR, "progressive_test.png")
+    Image.new("RGB", (5120, 2880), (250, 250, 250)).save(path)
+    requests = []
+
+    def fake(**kwargs):
+        text = kwargs["messages"][1]["content"][0]["text"]
+        requests.append(text)
+        if "reduced overview" in text:  # 1280x720 overview, 4x smaller
+            payload = {"text_blocks": [{"text": "Title", "bbox": [10, 10, 300, 40]},
+                                       {"text": "blur", "bbox": [610, 310, 690, 320]}],
+                       "uncertain_regions": [[600, 300, 700, 360]], "uncertainties": ["tiny log text"]}
+        else:
+            payload = {"text_blocks": [{"text": "ERR 42", "bbox": [24, 24, 124, 40]}], "uncertainties": []}
+        message = SimpleNamespace(content=json.dumps(payload))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+    try:
+        with patched(completion=fake, _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None):
+            result = examine_image(path, mode="ocr", progressive=True)
+            rejected = examine_image(path, mode="general", progressive=True)
+        blocks = result.get("content", {}).get("text_blocks", [])
+        progress = result.get("metadata", {}).get("progressive", {})
+        if len(requests) == 2 and progress.get("regions") == [[2376, 1176, 2824, 1464]]:
+            print(f"✓ Overview plus one full-resolution re-read of {progress['regions'][0]}")
+        else:
+            print(f"✗ Unexpected calls/regions: {len(requests)} / {progress}")
+        if blocks == [{"text": "Title", "bbox": [40, 40, 1200, 160]}, {"text": "ERR 42", "bbox": [2400, 1200, 2500, 1216]}]:
+            print("✓ Overview guess replaced by the re-read, both in original coordinates")
+        else:
+            print(f"✗ Wrong merge: {blocks}")
+        if progress.get("pixels_sent", 0) < progress.get("full_resolution_pixels", 0) / 10:
+            print(f"✓ Sent {progress['pixels_sent']} of {progress['full_resolution_pixels']} pixels")
+        else:
+            print(f"✗ Too many pixels sent: {progress}")
+        if "error" in rejected:
+            print("✓ Rejected for general mode")
+        else:
+            print("✗ progressive accepted for general mode")
+
+        # Compact overviews flag regions on the 0-1000 grid too
+        Image.new("RGB", (4000, 2000), (250, 250, 250)).save(path)
+        compact = FakeCompletion({"t": "Title|10|10|300|40", "u": [], "uncertain_regions": [[500, 500, 1000, 1000]]})
+        with patched(completion=compact, COMPACT_OUTPUT=True, _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None):
+            result = examine_image(path, mode="ocr", progressive=True)
+        regions = result.get("metadata", {}).get("progressive", {}).get("regions", [])
+        covered = [min(r[0] for r in regions), min(r[1] for r in regions),
+                   max(r[2] for r in regions), max(r[3] for r in regions)] if regions else None
+        if covered == [1976, 976, 4000, 2000]:
+            print(f"✓ Compact grid region re-read in original coordinates: {covered}")
+        else:
+            print(f"✗ Compact uncertain_regions mis-scaled: {regions}")
+    finally:
+        os.remove(path)
+
+def test_hedging():
+    """Test hedged requests: adaptive threshold, first answer wins, budget cap."""
+    print("\n" + "="*60)
+    print("TEST 24: Hedged Requests")
+    print("="*60)
+
+    histogram = active_vision.LatencyHistogram()
+    for i in range(1, 101):
+        histogram.observe(i / 100)
+    p50, p95 = histogram.percentile(50), histogram.percentile(95)
+    if 0.5 <= p50 <= 0.55 and 0.95 <= p95 <= 1.05:
+        print(f"✓ Rolling histogram: p50 {p50:.3f}s, p95 {p95:.3f}s")
+    else:
+        print(f"✗ Wrong percentiles: p50 {p50}, p95 {p95}")
+
+    bases = {}
+    def fake(**kwargs):
+        bases[kwargs["model"]] = kwargs.get("api_base")
+        if kwargs["model"] != "openai/backup":
+            time.sleep(1.0)  # the primary stalls
+        message = SimpleNamespace(content=json.dumps({"description": kwargs["model"], "main_objects": [], "uncertainties": []}))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+    active_vision._supports_cache_control(active_vision.MODEL_NAME)  # loads litellm outside the timings
+    fast = active_vision.LatencyHistogram()
+    for _ in range(30):
+        fast.observe(0.05)
+    with patched(completion=fake, HEDGE_MODEL="openai/backup", HEDGE_MIN_DELAY=0.05, _LATENCY=fast, API_BASE="http://gateway:4000",
+                 _HEDGE_BUDGET=active_vision.HedgeBudget(0.5, burst=1), _METRICS=active_vision.Metrics(),
+                 _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None):
+        start = time.perf_counter()
+        hedged = examine_image(os.path.join(BASE_DIR, "general_test.png"))
+        hedged_s = time.perf_counter() - start
+        start = time.perf_counter()
+        capped = examine_image(os.path.join(BASE_DIR, "query_test.png"))
+        capped_s = time.perf_counter() - start
+        metrics = active_vision.get_metrics()
+
+    if hedged.get("content", {}).get("description") == "openai/backup" and hedged_s < 0.5:
+        print(f"✓ Hedge answered a stalled call in {hedged_s:.2f}s")
+    else:
+        print(f"✗ Hedge did not win: {hedged} after {hedged_s:.2f}s")
+    if bases.get("openai/backup") == "http://gateway:4000":
+        print("✓ Hedge without VISION_HEDGE_API_BASE keeps VISION_API_BASE")
+    else:
+        print(f"✗ Hedge dropped the API base: {bases}")
+    if capped.get("content", {}).get("description") == active_vision.MODEL_NAME and capped_s >= 1.0:
+        print("✓ Budget exhausted: second call waited for the primary")
+    else:
+        print(f"✗ Budget not enforced: {capped} after {capped_s:.2f}s")
+    hedging = metrics.get("hedging", {})
+    if hedging.get("hedge_rate") == 0.5 and hedging.get("win_rate") == 1.0 and hedging.get("budget_denied") == 1:
+        print(f"✓ Hedge metrics: {hedging}")
+    else:
+        print(f"✗ Unexpected hedge metrics: {hedging}")
+
+def test_batch_jobs():
+    """Test offline batch jobs against the mock Batch API: submit, poll, apply, persist."""
+    print("\n" + "="*60)
+    print("TEST 25: Batch Jobs")
+    print("="*60)
+
+    def responder(body):
+        return {"text_blocks": [{"text": "batched", "bbox": [10, 10, 50, 30]}], "uncertainties": []}
+
+    paths = [os.path.join(BASE_DIR, "ocr_test.png"), os.path.join(BASE_DIR, "ui_test.png"), "/etc/passwd"]
+    with tempfile.TemporaryDirectory() as tmp, MockProvider(responder, batch_delay=0.2) as provider:
+        store = active_vision.BatchJobStore(tmp)
+        cache = active_vision.TTLCache(10, 60)
+        with patched(API_BASE=provider.url, _BATCH_JOBS=store, BATCH_POLL_SECONDS=0.05, _CACHE=cache,
+                     _RESULT_INDEX=None):
+            submitted = active_vision.submit_batch_job(paths, mode="ocr")
+            job_id = submitted.get("job_id", "")
+            running = active_vision.get_batch_job(job_id)
+            done = active_vision.get_batch_job(job_id, wait_seconds=5, limit=10)
+            chat_before = len(provider.requests)
+            cached = examine_image(paths[0], mode="ocr")
+            chat_after = len(provider.requests)
+            resubmitted = active_vision.submit_batch_job(paths[:2], mode="ocr")
+        persisted = store.load(job_id) if job_id else {}
+
+    counts = done.get("counts", {})
+    if submitted.get("status") == "in_progress" and submitted["counts"]["skipped"] == 1:
+        print(f"✓ Submitted {submitted['counts']['pending']} images in {len(submitted['shards'])} provider batch")
+    else:
+        print(f"✗ Unexpected submission: {submitted}")
+    if running.get("status") == "in_progress" and done.get("status") == "completed" and counts.get("succeeded") == 2:
+        print(f"✓ Polled to completion: {counts}")
+    else:
+        print(f"✗ Job did not complete: {done}")
+    results = done.get("results", [])
+    boxes = [r["content"]["text_blocks"][0]["bbox"] for r in results]
+    if len(results) == 2 and all(r["metadata"]["batch_job"] == job_id for r in results) and all(
+            len(b) == 4 for b in boxes):
+        print(f"✓ Results repaired and mapped to original coordinates: {boxes}")
+    else:
+        print(f"✗ Unexpected results: {results}")
+    if cached.get("content", {}).get("text_blocks", [{}])[0].get("text") == "batched" and chat_after == chat_before:
+        print("✓ examine_image answered from the batch result without a model call")
+    else:
+        print(f"✗ Batch result not cached: {cached}")
+    if resubmitted.get("counts", {}).get("cached") == 2 and not resubmitted.get("shards"):
+        print("✓ Already-analyzed images are not resubmitted")
+    else:
+        print(f"✗ Cached images were resubmitted: {resubmitted}")
+    if persisted.get("status") == "completed" and len(persisted.get("items", {})) == 3:
+        print("✓ Job state persisted to disk")
+    else:
+        print(f"✗ Job state not persisted: {persisted}")
+
+    # Directories are only listed inside the base, and symlinks out of it are not followed
+    with tempfile.TemporaryDirectory(dir=BASE_DIR) as inside, tempfile.TemporaryDirectory() as outside:
+        os.makedirs(os.path.join(outside, "sub"))
+        Image.new("RGB", (8, 8)).save(os.path.join(outside, "sub", "private.png"))
+        Image.new("RGB", (8, 8)).save(os.path.join(inside, "scan.png"))
+        os.symlink(outside, os.path.join(inside, "link"))
+        listed = active_vision._batch_inputs([outside, inside])
+    if listed == [outside, os.path.join(inside, "scan.png")]:
+        print("✓ Outside directories not walked; symlinked escapes skipped")
+    else:
+        print(f"✗ Batch inputs leaked outside the base: {listed}")
+
+def test_spatial_queries():
+    """Test element_at / elements_in_region / find_element over a cached ui result."""
+    print("\n" + "="*60)
+    print("TEST 26: Spatial Queries")
+    print("="*60)
+
+    fake = FakeCompletion({"elements": [
+        {"type": "panel", "label": "Settings", "bbox": [50, 50, 400, 300]},
+        {"type": "button", "label": "Save", "bbox": [100, 100, 200, 140]},
+        {"type": "button", "label": "Cancel", "bbox": [220, 100, 320, 140]},
+        {"type": "input", "label": "Search files", "bbox": [60, 200, 300, 230]},
+    ], "uncertainties": []})
+    path = os.path.join(BASE_DIR, "ui_test.png")
+    with patched(completion=fake, _CACHE=active_vision.TTLCache(10, 60), _SPATIAL=active_vision.TTLCache(10, 60),
+                 _RESULT_INDEX=None):
+        first = active_vision.element_at(path, 150, 120)
+        again = active_vision.element_at(path, 150, 120)
+        region = active_vision.elements_in_region(path, [90, 90, 330, 150], contained=True)
+        exact = active_vision.find_element(path, "  SAVE ")
+        fuzzy = active_vision.find_element(path, "Serch")
+        strict = active_vision.find_element(path, "Serch", fuzzy=False)
+        typed = active_vision.find_element(path, "Settings", element_type="button")
+        outside = active_vision.element_at(path, 700, 500)
+
+    labels = [m["label"] for m in first.get("matches", [])]
+    if first.get("source") == "inference" and labels == ["Save", "Settings"]:
+        print(f"✓ Hit test without a cached result analyzed once: {labels}")
+    else:
+        print(f"✗ Unexpected first hit test: {first}")
+    if again.get("source") == "cache" and fake.calls == 1 and again["elapsed_ms"] < 5:
+        print(f"✓ Repeat answered from the cache in {again['elapsed_ms']} ms, no model call")
+    else:
+        print(f"✗ Repeat was not local: {again}, calls={fake.calls}")
+    if [m["label"] for m in region.get("matches", [])] == ["Save", "Cancel"]:
+        print("✓ elements_in_region returns contained boxes in reading order")
+    else:
+        print(f"✗ Unexpected region query: {region}")
+    best = exact.get("matches", [{}])[0]
+    if best.get("label") == "Save" and best.get("score") == 1.0 and best.get("center") == [150, 120]:
+        print("✓ find_element exact match with click point")
+    else:
+        print(f"✗ Unexpected exact match: {exact}")
+    if fuzzy.get("matches", [{}])[0].get("label") == "Search files" and strict.get("matches") == []:
+        print("✓ Fuzzy matching finds near labels; strict mode does not")
+    else:
+        print(f"✗ Unexpected fuzzy results: {fuzzy} / {strict}")
+    if typed.get("matches") == [] and outside.get("matches") == []:
+        print("✓ Type filter and empty hit tests")
+    else:
+        print(f"✗ Unexpected filtered results: {typed} / {outside}")
+
+def test_image_pyramid():
+    """Test the tiled pyramid store: streamed build, lazy region reads, size limit lifted."""
+    print("\n" + "="*60)
+    print("TEST 27: Image Pyramids")
+    print("="*60)
+
+    img = Image.new("RGB", (3000, 2000), (200, 30, 30))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([1500, 0, 2999, 999], fill=(30, 200, 30))
+    draw.rectangle([0, 1000, 1499, 1999], fill=(30, 30, 200))
+    for x in range(0, 3000, 97):
+        draw.line([x, 0, x + 500, 1999], fill=(255, 255, 0), width=3)
+
+    sent = []
+    def fake(**kwargs):
+        url = kwargs["messages"][1]["content"][1]["image_url"]["url"]
+        sent.append(Image.open(BytesIO(base64.b64decode(url.split(",", 1)[1]))).convert("RGB"))
+        message = SimpleNamespace(content=json.dumps({"description": "map", "main_objects": [], "uncertainties": []}))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+    with tempfile.TemporaryDirectory(dir=BASE_DIR) as tmp:
+        bmp, png = os.path.join(tmp, "scan.bmp"), os.path.join(tmp, "scan.png")
+        img.save(bmp)
+        img.save(png)
+        with open(png, "rb") as f:
+            png_data = base64.b64encode(f.read()).decode()
+        store = active_vision.PyramidStore(os.path.join(tmp, "pyramids"), 256, 1 << 30)
+        metrics = active_vision.Metrics()
+        default_limit = Image.MAX_IMAGE_PIXELS
+        with patched(completion=fake, MAX_FILE_SIZE_MB=5, PYRAMID_MIN_PIXELS=1_000_000, _PYRAMIDS=store,
+                     _METRICS=metrics, _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None):
+            # A 6 MP image is over three times this limit: only the pyramid path may read it
+            Image.MAX_IMAGE_PIXELS = 2_000_000
+            try:
+                bomb = examine_image(image_data=png_data)
+                green = examine_image(bmp, region=[1500, 0, 3000, 1000])
+                png_bomb = examine_image(png, region=[0, 0, 1000, 1000])
+            finally:
+                Image.MAX_IMAGE_PIXELS = default_limit
+            start = time.perf_counter()
+            blue = examine_image(bmp, region=[0, 1000, 1500, 2000])
+            repeat_s = time.perf_counter() - start
+            refused = examine_image(bmp, refine_boxes=True)
+            whole = examine_image(png)
+            with patched(MAX_FILE_SIZE_MB=0.01):
+                compressed = examine_image(png, region=[0, 0, 1000, 1000])
+            counters = metrics.snapshot()["counters"]
+            pyramid = store.get(active_vision._validate_path(bmp, 100))
+            exact = pyramid.read((1234, 567, 2345, 1678), (1111, 1111))
+            overview = pyramid.read((0, 0, 3000, 2000), (700, 460))
+
+    colors = [im.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0)) for im in sent]
+    if ("decompression bomb" in bomb.get("error", "") and "decompression bomb" in png_bomb.get("error", "")
+            and default_limit == int(1024 * 1024 * 1024 // 4 // 3)):
+        print("✓ Pillow's decompression-bomb limit untouched; uploads and compressed files still hit it")
+    else:
+        print(f"✗ Decompression-bomb limit changed or bypassed: {default_limit}, {bomb}, {png_bomb}")
+    if ("error" not in green and green["metadata"]["original_size"] == {"width": 3000, "height": 2000}
+            and colors[0][1] > 150 and colors[1][2] > 150):
+        print(f"✓ 18 MB BMP over the 5 MB limit served by region: {colors[:2]}")
+    else:
+        print(f"✗ Unexpected pyramid results: {green} {colors}")
+    if counters.get("pyramid.builds") == 2 and counters.get("pyramid.streamed_builds") == 1:
+        print(f"✓ One build per image (BMP streamed in strips); repeat crop took {repeat_s * 1000:.1f} ms")
+    else:
+        print(f"✗ Unexpected build counters: {counters}")
+    if "error" in refused and "error" not in whole and whole["metadata"]["sent_size"]["width"] == 1536:
+        print("✓ Options needing a full decode refused for oversized files; large PNG downscaled from the pyramid")
+    else:
+        print(f"✗ Unexpected option handling: {refused} / {whole}")
+    if "Compressed images over" in compressed.get("error", ""):
+        print("✓ Compressed files over the size limit refused instead of decoded whole")
+    else:
+        print(f"✗ Oversized PNG accepted: {compressed}")
+    if ImageChops.difference(exact, img.crop((1234, 567, 2345, 1678))).getbbox() is None and overview.size == (750, 500):
+        print(f"✓ Level-0 reads are pixel-exact; overview read from level {pyramid.level_for((0, 0, 3000, 2000), (700, 460))}")
+    else:
+        print(f"✗ Pyramid read mismatch: {overview.size}")
+
+def test_record_replay():
+    """Test recording provider traffic and replaying it offline with original or scaled timing."""
+    print("\n" + "="*60)
+    print("TEST 28: Record / Replay")
+    print("="*60)
+
+    def provider(**kwargs):
+        time.sleep(0.3)
+        if "JSON fixer" in json.dumps(kwargs["messages"]):
+            content = json.dumps({"text_blocks": [{"text": "INVOICE 42", "bbox": [10, 10, 110, 30]}], "uncertainties": []})
+        else:
+            content = "Here you go: {'text_blocks': [INVOICE 42 at 10,10]"  # needs the repair model
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+    def offline(**kwargs):
+        raise AssertionError("replay must not call the provider")
+
+    path = os.path.join(BASE_DIR, "ocr_test.png")
+    with tempfile.TemporaryDirectory() as tmp:
+        log = os.path.join(tmp, "traffic.jsonl")
+        with patched(completion=provider, _TRAFFIC=active_vision.TrafficRecorder(log),
+                     _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None):
+            recorded = examine_image(path, mode="ocr")
+        with open(log) as f:
+            entries = [json.loads(line) for line in f]
+        timings = {}
+        for speed in (1.0, 0):
+            with patched(completion=offline, _TRAFFIC=active_vision.TrafficReplayer(log, speed),
+                         _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None):
+                start = time.perf_counter()
+                replayed = examine_image(path, mode="ocr")
+                timings[speed] = time.perf_counter() - start
+                missed = examine_image(os.path.join(BASE_DIR, "ui_test.png"), mode="ocr")
+
+    if len(entries) == 2 and all(0.25 < e["latency"] < 1 for e in entries) and "base64," not in json.dumps(entries) \
+            and ";sha256," in json.dumps(entries[0]["request"]):
+        print("✓ Recorded vision and repair calls with latencies and image hashes, no image bytes")
+    else:
+        print(f"✗ Unexpected recording: {json.dumps(entries)[:300]}")
+    if replayed == recorded and replayed["content"]["text_blocks"][0]["text"] == "INVOICE 42":
+        print("✓ Replay reproduces the envelope through repair and coordinate mapping")
+    else:
+        print(f"✗ Replay differs: {replayed} vs {recorded}")
+    if timings[1.0] >= 0.6 and timings[0] < 0.3:
+        print(f"✓ Original timing {timings[1.0]:.2f}s, instant replay {timings[0]:.3f}s")
+    else:
+        print(f"✗ Unexpected replay timing: {timings}")
+    if "No recorded response" in missed.get("error", ""):
+        print("✓ Unrecorded requests fail instead of reaching the provider")
+    else:
+        print(f"✗ Unexpected miss handling: {missed}")
+
+def test_cache_snapshots():
+    """Test exporting cached results, warm-starting a fresh cache from a snapshot, and merging."""
+    print("\n" + "="*60)
+    print("TEST 29: Cache Snapshots")
+    print("="*60)
+
+    def offline(**kwargs):
+        raise AssertionError("a snapshot hit must not call the provider")
+
+    fake = FakeCompletion({"text_blocks": [{"text": "WARM", "bbox": [10, 10, 90, 30]}], "uncertainties": []})
+    path = os.path.join(BASE_DIR, "ocr_test.png")
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    with tempfile.TemporaryDirectory() as tmp:
+        with patched(completion=fake, _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None,
+                     _SNAPSHOTS=active_vision.SnapshotSet(), SNAPSHOT_DIR=tmp):
+            original = examine_image(path, mode="ocr")
+            exported = active_vision.export_cache_snapshot("node-a.snap")
+        with patched(PROMPT_VERSION="0-old"):
+            writer = active_vision.SnapshotWriter(os.path.join(tmp, "old.snap"))
+            writer.add("content:" + "ab" * 16, {"mode": "ocr", "metadata": {"prompt_version": "0-old"}})
+            writer.close()
+        with patched(completion=offline, _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None,
+                     _SNAPSHOTS=active_vision.SnapshotSet(), SNAPSHOT_DIR=tmp):
+            stale = active_vision.import_cache_snapshot("old.snap")
+            attached = active_vision.import_cache_snapshot("node-a.snap")
+            start = time.perf_counter()
+            warm = examine_image(path, mode="ocr")
+            elapsed = time.perf_counter() - start
+            by_hash = examine_image(content_hash=digest, mode="ocr")
+            other_mode = examine_image(content_hash=digest, mode="ui")
+            merged = active_vision.export_cache_snapshot("fleet.snap", merge=["old.snap", "node-a.snap"])
+            escape = active_vision.import_cache_snapshot("../node-a.snap")
+            metrics = active_vision.get_metrics()
+
+    if exported.get("entries") == 1 and exported.get("skipped_stale") == 0 and fake.calls == 1:
+        print(f"✓ Exported {exported['entries']} content-keyed result ({exported['bytes']} bytes)")
+    else:
+        print(f"✗ Unexpected export: {exported}")
+    if attached.get("attached") and stale.get("attached") is False and stale.get("prompt_version") == "0-old":
+        print("✓ Current snapshot attached; one from an older prompt version refused")
+    else:
+        print(f"✗ Unexpected attach results: {attached} / {stale}")
+    if warm == original and elapsed < 0.5 and warm["content"]["text_blocks"][0]["text"] == "WARM":
+        print(f"✓ Fresh cache answered from the snapshot in {elapsed * 1000:.1f} ms, no provider call")
+    else:
+        print(f"✗ Snapshot did not warm the cache: {warm}")
+    if (by_hash.get("content") == original["content"] and other_mode.get("upload_required")
+            and by_hash["metadata"]["original_path"] == f"image://sha256/{digest}"):
+        print("✓ Hash-only request served from the snapshot; other modes still ask for an upload")
+    else:
+        print(f"✗ Unexpected hash lookups: {by_hash} / {other_mode}")
+    if merged.get("entries") == 1 and merged.get("skipped_stale") == 1 and "Invalid snapshot name" in escape.get("error", ""):
+        print("✓ Merge drops stale snapshots; names are confined to VISION_SNAPSHOT_DIR")
+    else:
+        print(f"✗ Unexpected merge or name handling: {merged} / {escape}")
+    if metrics.get("counters", {}).get("snapshot.hits", 0) >= 1 and len(metrics.get("snapshots", [])) == 1:
+        print(f"✓ Metrics report {metrics['counters']['snapshot.hits']} snapshot hits")
+    else:
+        print(f"✗ Snapshot metrics missing: {metrics.get('snapshots')}")
+
+def test_file_access():
+    """Test the open-once file access: no path stats per call, reads pinned to the validated file."""
+    print("\n" + "="*60)
+    print("TEST 30: File Access")
+    print("="*60)
+
+    fake = FakeCompletion({"description": "red", "main_objects": [], "uncertainties": []})
+    with tempfile.TemporaryDirectory(dir=BASE_DIR) as tmp, tempfile.TemporaryDirectory() as outside:
+        target = os.path.join(tmp, "shot.png")
+        Image.new("RGB", (64, 48), (255, 0, 0)).save(target)
+        Image.new("RGB", (64, 48), (0, 0, 255)).save(os.path.join(tmp, "other.png"))
+        Image.new("RGB", (8, 8)).save(os.path.join(outside, "secret.png"))
+        os.symlink(os.path.join(outside, "secret.png"), os.path.join(tmp, "escape.png"))
+        os.symlink(target, os.path.join(tmp, "alias.png"))
+
+        with patched(completion=fake, _CACHE=active_vision.TTLCache(10, 60), _RESULT_INDEX=None):
+            examine_image(target)
+            calls, lstats = [], []
+            real_stat, real_lstat = os.stat, os.lstat
+            os.stat = lambda *a, **k: calls.append(a[0]) or real_stat(*a, **k)
+            os.lstat = lambda *a, **k: lstats.append(a[0]) or real_lstat(*a, **k)
+            try:
+                hit = examine_image(target)
+            finally:
+                os.stat, os.lstat = real_stat, real_lstat
+            alias = examine_image(os.path.join(tmp, "alias.png"))
+            escape = examine_image(os.path.join(tmp, "escape.png"))
+            directory = examine_image(tmp)
+
+        # Paths outside the base are refused before anything is opened: a FIFO's writer stays blocked
+        fifo = os.path.join(outside, "fifo")
+        os.mkfifo(fifo)
+        writer = threading.Thread(target=lambda: open(fifo, "wb").close(), daemon=True)
+        writer.start()
+        time.sleep(0.1)  # let the writer block in open()
+        fifo_result = examine_image(fifo)
+        writer.join(timeout=0.3)
+        fifo_untouched = writer.is_alive()
+        if fifo_untouched:
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))  # release the writer
+        writer.join(timeout=1)
+
+        with active_vision._open_validated(target) as opened:
+            os.replace(os.path.join(tmp, "other.png"), target)
+            with active_vision._open_image(opened) as img:
+                pinned = img.convert("RGB").getpixel((0, 0))
+
+    depth = len(Path(target).parts)
+    if hit.get("content", {}).get("description") == "red" and fake.calls == 1 and not calls and len(lstats) <= depth:
+        print(f"✓ Cache hit validated the path with no stat calls and {len(lstats)} lstat calls to resolve it")
+    else:
+        print(f"✗ Unexpected path syscalls on a cache hit: {calls} / {lstats}")
+    if "outside" in fifo_result.get("error", "") and fifo_untouched:
+        print("✓ FIFO outside the base rejected without being opened")
+    else:
+        print(f"✗ Outside path opened before the check: {fifo_result}, writer blocked={fifo_untouched}")
+    if alias.get("content") and "outside" in escape.get("error", "") and "Not a regular file" in directory.get("error", ""):
+        print("✓ Symlinks inside the base allowed; escapes and directories rejected")
+    else:
+        print(f"✗ Unexpected validation: {alias} / {escape} / {directory}")
+    if pinned == (255, 0, 0):
+        print("✓ Reads stay on the validated file after the path is replaced")
+    else:
+        print(f"✗ Read followed the replaced path: {pinned}")
+
+def test_pdf_documents():
+    """Test PDF pages: text-layer ocr without the model, lazy per-page rasterizing, page-point coordinates."""
+    print("\n" + "="*60)
+    print("TEST 31: PDF Documents")
+    print("="*60)
+
+    try:
+        import pypdfium2  # noqa: F401
+    except ImportError:
+        print("⚠ pypdfium2 not installed (pip install -e '.[pdf]'), skipping")
+        return
+
+    fake = FakeCompletion({"text_blocks": [{"text": "STAMP", "bbox": [0, 0, 100, 50]}], "uncertainties": []})
+    with tempfile.TemporaryDirectory(dir=BASE_DIR) as tmp:
+        invoice, scan = os.path.join(tmp, "invoice.pdf"), os.path.join(tmp, "scan.pdf")
+        with open(invoice, "wb") as f:
+            f.write(make_text_pdf([[("INVOICE 42", 72, 72, 24), ("Total: 99.00", 72, 200, 12)],
+                                   [("Page two", 100, 100, 18)]]))
+        sheets = [Image.new("RGB", (612, 792), "white") for _ in range(3)]
+        sheets[0].save(scan, save_all=True, append_images=sheets[1:])
+        with open(scan, "rb") as f:
+            scan_data = base64.b64encode(f.read()).decode()
+
+        with patched(completion=fake, _CACHE=active_vision.TTLCache(20, 60), _RESULT_INDEX=None):
+            text = examine_image(invoice, mode="ocr", pages="all")
+            total = examine_image(invoice, mode="ocr", region=[0, 150, 300, 300])
+            scanned = examine_image(scan, mode="ocr", pages=[2], region=[306, 396, 612, 792])
+            calls_after_one = fake.calls
+            both = examine_image(scan, mode="ocr", pages=[0, 2], region=[306, 396, 612, 792])
+            uploaded = examine_image(image_data=scan_data, mode="ocr", pages=[2], region=[306, 396, 612, 792])
+            calls_after_upload = fake.calls
+            described = examine_image(invoice, mode="general")
+            out_of_range = examine_image(invoice, pages=[5])
+            not_pdf = examine_image(os.path.join(BASE_DIR, "ui_test.png"), pages=[0])
+
+    blocks = [b["text"] for p in text.get("pages", []) for b in p["content"]["text_blocks"]]
+    first = text.get("pages", [{}])[0].get("content", {}).get("text_blocks", [{}])[0]
+    if blocks == ["INVOICE 42", "Total: 99.00", "Page two"] and text["metadata"]["pages_from_text_layer"] == 2 \
+            and abs(first["bbox"][1] - 78) <= 3 and calls_after_one == 1:
+        print(f"✓ Text layer read without a model call: {blocks}, first box {first['bbox']} in points")
+    else:
+        print(f"✗ Unexpected text layer result: {text}")
+    if [b["text"] for b in total.get("pages", [{}])[0].get("content", {}).get("text_blocks", [])] == ["Total: 99.00"]:
+        print("✓ Region in page points selects the text blocks inside it")
+    else:
+        print(f"✗ Unexpected region result: {total}")
+    page = scanned.get("pages", [{}])[0]
+    if (page.get("source") == "model" and page["content"]["text_blocks"][0]["bbox"] == [306, 396, 330, 408]
+            and page["dpi"] == active_vision.PDF_MAX_DPI and scanned["metadata"]["page_count"] == 3):
+        print(f"✓ Scanned page rasterized at {page['dpi']} DPI, boxes mapped back to page points")
+    else:
+        print(f"✗ Unexpected scanned page: {scanned}")
+    if (calls_after_upload == 2 and [p["index"] for p in both.get("pages", [])] == [0, 2]
+            and uploaded.get("pages") == scanned.get("pages")):
+        print("✓ Pages cached by content hash, page and DPI; uploaded bytes reuse them")
+    else:
+        print(f"✗ Unexpected page caching: {calls_after_upload} calls, {uploaded}")
+    if described.get("pages", [{}])[0].get("dpi") == 139 and fake.calls == 3:
+        print("✓ DPI chosen from the mode's max_dim (general: 139 DPI for a Letter page)")
+    else:
+        print(f"✗ Unexpected DPI choice: {described}")
+    if "out of range" in out_of_range.get("error", "") and "PDF" in not_pdf.get("error", ""):
+        print("✓ Bad page indices and pages on images rejected")
+    else:
+        print(f"✗ Unexpected errors: {out_of_range} / {not_pdf}")
+
 def main():
     """Run all tests."""
     print("\n" + "="*60)
@@ -232,6 +1570,30 @@ def main():
         test_json_repair()
         test_examine_image_validation()
         test_all_modes()
+        test_near_duplicate_index()
+        test_connection_pooling()
+        test_rate_limit_and_breaker()
+        test_priority_scheduler()
+        test_multi_frame()
+        test_video_keyframes()
+        test_content_crop()
+        test_result_index()
+        test_prompt_prefix()
+        test_box_refinement()
+        test_lazy_imports()
+        test_shared_store()
+        test_in_memory_images()
+        test_screenshot_fast_path()
+        test_compact_schema()
+        test_progressive()
+        test_hedging()
+        test_batch_jobs()
+        test_spatial_queries()
+        test_image_pyramid()
+        test_record_replay()
+        test_cache_snapshots()
+        test_file_access()
+        test_pdf_documents()
         
         print("\n" + "="*60)
         print("Test Suite Completed!")